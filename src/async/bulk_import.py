@@ -0,0 +1,198 @@
+"""
+Streaming NDJSON bulk import of products.
+
+The request body is read incrementally, one line per product. Lines are
+validated against `ProductInput` and inserted in chunks of `CHUNK_SIZE` rows
+with a commit per chunk: on PostgreSQL with asyncpg's COPY
+(`copy_records_to_table()`), elsewhere with a single executemany
+(insertmanyvalues) INSERT. Only one chunk is held in memory at a time,
+whatever the size of the upload; the result keeps running totals and
+the statistics of the last `MAX_REPORTED_CHUNKS` chunks only.
+
+Chunks are committed as they are inserted: an import that fails midway
+(e.g. with 413, a line too long) keeps the chunks committed before the
+failure, and the error reports them (`inserted`, `rejected` and
+`chunk_count` so far); the rows read since the last commit are not
+inserted.
+"""
+import time
+from collections import deque
+from typing import AsyncIterator
+
+import models
+import schemas
+from fastapi import HTTPException
+from pydantic import ValidationError
+from sqlalchemy import insert
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+CHUNK_SIZE = 1000
+MAX_LINE_BYTES = 64 * 1024
+# rejected rows beyond this are counted, but not reported one by one
+MAX_REPORTED_ERRORS = 1000
+# statistics of the last chunks in the result, the others are only counted
+MAX_REPORTED_CHUNKS = 10
+
+
+async def iter_lines(
+        stream: AsyncIterator[bytes],
+) -> AsyncIterator[tuple[int, bytes]]:
+    """Yield (line number, line) for every non-empty line of the stream."""
+    line_no = 0
+    buffer = b""
+    async for data in stream:
+        buffer += data
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            line_no += 1
+            if line.strip():
+                yield line_no, line
+        if len(buffer) > MAX_LINE_BYTES:
+            raise HTTPException(
+                status_code=413,
+                detail=f"Line {line_no + 1} exceeds {MAX_LINE_BYTES} bytes.",
+            )
+    if buffer.strip():
+        yield line_no + 1, buffer
+
+
+def format_error(e: ValidationError) -> str:
+    messages = []
+    for error in e.errors():
+        field = ".".join(str(loc) for loc in error["loc"]) or "row"
+        messages.append(f"{field}: {error['msg']}")
+    return "; ".join(messages)
+
+
+def to_row(product: schemas.ProductInput) -> dict:
+    row = product.model_dump()
+    # same normalization as `Product.validate_product_name()`,
+    # validators do not run for bulk inserts
+    row["product_name"] = row["product_name"].title()
+    return row
+
+
+async def copy_chunk(session: AsyncSession, rows: list[tuple[int, dict]]):
+    """COPY a chunk into the product table with asyncpg."""
+    columns = ["product_name", "unit_price", "units_in_stock", "type"]
+    records = [
+        # COPY sends the enum label, like SQLAlchemy's Enum type does
+        tuple(row[c].name if c == "type" else row[c] for c in columns)
+        for _, row in rows
+    ]
+    conn = await session.connection()
+    raw_connection = await conn.get_raw_connection()
+    try:
+        await raw_connection.driver_connection.copy_records_to_table(
+            models.Product.__tablename__,
+            records=records,
+            columns=columns,
+        )
+    except Exception as e:
+        # asyncpg errors are only wrapped by SQLAlchemy for its own calls
+        raise DBAPIError(None, None, e) from e
+
+
+async def insert_chunk(
+        session: AsyncSession,
+        rows: list[tuple[int, dict]],
+) -> list[tuple[int, str]]:
+    """
+    Insert and commit a chunk of (line number, row) pairs with one COPY or
+    executemany. If the database rejects the chunk, the rows are inserted one
+    by one to find the rejected ones, which are returned with their error.
+    """
+    if not rows:
+        return []
+
+    try:
+        if session.bind.dialect.driver == "asyncpg":
+            await copy_chunk(session, rows)
+        else:
+            await session.execute(
+                insert(models.Product), [row for _, row in rows])
+        await session.commit()
+        return []
+    except DBAPIError:
+        await session.rollback()
+
+    rejected = []
+    for line_no, row in rows:
+        try:
+            async with session.begin_nested():
+                await session.execute(insert(models.Product), [row])
+        except DBAPIError as e:
+            rejected.append((line_no, str(e.orig)))
+    await session.commit()
+    return rejected
+
+
+async def import_products(
+        stream: AsyncIterator[bytes],
+        session: AsyncSession,
+        chunk_size: int = CHUNK_SIZE,
+) -> dict:
+    result = {
+        "inserted": 0,
+        "rejected": 0,
+        "chunk_count": 0,
+        "seconds": 0.0,
+        "chunks": deque(maxlen=MAX_REPORTED_CHUNKS),
+        "errors": [],
+    }
+
+    def reject(line_no: int, error: str):
+        result["rejected"] += 1
+        if len(result["errors"]) < MAX_REPORTED_ERRORS:
+            result["errors"].append({"line": line_no, "error": error})
+
+    async def flush(rows: list[tuple[int, dict]], invalid: int):
+        start = time.perf_counter()
+        rejected = await insert_chunk(session, rows)
+        for line_no, error in rejected:
+            reject(line_no, error)
+        inserted = len(rows) - len(rejected)
+        seconds = time.perf_counter() - start
+        result["inserted"] += inserted
+        result["chunk_count"] += 1
+        result["seconds"] += seconds
+        result["chunks"].append({
+            "chunk": result["chunk_count"],
+            "rows": len(rows) + invalid,
+            "inserted": inserted,
+            "rejected": len(rejected) + invalid,
+            "seconds": round(seconds, 6),
+        })
+
+    rows = []
+    invalid = 0
+    try:
+        async for line_no, line in iter_lines(stream):
+            try:
+                product = schemas.ProductInput.model_validate_json(line)
+            except ValidationError as e:
+                reject(line_no, format_error(e))
+                invalid += 1
+            else:
+                rows.append((line_no, to_row(product)))
+
+            if len(rows) + invalid >= chunk_size:
+                await flush(rows, invalid)
+                rows = []
+                invalid = 0
+    except HTTPException as e:
+        # the chunks before are committed: say how much was imported
+        raise HTTPException(status_code=e.status_code, detail={
+            "error": e.detail,
+            "inserted": result["inserted"],
+            "rejected": result["rejected"],
+            "chunk_count": result["chunk_count"],
+        }) from e
+
+    if rows or invalid:
+        await flush(rows, invalid)
+
+    result["seconds"] = round(result["seconds"], 6)
+    result["chunks"] = list(result["chunks"])
+    return result
@@ -0,0 +1,189 @@
+"""
+Hit rate of SQLAlchemy's compiled statement cache, per call site.
+
+Every execution of a statement looks up its cache key in the engine's
+compiled cache; a miss compiles the statement to SQL again. The
+`before_execute` listener records when the execution started and where it
+was called from (the first frame outside SQLAlchemy), `before_cursor_execute`
+reads the outcome from `context.cache_hit`; the time in between is the
+compilation (or lookup) time.
+
+Per call site it reports the executions by outcome:
+
+- hit: found in the cache,
+- miss: compiled and cached (expected once per statement shape),
+- no_cache_key: the statement cannot produce a cache key, e.g., it contains
+  a custom construct without `inherit_cache`, and is compiled every time,
+- disabled: caching turned off (`compiled_cache=None` execution option),
+
+with the compilation times and the size of the engine's cache. Sites that
+never hit the cache are flagged: "never cacheable" when no execution had a
+cache key, "no reuse" when every execution was a miss (a new cache key each
+time, like literal values rendered into the statement).
+
+`stmt.compile()` (used to print statements) never uses the cache and is not
+an execution, so it does not show up here.
+
+In the async app, statements are executed by the sync engine inside a
+greenlet, whose stack ends in SQLAlchemy: the call site is found by going on
+with the stack of the parent greenlet, where the caller awaits.
+
+Walking the stack costs a few microseconds per statement: the FastAPI
+service installs the listeners only when `SQL_CACHE_STATS=1`.
+"""
+import os
+import sys
+import sysconfig
+import threading
+import time
+from collections import defaultdict
+from typing import Any
+
+import greenlet
+import sqlalchemy
+from sqlalchemy import event
+from sqlalchemy.engine.default import (CACHE_HIT, CACHE_MISS,
+                                       CACHING_DISABLED, NO_CACHE_KEY)
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+SQL_CACHE_STATS = os.environ.get("SQL_CACHE_STATS", "") == "1"
+
+OUTCOMES = {
+    CACHE_HIT: "hit",
+    CACHE_MISS: "miss",
+    NO_CACHE_KEY: "no_cache_key",
+    CACHING_DISABLED: "disabled",
+}
+
+# frames in these packages and in the standard library are not call sites;
+# those of third-party packages, even installed under the standard library
+# (site-packages of a system Python), are
+_INTERNAL_PACKAGES = tuple(os.path.join(path, "") for path in (
+    os.path.dirname(sqlalchemy.__file__),
+    os.path.dirname(greenlet.__file__),
+))
+_STDLIB = os.path.join(sysconfig.get_paths()["stdlib"], "")
+_THIRD_PARTY = (f"{os.sep}site-packages{os.sep}",
+                f"{os.sep}dist-packages{os.sep}")
+
+
+def is_internal(filename: str) -> bool:
+    if filename.startswith(_INTERNAL_PACKAGES):
+        return True
+    return filename.startswith(_STDLIB) and not any(
+        part in filename for part in _THIRD_PARTY)
+
+
+def call_site() -> str:
+    """`file:line (function)` of the innermost caller outside SQLAlchemy."""
+    frame = sys._getframe(2)  # skip this function and the listener
+    current = greenlet.getcurrent()
+    while True:
+        while frame is not None:
+            filename = frame.f_code.co_filename
+            if not is_internal(filename):
+                return (f"{os.path.basename(filename)}:{frame.f_lineno} "
+                        f"({frame.f_code.co_name})")
+            frame = frame.f_back
+        # the awaiting caller is suspended in the parent greenlet
+        current = current.parent
+        if current is None:
+            return "<unknown>"
+        frame = current.gr_frame
+
+
+class CacheStats:
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.sites: dict[str, dict[str, Any]] = defaultdict(self._new_site)
+        self.engines: list[AsyncEngine] = []
+
+    @staticmethod
+    def _new_site() -> dict[str, Any]:
+        return {
+            "executions": 0,
+            **{outcome: 0 for outcome in OUTCOMES.values()},
+            "compile_ms_total": 0.0,
+            "compile_ms_max": 0.0,
+            "statement": "",
+        }
+
+    def _before_execute(
+            self, conn, clauseelement, multiparams, params, execution_options):
+        conn.info["cache_stats"] = (time.perf_counter(), call_site())
+
+    def _before_cursor_execute(
+            self, conn, cursor, statement, parameters, context, executemany):
+        started = conn.info.pop("cache_stats", None)
+        if started is None:  # not from `execute()`, e.g., DDL
+            return
+        start, site = started
+        milliseconds = (time.perf_counter() - start) * 1000
+        outcome = OUTCOMES.get(context.cache_hit)
+        with self._lock:
+            stats = self.sites[site]
+            stats["executions"] += 1
+            if outcome is not None:
+                stats[outcome] += 1
+            if context.cache_hit is not CACHE_HIT:
+                # time spent compiling; a hit only costs the lookup
+                stats["compile_ms_total"] += milliseconds
+                stats["compile_ms_max"] = max(
+                    stats["compile_ms_max"], milliseconds)
+            if not stats["statement"]:
+                stats["statement"] = " ".join(statement.split())[:200]
+
+    def install(self, engine: AsyncEngine):
+        sync_engine = engine.sync_engine
+        event.listen(sync_engine, "before_execute", self._before_execute)
+        event.listen(
+            sync_engine, "before_cursor_execute", self._before_cursor_execute)
+        self.engines.append(engine)
+
+    def uninstall(self, engine: AsyncEngine):
+        sync_engine = engine.sync_engine
+        event.remove(sync_engine, "before_execute", self._before_execute)
+        event.remove(
+            sync_engine, "before_cursor_execute", self._before_cursor_execute)
+        self.engines.remove(engine)
+
+    def reset(self):
+        with self._lock:
+            self.sites.clear()
+
+    def report(self) -> dict[str, Any]:
+        with self._lock:
+            sites = {site: dict(stats) for site, stats in self.sites.items()}
+        for stats in sites.values():
+            cacheable = stats["hit"] + stats["miss"]
+            stats["hit_rate"] = (
+                stats["hit"] / stats["executions"]
+                if stats["executions"] else 0.0
+            )
+            if cacheable == 0:
+                stats["flag"] = "never cacheable"
+            elif stats["hit"] == 0 and stats["miss"] > 1:
+                stats["flag"] = "no reuse"
+            else:
+                stats["flag"] = None
+        return {
+            "caches": [engine_cache(engine) for engine in self.engines],
+            "sites": dict(sorted(
+                sites.items(),
+                key=lambda item: item[1]["compile_ms_total"],
+                reverse=True,
+            )),
+        }
+
+
+def engine_cache(engine: AsyncEngine) -> dict[str, Any]:
+    cache = engine.sync_engine._compiled_cache  # LRUCache, None if disabled
+    return {
+        "engine": repr(engine.url),
+        "size": len(cache) if cache is not None else 0,
+        "capacity": cache.capacity if cache is not None else 0,
+    }
+
+
+cache_stats = CacheStats()
+
@@ -2,9 +2,10 @@
 Database CRUD operations for FastAPI service.
 """
 import models
+import pagination
 import schemas
 from fastapi import HTTPException
-from sqlalchemy import desc, select
+from sqlalchemy import desc, func, select
 from sqlalchemy.ext.asyncio import AsyncSession
 
 
@@ -40,22 +41,70 @@ async def get_products(
         page_size: int,
         order_by: str,
         direction: str,
+        total: str = "none",
+        q: str | None = None,
 ):
-    stmt = (
-        select(models.Product)
-        .offset((page - 1) * page_size)
-        .limit(page_size)
-    )
+    if total not in pagination.TOTAL_MODES:
+        raise HTTPException(
+            status_code=400,
+            detail=f'Use one of {pagination.TOTAL_MODES} for the total.',
+        )
+
+    table = models.Product.__table__
+    if q is None:
+        stmt = select(models.Product)
+    else:
+        # best matches first, then `order_by`
+        try:
+            stmt = models.Product.search(q)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        if total not in ("none", "exact"):
+            raise HTTPException(
+                status_code=400,
+                detail='Use none or exact for the total of a search.',
+            )
+        table = stmt.subquery()  # what `exact_count()` counts
+
+    # fetch one more row than requested to know if there is a next page
+    stmt = stmt.offset((page - 1) * page_size).limit(page_size + 1)
+    # a column, rather than a string resolved as a label reference, so an
+    # unknown name is a client error instead of a CompileError
+    column = models.Product.__table__.c.get(order_by)
+    if column is None:
+        raise HTTPException(
+            status_code=400,
+            detail=f'Cannot order by {order_by!r}.',
+        )
     if direction == "asc":
-        stmt = stmt.order_by(order_by)
+        stmt = stmt.order_by(column)
     elif direction == "desc":
-        stmt = stmt.order_by(desc(order_by))
+        stmt = stmt.order_by(desc(column))
     else:
         raise HTTPException(
             status_code=400,
             detail='Use asc or desc for the direction parameter.',
         )
 
-    products = (await session.scalars(stmt)).all()
+    count = None
+    if total == "exact":
+        # the window is computed before LIMIT, in the same query
+        stmt = stmt.add_columns(func.count().over().label("total"))
+        rows = (await session.execute(stmt)).all()
+        products = [row[0] for row in rows]
+        if rows:
+            count = rows[0].total
+        else:
+            # past the last page, the window has no row to report on
+            count = await pagination.exact_count(session, table)
+    else:
+        products = (await session.scalars(stmt)).all()
+        count = await pagination.total_count(session, table, total)
 
-    return products
+    return {
+        "items": products[:page_size],
+        "page": page,
+        "page_size": page_size,
+        "has_more": len(products) > page_size,
+        "total": count,
+    }
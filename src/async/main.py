@@ -1,14 +1,35 @@
 """
 SQLAlchemy Integration with FastAPI.
 """
+from contextlib import asynccontextmanager
 from typing import AsyncGenerator
+
+import bulk_import
 import crud
+import etag
+import export
 import schemas
-from fastapi import Depends, FastAPI
-from models import AsyncSessionMaker
+import warmup
+from fastapi import (Depends, FastAPI, Header, HTTPException, Query, Request,
+                     Response)
+from cache_stats import SQL_CACHE_STATS, cache_stats
+from models import AsyncSessionMaker, engine
+from profiler import profiler
 from sqlalchemy.ext.asyncio import AsyncSession
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # fill the pool, the compiled cache and asyncpg's prepared statements
+    # before serving requests
+    await warmup.warm_up()
+    yield
+
+
+app = FastAPI(lifespan=lifespan)
+profiler.install(engine)
+if SQL_CACHE_STATS:
+    cache_stats.install(engine)
 
 
 # Dependency Injection
@@ -17,6 +38,31 @@ async def get_session() -> AsyncGenerator[AsyncSession, None]:
         yield session
 
 
+@app.get("/admin/profiler")
+async def profiler_report(top: int = 20):
+    """Statement statistics of this process, slowest in total first."""
+    return profiler.report(top)
+
+
+@app.delete("/admin/profiler", status_code=204)
+async def reset_profiler():
+    profiler.reset()
+
+
+@app.get("/admin/cache")
+async def cache_report():
+    """Compiled cache outcomes per call site, set `SQL_CACHE_STATS=1`."""
+    if not SQL_CACHE_STATS:
+        raise HTTPException(
+            status_code=404, detail="Set SQL_CACHE_STATS=1 to enable.")
+    return cache_stats.report()
+
+
+@app.delete("/admin/cache", status_code=204)
+async def reset_cache_stats():
+    cache_stats.reset()
+
+
 @app.post("/products", status_code=201, response_model=schemas.ProductOutput)
 async def create_product(
     product: schemas.ProductInput,
@@ -25,20 +71,59 @@ async def create_product(
     return await crud.create_product(session, product)
 
 
+@app.post("/products/bulk", response_model=schemas.ImportResult)
+async def bulk_import_products(
+    request: Request,
+    session: AsyncSession = Depends(get_session),
+):
+    """Import products from an NDJSON body, one product per line."""
+    return await bulk_import.import_products(request.stream(), session)
+
+
+# declared before `/products/{product_id}` so "export" is not taken as an ID
+@app.get("/products/export")
+async def export_products(fmt: str = Query("ndjson", alias="format")):
+    return export.export_response(export.products_stmt(), fmt, "products")
+
+
+@app.get("/orders/export")
+async def export_orders(fmt: str = Query("ndjson", alias="format")):
+    return export.export_response(export.orders_stmt(), fmt, "orders")
+
+
 @app.get("/products/{product_id}", response_model=schemas.ProductOutput)
 async def get_product(
     product_id: int,
+    response: Response,
+    if_none_match: str | None = Header(None),
     session: AsyncSession = Depends(get_session),
 ):
-    return await crud.get_product(session, product_id)
+    # conditional GET: compare versions without loading the product
+    if if_none_match is not None:
+        version = await etag.get_product_version(session, product_id)
+        if version is not None:
+            tag = etag.make_etag(product_id, version)
+            if etag.etag_matches(if_none_match, tag):
+                return Response(status_code=304, headers={"ETag": tag})
+
+    product = await crud.get_product(session, product_id)
+    if product is None:
+        raise HTTPException(status_code=404, detail="Product not found.")
+    etag.version_cache.set(product.product_id, product.version_id)
+    response.headers["ETag"] = etag.make_etag(
+        product.product_id, product.version_id)
+    return product
 
 
-@app.get("/products", response_model=list[schemas.ProductOutput])
+@app.get("/products", response_model=schemas.ProductPage)
 async def get_products(
     page: int = 1,
     page_size: int = 3,
     order_by: str = "product_id",
     direction: str = "asc",
+    total: str = "none",
+    q: str | None = None,
     session: AsyncSession = Depends(get_session),
 ):
-    return await crud.get_products(session, page, page_size, order_by, direction)
+    return await crud.get_products(
+        session, page, page_size, order_by, direction, total, q)
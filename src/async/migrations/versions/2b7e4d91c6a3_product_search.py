@@ -0,0 +1,88 @@
+"""product search
+
+Revision ID: 2b7e4d91c6a3
+Revises: 4a9e1f6b7c02
+Create Date: 2026-10-19 15:14:03.618452
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '2b7e4d91c6a3'
+down_revision: Union[str, None] = '4a9e1f6b7c02'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+# The full-text index of `product.product_name` used by `Product.search()`:
+# an FTS5 table kept in sync by triggers (SQLite), a GIN index (PostgreSQL).
+SQL_CREATE_SEARCH = {
+    'sqlite': [
+        '''
+        CREATE VIRTUAL TABLE product_search USING fts5(
+            product_name, content='product', content_rowid='product_id'
+        )
+        ''',
+        '''
+        CREATE TRIGGER product_search_insert AFTER INSERT ON product
+        BEGIN
+            INSERT INTO product_search (rowid, product_name)
+            VALUES (NEW.product_id, NEW.product_name);
+        END
+        ''',
+        '''
+        CREATE TRIGGER product_search_update
+        AFTER UPDATE OF product_name ON product
+        BEGIN
+            INSERT INTO product_search (product_search, rowid, product_name)
+            VALUES ('delete', OLD.product_id, OLD.product_name);
+            INSERT INTO product_search (rowid, product_name)
+            VALUES (NEW.product_id, NEW.product_name);
+        END
+        ''',
+        '''
+        CREATE TRIGGER product_search_delete AFTER DELETE ON product
+        BEGIN
+            INSERT INTO product_search (product_search, rowid, product_name)
+            VALUES ('delete', OLD.product_id, OLD.product_name);
+        END
+        ''',
+        # index the existing products
+        "INSERT INTO product_search (product_search) VALUES ('rebuild')",
+    ],
+    'postgresql': [
+        '''
+        CREATE INDEX product_name_search ON product
+        USING gin (to_tsvector('simple', product_name))
+        ''',
+    ],
+}
+SQL_DROP_SEARCH = {
+    'sqlite': [
+        'DROP TRIGGER IF EXISTS product_search_insert',
+        'DROP TRIGGER IF EXISTS product_search_update',
+        'DROP TRIGGER IF EXISTS product_search_delete',
+        'DROP TABLE IF EXISTS product_search',
+    ],
+    'postgresql': [
+        'DROP INDEX IF EXISTS product_name_search',
+    ],
+}
+
+
+# other databases have no search index: `Product.search()` falls back to
+# ILIKE there
+
+
+def upgrade() -> None:
+    for statement in SQL_CREATE_SEARCH.get(op.get_bind().dialect.name, []):
+        op.execute(statement)
+
+
+def downgrade() -> None:
+    for statement in SQL_DROP_SEARCH.get(op.get_bind().dialect.name, []):
+        op.execute(statement)
@@ -0,0 +1,35 @@
+"""product version
+
+Revision ID: 6f0d2a8c41e5
+Revises: 1ca60b32bf67
+Create Date: 2026-10-19 10:14:03.771590
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '6f0d2a8c41e5'
+down_revision: Union[str, None] = '1ca60b32bf67'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # existing rows start at version 1
+    op.add_column(
+        'product',
+        sa.Column(
+            'version_id',
+            sa.Integer(),
+            server_default='1',
+            nullable=False,
+        ),
+    )
+
+
+def downgrade() -> None:
+    op.drop_column('product', 'version_id')
@@ -35,3 +35,48 @@ class ProductOutput(ProductBase):
 
     class Config:
         from_attributes = True  # for compatibility between models
+
+
+class ProductPage(BaseModel):
+    """
+    A page of products. `has_more` tells if there is a next page, `total` is
+    only set when a total was requested (exact, estimated or cached).
+    """
+    items: list[ProductOutput]
+    page: int
+    page_size: int
+    has_more: bool
+    total: int | None = None
+
+
+class ImportChunk(BaseModel):
+    """
+    Progress of one chunk of a bulk import.
+    """
+    chunk: int
+    rows: int
+    inserted: int
+    rejected: int
+    seconds: float
+
+
+class ImportRowError(BaseModel):
+    """
+    A rejected row of a bulk import, identified by its line number.
+    """
+    line: int
+    error: str
+
+
+class ImportResult(BaseModel):
+    """
+    Result of a bulk import. Only the first rejected rows are listed in
+    `errors`, `rejected` counts all of them; only the last chunks are listed
+    in `chunks`, `chunk_count` counts all of them.
+    """
+    inserted: int
+    rejected: int
+    chunk_count: int
+    seconds: float
+    chunks: list[ImportChunk]
+    errors: list[ImportRowError]
@@ -0,0 +1,123 @@
+"""
+Startup warm-up for the FastAPI service.
+
+The first requests after a deploy pay for mapper configuration, SQL
+compilation and opening database connections. With asyncpg, every statement
+is also prepared once per connection. The hot paths registered here are run
+once on every pooled connection before the app accepts traffic, so the
+compiled cache, the pool and asyncpg's prepared statement cache are already
+filled when requests arrive.
+"""
+import asyncio
+import time
+from contextlib import AsyncExitStack
+from typing import Awaitable, Callable
+
+import crud
+import models
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine, AsyncSession
+from sqlalchemy.orm import configure_mappers
+
+HotPath = Callable[[AsyncSession], Awaitable[None]]
+
+# statements used by `crud`, run against each pooled connection on startup
+HOT_PATHS: list[HotPath] = []
+
+
+def hot_path(fn: HotPath) -> HotPath:
+    """Register a coroutine function that executes a hot statement."""
+    HOT_PATHS.append(fn)
+    return fn
+
+
+@hot_path
+async def warm_get_product(session: AsyncSession):
+    # a PK that does not exist still compiles and prepares the statement
+    await crud.get_product(session, 0)
+
+
+@hot_path
+async def warm_get_products(session: AsyncSession):
+    # default parameters of `GET /products`, in both directions
+    for direction in ("asc", "desc"):
+        await crud.get_products(session, 1, 3, "product_id", direction)
+
+
+@hot_path
+async def warm_create_product(session: AsyncSession):
+    # like `crud.create_product()`, but flushed instead of committed;
+    # the INSERT is rolled back by `warm_up_connection()`
+    session.add(models.Product(product_name="warm-up", unit_price=1))
+    await session.flush()
+
+
+async def warm_up_connection(
+        conn: AsyncConnection,
+        hot_paths: list[HotPath] = HOT_PATHS,
+):
+    """
+    Run the hot paths on a single connection. Everything is rolled back, so
+    nothing written by the warm-up is ever visible to other transactions.
+    """
+    async with AsyncSession(bind=conn) as session:
+        for fn in hot_paths:
+            await fn(session)
+        await session.rollback()
+
+
+def raise_first_error(results: list):
+    """Raise the first exception returned by `asyncio.gather()`, if any."""
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+
+
+async def warm_up(
+        engine: AsyncEngine = models.engine,
+        connections: int | None = None,
+        hot_paths: list[HotPath] = HOT_PATHS,
+) -> dict[str, float]:
+    """
+    Configure the mappers, open `connections` connections (defaults to the
+    pool size) concurrently and run the hot paths on each of them.
+    Returns the time spent on every step in seconds.
+    """
+    timings = {}
+
+    start = time.perf_counter()
+    configure_mappers()
+    timings["configure_mappers"] = time.perf_counter() - start
+
+    if connections is None:
+        size = getattr(engine.pool, "size", None)
+        connections = size() if callable(size) else 1
+
+    async with AsyncExitStack() as stack:
+        # check out all connections before using them, otherwise the pool
+        # would hand out the same connection again and again; the ones
+        # opened are closed on exit, even if opening another one failed
+        start = time.perf_counter()
+        results = await asyncio.gather(
+            *(engine.connect().start() for _ in range(connections)),
+            return_exceptions=True,
+        )
+        conns = [r for r in results if isinstance(r, AsyncConnection)]
+        for conn in conns:
+            stack.push_async_callback(conn.close)
+        raise_first_error(results)
+        timings["pool_prefill"] = time.perf_counter() - start
+
+        # no connection is closed while a hot path still runs on another
+        start = time.perf_counter()
+        raise_first_error(await asyncio.gather(
+            *(warm_up_connection(conn, hot_paths) for conn in conns),
+            return_exceptions=True,
+        ))
+        timings["hot_paths"] = time.perf_counter() - start
+
+    return timings
+
+
+if __name__ == "__main__":
+    for step, seconds in asyncio.run(warm_up()).items():
+        print(f"{step:<20}: {seconds * 1000:.2f} ms")
@@ -0,0 +1,334 @@
+"""
+Order fulfilment queue for concurrent workers.
+
+Several workers running `process_order()` of update_delete_data.py on the
+unshipped orders pick the same orders, and each of them locks the products
+of an order one by one: workers wait on each other's product rows (a lock
+convoy) and can deadlock when two orders list the same products in another
+order.
+
+Here each worker claims a batch of orders that no other worker holds and
+fulfils it in one transaction:
+
+- on PostgreSQL and MySQL, `SELECT ... FOR UPDATE SKIP LOCKED` claims the
+  batch in the fulfilment transaction: rows locked by other workers are
+  skipped, not waited for,
+- other databases (SQLite) have no row locks: a claim is a lease,
+  `order.claimed_by` and `order.claimed_until`, taken by one short
+  `UPDATE ... RETURNING` and released by shipping. The orders of a worker
+  that dies are claimed again once the lease expires.
+
+A batch is fulfilled by shipping its orders (only those still unshipped, and
+still claimed by this worker for a lease) and decrementing the stock of each
+product once, with the quantities of the batch added up, in product order:
+every product row is locked once per batch and in the same order by all the
+workers. If a product runs out (checked on the locked rows, not left to the
+CHECK constraint: MySQL reports its violation as an OperationalError), the
+batch is rolled back to a savepoint and its orders are fulfilled one per
+savepoint; those that fail are left unshipped and not claimed again for
+`RETRY_DELAY`. MySQL and MariaDB have no `UPDATE ... RETURNING`: the orders
+to ship are selected, and locked, before the update there.
+
+A transaction that fails on a serialization failure or a deadlock (or SQLite
+being locked) is retried from the start, up to `MAX_ATTEMPTS`, after an
+exponential backoff with jitter. Workers are threads or processes of
+`run_workers()`; adding workers (or hosts running it) scales out, since they
+only meet on the products of the orders they ship.
+"""
+import os
+import random
+import socket
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timedelta
+from functools import cache
+
+from sqlalchemy import (Connection, Engine, bindparam, create_engine, func,
+                        or_, select, update)
+from sqlalchemy.exc import DBAPIError
+from tables import order, order_detail, product
+
+BATCH_SIZE = 50
+LEASE = timedelta(minutes=5)
+RETRY_DELAY = timedelta(minutes=1)
+MAX_ATTEMPTS = 8
+BACKOFF = 0.01  # seconds before the first retry, doubled every attempt
+
+SKIP_LOCKED_DIALECTS = ("postgresql", "mysql", "mariadb")
+# serialization failure, deadlock (PostgreSQL SQLSTATE, MySQL error code)
+RETRY_SQLSTATES = ("40001", "40P01")
+RETRY_MYSQL_ERRORS = (1205, 1213)
+
+
+class OutOfStock(Exception):
+    """Products with fewer units in stock than the orders to ship need."""
+
+
+def worker_name() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}"
+
+
+def is_retryable(error: DBAPIError) -> bool:
+    orig = error.orig
+    sqlstate = getattr(orig, "pgcode", None) or getattr(orig, "sqlstate", None)
+    if sqlstate in RETRY_SQLSTATES:
+        return True
+    if orig is not None and orig.args and orig.args[0] in RETRY_MYSQL_ERRORS:
+        return True
+    return "database is locked" in str(orig)  # SQLite
+
+
+def retrying(engine: Engine, transaction, *args):
+    """Run `transaction(conn, *args)` in a transaction, retried on errors."""
+    for attempt in range(MAX_ATTEMPTS - 1):
+        try:
+            with engine.begin() as conn:
+                return transaction(conn, *args)
+        except DBAPIError as e:
+            if not is_retryable(e):
+                raise
+        time.sleep(BACKOFF * 2**attempt * random.uniform(0.5, 1.5))
+    with engine.begin() as conn:  # the last attempt
+        return transaction(conn, *args)
+
+
+def claimable(now: datetime):
+    return select(order.c.order_id).where(
+        order.c.is_shipped == False,  # noqa: E712
+        or_(order.c.claimed_until == None,  # noqa: E711
+            order.c.claimed_until < now),
+    )
+
+
+def lock_batch(conn: Connection, batch_size: int) -> list[int]:
+    """Lock unshipped orders that no other transaction has locked."""
+    stmt = (
+        claimable(datetime.now())
+        .order_by(order.c.order_id)
+        .limit(batch_size)
+        .with_for_update(skip_locked=True)
+    )
+    return list(conn.scalars(stmt))
+
+
+def lease_batch(conn: Connection, worker: str, batch_size: int) -> list[int]:
+    """Claim unshipped orders that are not claimed, for `LEASE`."""
+    now = datetime.now()
+    batch = claimable(now).order_by(order.c.order_id).limit(batch_size)
+    stmt = (
+        update(order)
+        .where(order.c.order_id.in_(batch.scalar_subquery()))
+        .values(claimed_by=worker, claimed_until=now + LEASE)
+    )
+    if conn.dialect.update_returning:
+        return sorted(conn.scalars(stmt.returning(order.c.order_id)))
+    conn.execute(stmt)
+    return list(conn.scalars(
+        select(order.c.order_id)
+        .where(order.c.claimed_by == worker,
+               order.c.claimed_until == now + LEASE)
+        .order_by(order.c.order_id)
+    ))
+
+
+def ship(
+        conn: Connection,
+        order_ids: list[int],
+        worker: str | None = None,
+) -> list[int]:
+    """
+    Ship the orders among `order_ids` that are not shipped yet (and claimed
+    by `worker`, if given), decrement the stock. Return the shipped orders.
+    Raise `OutOfStock` if a product runs out.
+    """
+    unshipped = [
+        order.c.order_id.in_(order_ids),
+        order.c.is_shipped == False,  # noqa: E712
+    ]
+    if worker is not None:
+        unshipped.append(order.c.claimed_by == worker)
+    stmt = update(order).values(is_shipped=True, claimed_until=None)
+    if conn.dialect.update_returning:
+        shipped = list(conn.scalars(
+            stmt.where(*unshipped).returning(order.c.order_id)))
+    else:  # MySQL, MariaDB: the selected rows stay locked until the update
+        shipped = list(conn.scalars(
+            select(order.c.order_id)
+            .where(*unshipped)
+            .order_by(order.c.order_id)
+            .with_for_update()
+        ))
+        if shipped:
+            conn.execute(stmt.where(order.c.order_id.in_(shipped)))
+    if not shipped:
+        return shipped
+
+    quantities = conn.execute(
+        select(order_detail.c.product_id, func.sum(order_detail.c.quantity))
+        .where(order_detail.c.order_id.in_(shipped))
+        .group_by(order_detail.c.product_id)
+        .order_by(order_detail.c.product_id)
+    ).all()
+    if quantities:
+        stock = dict(conn.execute(
+            select(product.c.product_id, product.c.units_in_stock)
+            .where(product.c.product_id.in_(
+                [product_id for product_id, _ in quantities]))
+            .order_by(product.c.product_id)
+            .with_for_update()
+        ).all())
+        missing = [
+            product_id for product_id, quantity in quantities
+            if (stock[product_id] or 0) < quantity
+        ]
+        if missing:
+            raise OutOfStock(missing)
+        conn.execute(
+            update(product)
+            .where(product.c.product_id == bindparam("id"))
+            .values(units_in_stock=product.c.units_in_stock
+                    - bindparam("quantity")),
+            [{"id": product_id, "quantity": quantity}
+             for product_id, quantity in quantities],
+        )
+    return shipped
+
+
+def postpone(conn: Connection, order_id: int, worker: str):
+    conn.execute(
+        update(order)
+        .where(order.c.order_id == order_id)
+        .where(order.c.is_shipped == False)  # noqa: E712
+        .values(claimed_by=worker,
+                claimed_until=datetime.now() + RETRY_DELAY)
+    )
+
+
+def fulfil(
+        conn: Connection,
+        claimed: list[int],
+        worker: str,
+        skip_locked: bool,
+) -> Counter:
+    stats = Counter(batches=1, claimed=len(claimed))
+    owner = None if skip_locked else worker
+    try:
+        with conn.begin_nested():
+            stats["shipped"] += len(ship(conn, claimed, owner))
+        return stats
+    except OutOfStock:  # one order per savepoint
+        pass
+    for order_id in claimed:
+        try:
+            with conn.begin_nested():
+                stats["shipped"] += len(ship(conn, [order_id], owner))
+        except OutOfStock:
+            postpone(conn, order_id, worker)
+            stats["postponed"] += 1
+    return stats
+
+
+def fulfil_batch(
+        engine: Engine,
+        worker: str,
+        batch_size: int = BATCH_SIZE,
+) -> Counter | None:
+    """Claim and fulfil one batch. None when no order could be claimed."""
+    if engine.dialect.name in SKIP_LOCKED_DIALECTS:
+        def claim_and_fulfil(conn: Connection):
+            claimed = lock_batch(conn, batch_size)
+            return fulfil(conn, claimed, worker, True) if claimed else None
+
+        return retrying(engine, claim_and_fulfil)
+
+    claimed = retrying(engine, lease_batch, worker, batch_size)
+    if not claimed:
+        return None
+    return retrying(engine, fulfil, claimed, worker, False)
+
+
+@cache
+def get_engine(url: str) -> Engine:
+    return create_engine(url, pool_size=32, max_overflow=0)
+
+
+def work(
+        url: str,
+        batch_size: int = BATCH_SIZE,
+        max_batches: int | None = None,
+) -> Counter:
+    """Fulfil batches until no order can be claimed (or `max_batches`)."""
+    engine = get_engine(url)
+    worker = worker_name()
+    stats: Counter = Counter()
+    while max_batches is None or stats["batches"] < max_batches:
+        batch = fulfil_batch(engine, worker, batch_size)
+        if batch is None:
+            break
+        stats += batch
+    return stats
+
+
+def run_workers(
+        url: str,
+        workers: int = 4,
+        batch_size: int = BATCH_SIZE,
+        processes: bool = False,
+) -> Counter:
+    """Run `workers` threads (or processes) until the queue is drained."""
+    executor = ProcessPoolExecutor if processes else ThreadPoolExecutor
+    with executor(workers) as pool:
+        results = [pool.submit(work, url, batch_size) for _ in range(workers)]
+        return sum((result.result() for result in results), Counter())
+
+
+if __name__ == "__main__":
+    import logging
+    import tempfile
+
+    from sqlalchemy import insert
+    from tables import customer, metadata
+
+    logging.disable(logging.INFO)  # `echo=True` on the engine of tables.py
+    orders, products = 5_000, 200
+    for workers in (1, 4):
+        with tempfile.TemporaryDirectory() as tmp:
+            url = f"sqlite+pysqlite:///{os.path.join(tmp, 'queue.db')}"
+            engine = get_engine(url)
+            metadata.create_all(engine)
+            rng = random.Random(0)
+            with engine.begin() as conn:
+                conn.execute(insert(customer), [{"email": "a@example.com"}])
+                conn.execute(insert(product), [
+                    # the last product runs out
+                    {"product_name": f"product {i}", "unit_price": 1,
+                     "units_in_stock": 10 if i == products - 1 else 10**6}
+                    for i in range(products)
+                ])
+                conn.execute(insert(order), [{"customer_id": 1}] * orders)
+                conn.execute(insert(order_detail), [
+                    {"order_id": o, "product_id": p, "quantity": 1}
+                    for o in range(1, orders + 1)
+                    for p in rng.sample(range(1, products + 1), 3)
+                ])
+
+            start = time.perf_counter()
+            stats = run_workers(url, workers)
+            seconds = time.perf_counter() - start
+            with engine.connect() as conn:
+                shipped = conn.scalar(
+                    select(func.count())
+                    .where(order.c.is_shipped == True))  # noqa: E712
+                sold = conn.scalar(select(func.sum(
+                    product.c.units_in_stock)))
+                ordered = conn.scalar(
+                    select(func.sum(order_detail.c.quantity))
+                    .join(order)
+                    .where(order.c.is_shipped == True))  # noqa: E712
+            stock = (products - 1) * 10**6 + 10
+            print(f"{workers} workers: {dict(stats)} in {seconds:.2f} s, "
+                  f"{shipped} orders shipped, stock consistent: "
+                  f"{stock - sold == ordered}")
+            get_engine(url).dispose()
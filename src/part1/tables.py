@@ -95,6 +95,9 @@ order = Table(
     ),
     Column("order_datetime", DateTime, default=datetime.now),
     Column("is_shipped", Boolean, default=False),
+    # claim of a fulfilment worker, see fulfilment.py
+    Column("claimed_by", String(63), nullable=True),
+    Column("claimed_until", DateTime, nullable=True),
 )
 
 order_detail = Table(
@@ -0,0 +1,332 @@
+"""
+Aggregate attributes loaded in batches, like `selectinload()` for
+collections.
+
+`Customer.order_count` is a `query_expression()`: it is only filled by a
+`with_expression()` option on the statement, usually a correlated subquery
+that the database runs once per customer row. An `Aggregate` declares how to
+compute such an attribute instead, from the foreign key of the children and
+an aggregate function (`count()` by default), and fills it for a whole
+result with one extra query:
+
+    SELECT customer_id, count(*) FROM "order"
+    WHERE customer_id IN (...) GROUP BY customer_id
+
+with the primary keys of the loaded parents, `IN_BATCH_SIZE` per query.
+Parents without children get `default`. The hybrids `Order.total`,
+`Order.item_count` and `Customer.lifetime_value` read such attributes
+(`Order._total`, ...), declared in `AGGREGATES` with the joins they need.
+
+With `enable_aggregates()`:
+
+- eager: `select(Customer).execution_options(aggregates=[ORDER_COUNT])`
+  fills the attribute before the result is returned. The result is buffered
+  (frozen) for that, so the option is ignored with `yield_per`.
+- lazy: an aggregate declared with `lazy=True` is filled on first access,
+  for every instance loaded by the same query that still lacks it. Once
+  expired (e.g. by a commit), it is filled on first access for every
+  instance of the session where it was expired.
+
+A value is stored like a loaded column: it is not updated when children are
+added or removed in the session, only by loading the parent again.
+"""
+import weakref
+
+from decimal import Decimal
+
+from models import Customer, Order, OrderDetail, Product
+from sqlalchemy import event, func, inspect, select
+from sqlalchemy.orm import InstrumentedAttribute, Session, with_expression
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.base import (ATTR_WAS_SET, NO_AUTOFLUSH,
+                                 PASSIVE_NO_RESULT, SQL_OK)
+
+IN_BATCH_SIZE = 500  # parameters per IN (...)
+
+
+class Aggregate:
+    """`attribute` = `expression` over the children, per `foreign_key`."""
+
+    def __init__(
+            self,
+            attribute: InstrumentedAttribute,
+            foreign_key: InstrumentedAttribute,
+            expression=None,
+            default=0,
+            lazy: bool = False,
+            select_from=None,
+    ) -> None:
+        self.attribute = attribute
+        self.foreign_key = foreign_key
+        self.expression = func.count() if expression is None else expression
+        # what `expression` is computed from, if not the children alone
+        self.select_from = select_from
+        self.default = default
+        self.lazy = lazy
+        self.key = attribute.key
+        self.parent = attribute.class_
+
+    def __repr__(self) -> str:
+        return f"Aggregate({self.attribute}, {self.foreign_key})"
+
+    def load(self, session: Session, instances) -> int:
+        """Fill the attribute of `instances` lacking it, return how many."""
+        states = [
+            state for state in map(inspect, instances)
+            if state.key is not None and self.key not in state.dict
+        ]
+        for start in range(0, len(states), IN_BATCH_SIZE):
+            batch = states[start:start + IN_BATCH_SIZE]
+            stmt = select(self.foreign_key, self.expression)
+            if self.select_from is not None:
+                stmt = stmt.select_from(self.select_from)
+            values = dict(session.execute(
+                stmt.where(self.foreign_key.in_(
+                    [state.identity[0] for state in batch]))
+                .group_by(self.foreign_key)
+            ).all())
+            for state in batch:
+                set_committed_value(
+                    state.obj(), self.key,
+                    values.get(state.identity[0], self.default))
+        return len(states)
+
+
+class BatchLoader:
+    """Loader callable of `aggregate` shared by the instances of a batch."""
+
+    def __init__(self, aggregate: Aggregate) -> None:
+        self.aggregate = aggregate
+        # id -> instance, not kept alive (dataclasses are not hashable)
+        self.instances: weakref.WeakValueDictionary = (
+            weakref.WeakValueDictionary())
+
+    def __call__(self, state, passive):
+        session = state.session
+        if not passive & SQL_OK or session is None:
+            return PASSIVE_NO_RESULT
+        instances = [
+            obj for obj in self.instances.values()
+            if inspect(obj).session is session
+        ]
+        self.instances.clear()
+        if passive & NO_AUTOFLUSH:
+            with session.no_autoflush:
+                self.aggregate.load(session, instances)
+        else:
+            self.aggregate.load(session, instances)
+        if self.aggregate.key not in state.dict:  # not loaded with the rest
+            self.aggregate.load(session, [state.obj()])
+        return ATTR_WAS_SET
+
+
+line_total = OrderDetail.quantity * Product.unit_price
+details_with_products = OrderDetail.__table__.join(Product.__table__)
+
+AGGREGATES = [
+    ORDER_COUNT := Aggregate(Customer.order_count, Order.customer_id,
+                             lazy=True),
+    ORDER_TOTAL := Aggregate(
+        Order._total,
+        OrderDetail.order_id,
+        func.sum(line_total),
+        default=Decimal(0),
+        lazy=True,
+        select_from=details_with_products,
+    ),
+    ORDER_ITEM_COUNT := Aggregate(
+        Order._item_count,
+        OrderDetail.order_id,
+        func.sum(OrderDetail.quantity),
+        lazy=True,
+    ),
+    LIFETIME_VALUE := Aggregate(
+        Customer._lifetime_value,
+        Order.customer_id,
+        func.sum(line_total),
+        default=Decimal(0),
+        lazy=True,
+        select_from=Order.__table__.join(details_with_products),
+    ),
+]
+
+
+def top_orders_by_value(session: Session, limit: int = 10) -> list[Order]:
+    """
+    The `limit` orders of highest `total`, with it filled: one GROUP BY
+    over the order details instead of a subquery per order.
+    """
+    total = func.sum(line_total)
+    return list(session.scalars(
+        select(Order)
+        .join(Order.order_details)
+        .join(OrderDetail.product)
+        .group_by(Order.order_id)
+        .order_by(total.desc(), Order.order_id)
+        .limit(limit)
+        .options(with_expression(Order._total, total))
+    ))
+
+
+def load_eagerly(orm_execute_state):
+    aggregates = orm_execute_state.execution_options.get("aggregates")
+    if (not aggregates or not orm_execute_state.is_select
+            or "yield_per" in orm_execute_state.execution_options):
+        return None
+    frozen = orm_execute_state.invoke_statement().freeze()
+    session = orm_execute_state.session
+    for aggregate in aggregates:
+        instances = [
+            entity for row in frozen()
+            for entity in row if isinstance(entity, aggregate.parent)
+        ]
+        aggregate.load(session, instances)
+    return frozen()
+
+
+def batch_lazily(aggregate: Aggregate) -> dict:
+    """Listeners adding the instances to the batch of their query."""
+    def add(state, batches: dict):
+        if aggregate.key in state.dict or aggregate.key in state.callables:
+            return  # loaded by `with_expression()` or already in a batch
+        loader = batches.get((BatchLoader, aggregate))
+        if loader is None or not loader.instances:
+            loader = batches[(BatchLoader, aggregate)] = (
+                BatchLoader(aggregate))
+        obj = state.obj()
+        loader.instances[id(obj)] = obj
+        if "callables" not in state.__dict__:
+            state.callables = {}
+        state.callables[aggregate.key] = loader
+
+    def on_load(target, context):
+        add(inspect(target), context.attributes)
+
+    def on_refresh(target, context, attrs):
+        add(inspect(target), context.attributes)
+
+    def on_expire(target, attrs):
+        state = inspect(target)
+        if state.session is not None and (attrs is None
+                                          or aggregate.key in attrs):
+            add(state, state.session.info)
+
+    return {"load": on_load, "refresh": on_refresh, "expire": on_expire}
+
+
+_lazy_listeners: dict[Aggregate, dict] = {}
+
+
+def enable_aggregates(target=Session):
+    """Load `AGGREGATES`, for all sessions by default."""
+    event.listen(target, "do_orm_execute", load_eagerly, retval=True)
+    for aggregate in AGGREGATES:
+        if aggregate.lazy and aggregate not in _lazy_listeners:
+            listeners = _lazy_listeners[aggregate] = batch_lazily(aggregate)
+            for name, fn in listeners.items():
+                event.listen(aggregate.parent, name, fn)
+
+
+def disable_aggregates(target=Session):
+    event.remove(target, "do_orm_execute", load_eagerly)
+    for aggregate, listeners in _lazy_listeners.items():
+        for name, fn in listeners.items():
+            event.remove(aggregate.parent, name, fn)
+    _lazy_listeners.clear()
+
+
+if __name__ == "__main__":
+    import logging
+    import time
+
+    from models import Base
+    from sqlalchemy import create_engine, insert
+
+    logging.disable(logging.INFO)  # `echo=True` on the engine of models.py
+    engine = create_engine("sqlite+pysqlite:///:memory:")
+    Base.metadata.create_all(engine)
+    with engine.begin() as conn:
+        conn.execute(insert(Customer), [
+            {"first_name": "First", "last_name": f"Last {i}",
+             "address": f"{i} Main St", "email": f"customer{i}@example.com"}
+            for i in range(2_000)
+        ])
+        conn.execute(insert(Order), [
+            {"customer_id": 1 + i * 7 % 1_999} for i in range(20_000)
+        ])
+        conn.execute(insert(Product), [
+            {"product_name": f"product {i}", "unit_price": Decimal(i) + 1}
+            for i in range(100)
+        ])
+        conn.execute(insert(OrderDetail), [
+            {"order_id": 1 + i // 3, "product_id": 1 + i * 13 % 100,
+             "quantity": 1 + i % 4}
+            for i in range(60_000)
+        ])
+    statements = 0
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def count(conn, cursor, statement, parameters, context, executemany):
+        global statements
+        statements += 1
+
+    correlated = (
+        select(func.count(Order.order_id))
+        .where(Order.customer_id == Customer.customer_id)
+        .scalar_subquery()
+    )
+    enable_aggregates()
+    for name, stmt in (
+            ("with_expression", select(Customer).options(
+                with_expression(Customer.order_count, correlated))),
+            ("eager", select(Customer).execution_options(
+                aggregates=[ORDER_COUNT])),
+            ("lazy", select(Customer)),
+    ):
+        with Session(engine) as session:
+            statements = 0
+            start = time.perf_counter()
+            customers = session.scalars(stmt).all()
+            total = sum(customer.order_count for customer in customers)
+            seconds = time.perf_counter() - start
+            print(f"{name}: {total} orders, {statements} statements, "
+                  f"{seconds * 1000:.0f} ms")
+
+    with Session(engine) as session:
+        customers = session.scalars(select(Customer)).all()
+        session.commit()  # expires them
+        statements = 0
+        total = sum(customer.order_count for customer in customers)
+        print(f"after a commit: {total} orders, {statements} statements")
+
+    # top 5 orders by value
+    for name, top in (
+            ("python", lambda session: sorted(
+                session.scalars(select(Order)),
+                key=lambda order: order.total, reverse=True)[:5]),
+            ("order_by(Order.total)", lambda session: session.scalars(
+                select(Order).order_by(Order.total.desc()).limit(5)).all()),
+            ("top_orders_by_value", top_orders_by_value),
+    ):
+        with Session(engine) as session:
+            if name == "python":
+                disable_aggregates()  # the Python fallback of the hybrid
+            statements = 0
+            start = time.perf_counter()
+            orders = top(session)
+            totals = [order.total for order in orders[:5]]
+            seconds = time.perf_counter() - start
+            print(f"{name}: {totals}, {statements} statements, "
+                  f"{seconds * 1000:.0f} ms")
+            if name == "python":
+                enable_aggregates()
+
+    with Session(engine) as session:
+        statements = 0
+        customers = session.scalars(
+            select(Customer).where(Customer.lifetime_value > 500)).all()
+        print(f"{len(customers)} customers over 500, lifetime values "
+              f"{[customer.lifetime_value for customer in customers[:3]]}, "
+              f"item counts "
+              f"{[order.item_count for order in customers[0].orders[:3]]}, "
+              f"{statements} statements")
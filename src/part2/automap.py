@@ -6,7 +6,7 @@ import re
 
 import inflect  # pip install inflect
 from models import SessionMaker, engine
-from sqlalchemy import Column, Integer, Table, select
+from sqlalchemy import select
 from sqlalchemy.ext.automap import AutomapBase, automap_base
 from sqlalchemy.orm import Session
 
@@ -83,30 +83,46 @@ def automap_custom(session: Session):
 
 def automap_view(session: Session):
     """
-    First, create a view with SQL:
-
-    CREATE VIEW manager AS
-    SELECT
-        employee_id AS id,
-        "name",
-        hire_date
-    FROM
-        employee e
-    WHERE
-        e.is_manager = TRUE;
-
+    First, create the `manager` table: a materialized version of the
+    managers, kept up to date by triggers on `employee`, like the `manager`
+    table of part3 (see its models.py and migrations for PostgreSQL).
+    Reads are primary key lookups, instead of the query of a plain view
+    recomputed on every read. With SQLite:
+
+    CREATE TABLE manager (
+        id INTEGER PRIMARY KEY,
+        "name" VARCHAR(127) NOT NULL,
+        hire_date DATE NOT NULL
+    );
+    INSERT INTO manager (id, "name", hire_date)
+    SELECT employee_id, "name", hire_date FROM employee WHERE is_manager;
+
+    CREATE TRIGGER manager_insert AFTER INSERT ON employee
+    WHEN NEW.is_manager
+    BEGIN
+        INSERT INTO manager (id, "name", hire_date)
+        VALUES (NEW.employee_id, NEW."name", NEW.hire_date);
+    END;
+    CREATE TRIGGER manager_update AFTER UPDATE ON employee
+    WHEN OLD.is_manager OR NEW.is_manager
+    BEGIN
+        DELETE FROM manager WHERE id = OLD.employee_id;
+        INSERT INTO manager (id, "name", hire_date)
+        SELECT NEW.employee_id, NEW."name", NEW.hire_date
+        WHERE NEW.is_manager;
+    END;
+    CREATE TRIGGER manager_delete AFTER DELETE ON employee
+    WHEN OLD.is_manager
+    BEGIN
+        DELETE FROM manager WHERE id = OLD.employee_id;
+    END;
     """
-    print("# Reflecting a view with automap:")
+    print("# Reflecting the manager table with automap:")
     Base: AutomapBase = automap_base()
 
-    # add table (view) to metadata:
-    Table(
-        "manager",
-        Base.metadata,
-        # PK is required for reflection to work
-        Column('id', Integer, primary_key=True),
-        autoload_with=engine,
-    )
+    # reflect only the manager table: it has a primary key, so automap maps
+    # it as is (a plain view has none, one would have to be declared)
+    Base.metadata.reflect(engine, only=["manager"])
     Base.prepare(
         # autoload_with=engine,  # to load all tables
         classname_for_table=camelize_classname,
@@ -119,6 +135,9 @@ def automap_view(session: Session):
     with Session(engine) as session:
         for manager in session.scalars(select(Manager)):
             print(manager.id, manager.name, manager.hire_date)
+        managers = session.scalars(select(Manager.id).limit(1)).all()
+        if managers:
+            print("By primary key:", session.get(Manager, managers[0]).name)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,486 @@
+"""
+Workload benchmark: the Core style of part1 against the ORM style of part2.
+
+The same workloads run through the `tables` of part1 with a `Connection`,
+and through the `models` of this part with a `Session`, on SQLite in memory
+and in a file, for each size (number of orders):
+
+- insert: orders with one order line each, in batches of `BATCH_SIZE`
+  (Core: `insert()` with a list of parameters, ORM: `session.add_all()`),
+- filtered_select: the orders of the first tenth of the customers,
+- join_details: orders with their order lines and products,
+- aggregate: the number of orders per customer,
+- bulk_update: every other order marked as shipped by primary key
+  (Core: `update()` with `bindparam()`, ORM: `update()` with a list of
+  parameters, which is an ORM bulk UPDATE by primary key),
+- delete: the shipped orders and their order lines.
+
+For each run it reports rows per second, statements executed (a DBAPI
+`executemany()` counts as one) and the peak memory allocated by Python
+during the workload (with `tracemalloc`, in a second run on a fresh
+database, since tracing slows everything down).
+
+Results are stored as JSON; `--compare` checks them against a previous
+result file and fails when a workload got slower than `--threshold`.
+
+pytest collects the checks too: both styles must process the same number of
+rows in every workload, at `BENCH_SIZES` (the smallest size by default),
+and no workload may be slower than in `BENCH_BASELINE`, a result file, by
+more than `BENCH_THRESHOLD`, if given.
+
+Usage:
+    python bench_core_vs_orm.py [--sizes 1000,100000,1000000]
+        [--backends memory,file] [--output results.json]
+        [--compare baseline.json] [--threshold 0.2] [--no-memory]
+    BENCH_SIZES=1000,100000 BENCH_BASELINE=baseline.json \
+        python -m pytest bench_core_vs_orm.py
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import contextmanager
+from typing import Callable, Iterator
+
+import pytest
+import sqlalchemy
+from sqlalchemy import (Engine, bindparam, create_engine, delete, event,
+                        func, insert, select, update)
+from sqlalchemy.orm import Session, joinedload, selectinload
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "part1"))
+
+import models  # noqa: E402
+import tables  # noqa: E402
+
+SIZES = [1_000, 100_000, 1_000_000]
+THRESHOLD = 0.2
+BACKENDS = ["memory", "file"]
+STYLES = ["core", "orm"]
+WORKLOADS = [
+    "insert",
+    "filtered_select",
+    "join_details",
+    "aggregate",
+    "bulk_update",
+    "delete",
+]
+BATCH_SIZE = 10_000
+PRODUCTS = 100
+
+
+def batches(count: int, size: int = BATCH_SIZE) -> Iterator[range]:
+    for start in range(1, count + 1, size):
+        yield range(start, min(start + size, count + 1))
+
+
+def counts(size: int) -> dict[str, int]:
+    return {
+        "orders": size,
+        "customers": max(size // 10, 1),
+        "employees": max(size // 100, 1),
+        "products": min(size, PRODUCTS),
+    }
+
+
+def fill_reference_data(engine: Engine, metadata, product_type, size: int):
+    """Customers, employees and products, inserted before any measurement."""
+    n = counts(size)
+    with engine.begin() as conn:
+        conn.execute(insert(metadata.tables["customer"]), [
+            {"first_name": f"First {i}", "last_name": f"Last {i}",
+             "address": f"{i} Main Street", "email": f"c{i}@example.com"}
+            for i in range(1, n["customers"] + 1)
+        ])
+        conn.execute(insert(metadata.tables["employee"]), [
+            {"name": f"Employee {i}", "is_manager": i == 1,
+             "manager_id": None if i == 1 else 1}
+            for i in range(1, n["employees"] + 1)
+        ])
+        conn.execute(insert(metadata.tables["product"]), [
+            {"product_name": f"Product {i}", "unit_price": 1 + i,
+             "units_in_stock": 100, "type": product_type.OTHER}
+            for i in range(1, n["products"] + 1)
+        ])
+
+
+def order_values(order_id: int, size: int) -> tuple[int, int, int]:
+    """(customer_id, employee_id, product_id) of an order."""
+    n = counts(size)
+    return (
+        order_id % n["customers"] + 1,
+        order_id % n["employees"] + 1,
+        order_id % n["products"] + 1,
+    )
+
+
+# Core workloads, with the tables of part1; each returns the number of rows
+
+def core_insert(engine: Engine, size: int) -> int:
+    with engine.connect() as conn:
+        for ids in batches(size):
+            orders, details = [], []
+            for order_id in ids:
+                customer_id, employee_id, product_id = order_values(
+                    order_id, size)
+                orders.append({"order_id": order_id,
+                               "customer_id": customer_id,
+                               "employee_id": employee_id})
+                details.append({"order_id": order_id,
+                                "product_id": product_id,
+                                "quantity": 1})
+            conn.execute(insert(tables.order), orders)
+            conn.execute(insert(tables.order_detail), details)
+            conn.commit()
+    return size * 2
+
+
+def core_filtered_select(engine: Engine, size: int) -> int:
+    stmt = (
+        select(tables.order)
+        .where(tables.order.c.customer_id <= counts(size)["customers"] // 10)
+        .where(tables.order.c.is_shipped == False)  # noqa: E712
+    )
+    with engine.connect() as conn:
+        return len(conn.execute(stmt).all())
+
+
+def core_join_details(engine: Engine, size: int) -> int:
+    stmt = (
+        select(
+            tables.order.c.order_id,
+            tables.order.c.order_datetime,
+            tables.product.c.product_name,
+            tables.order_detail.c.quantity,
+        )
+        .join_from(tables.order, tables.order_detail)
+        .join_from(tables.order_detail, tables.product)
+        .where(tables.order.c.order_id <= max(size // 10, 1))
+    )
+    with engine.connect() as conn:
+        return len(conn.execute(stmt).all())
+
+
+def core_aggregate(engine: Engine, size: int) -> int:
+    stmt = (
+        select(
+            tables.order.c.customer_id,
+            func.count(tables.order.c.order_id).label("count"),
+        )
+        .group_by(tables.order.c.customer_id)
+        .having(func.count(tables.order.c.order_id) > 1)
+    )
+    with engine.connect() as conn:
+        conn.execute(stmt).all()
+    return size  # orders aggregated
+
+
+def core_bulk_update(engine: Engine, size: int) -> int:
+    stmt = (
+        update(tables.order)
+        .where(tables.order.c.order_id == bindparam("id"))
+        .values(is_shipped=True)
+    )
+    rows = 0
+    with engine.connect() as conn:
+        for ids in batches(size):
+            parameters = [{"id": order_id} for order_id in ids[::2]]
+            conn.execute(stmt, parameters)
+            rows += len(parameters)
+        conn.commit()
+    return rows
+
+
+def core_delete(engine: Engine, size: int) -> int:
+    shipped = (
+        select(tables.order.c.order_id)
+        .where(tables.order.c.is_shipped == True)  # noqa: E712
+    )
+    with engine.connect() as conn:
+        conn.execute(
+            delete(tables.order_detail)
+            .where(tables.order_detail.c.order_id.in_(shipped))
+        )
+        result = conn.execute(
+            delete(tables.order)
+            .where(tables.order.c.is_shipped == True)  # noqa: E712
+        )
+        conn.commit()
+    return result.rowcount
+
+
+# ORM workloads, with the models of part2
+
+def orm_insert(engine: Engine, size: int) -> int:
+    with Session(engine) as session:
+        for ids in batches(size):
+            orders = []
+            for order_id in ids:
+                customer_id, employee_id, product_id = order_values(
+                    order_id, size)
+                order = models.Order(
+                    customer_id=customer_id, employee_id=employee_id)
+                order.order_details.append(
+                    models.OrderDetail(product_id=product_id, quantity=1))
+                orders.append(order)
+            session.add_all(orders)
+            session.commit()
+    return size * 2
+
+
+def orm_filtered_select(engine: Engine, size: int) -> int:
+    stmt = (
+        select(models.Order)
+        .where(models.Order.customer_id <= counts(size)["customers"] // 10)
+        .where(models.Order.is_shipped == False)  # noqa: E712
+    )
+    with Session(engine) as session:
+        return len(session.scalars(stmt).all())
+
+
+def orm_join_details(engine: Engine, size: int) -> int:
+    stmt = (
+        select(models.Order)
+        .where(models.Order.order_id <= max(size // 10, 1))
+        .options(
+            selectinload(models.Order.order_details)
+            .joinedload(models.OrderDetail.product)
+        )
+    )
+    with Session(engine) as session:
+        return len([
+            (order.order_id, detail.product.product_name, detail.quantity)
+            for order in session.scalars(stmt)
+            for detail in order.order_details
+        ])
+
+
+def orm_aggregate(engine: Engine, size: int) -> int:
+    stmt = (
+        select(
+            models.Order.customer_id,
+            func.count(models.Order.order_id).label("count"),
+        )
+        .group_by(models.Order.customer_id)
+        .having(func.count(models.Order.order_id) > 1)
+    )
+    with Session(engine) as session:
+        session.execute(stmt).all()
+    return size
+
+
+def orm_bulk_update(engine: Engine, size: int) -> int:
+    rows = 0
+    with Session(engine) as session:
+        for ids in batches(size):
+            parameters = [
+                {"order_id": order_id, "is_shipped": True}
+                for order_id in ids[::2]
+            ]
+            session.execute(update(models.Order), parameters)
+            rows += len(parameters)
+        session.commit()
+    return rows
+
+
+def orm_delete(engine: Engine, size: int) -> int:
+    shipped = (
+        select(models.Order.order_id)
+        .where(models.Order.is_shipped == True)  # noqa: E712
+    )
+    with Session(engine) as session:
+        session.execute(
+            delete(models.OrderDetail)
+            .where(models.OrderDetail.order_id.in_(shipped))
+        )
+        result = session.execute(
+            delete(models.Order)
+            .where(models.Order.is_shipped == True)  # noqa: E712
+        )
+        session.commit()
+    return result.rowcount
+
+
+STYLE_WORKLOADS: dict[str, dict[str, Callable[[Engine, int], int]]] = {
+    style: {name: globals()[f"{style}_{name}"] for name in WORKLOADS}
+    for style in STYLES
+}
+STYLE_SCHEMAS = {
+    "core": (tables.metadata, tables.ProductType),
+    "orm": (models.Base.metadata, models.ProductType),
+}
+
+
+@contextmanager
+def database(backend: str) -> Iterator[Engine]:
+    with tempfile.TemporaryDirectory() as tmp:
+        if backend == "memory":
+            url = "sqlite+pysqlite:///:memory:"
+        else:
+            url = f"sqlite+pysqlite:///{os.path.join(tmp, 'bench.db')}"
+        engine = create_engine(url)
+        try:
+            yield engine
+        finally:
+            engine.dispose()
+
+
+def run_style(
+        backend: str,
+        size: int,
+        style: str,
+        trace_memory: bool,
+) -> dict[str, dict]:
+    """Run all workloads in order on a fresh database."""
+    metadata, product_type = STYLE_SCHEMAS[style]
+    results = {}
+    with database(backend) as engine:
+        metadata.create_all(engine)
+        fill_reference_data(engine, metadata, product_type, size)
+
+        statements = 0
+
+        @event.listens_for(engine, "before_cursor_execute")
+        def count_statements(*args):
+            nonlocal statements
+            statements += 1
+
+        for name, workload in STYLE_WORKLOADS[style].items():
+            gc.collect()
+            statements = 0
+            if trace_memory:
+                tracemalloc.start()
+            start = time.perf_counter()
+            rows = workload(engine, size)
+            elapsed = time.perf_counter() - start
+            result = {
+                "rows": rows,
+                "seconds": elapsed,
+                "rows_per_second": rows / elapsed if elapsed else 0.0,
+                "statements": statements,
+            }
+            if trace_memory:
+                result["peak_memory_mb"] = (
+                    tracemalloc.get_traced_memory()[1] / 2**20)
+                tracemalloc.stop()
+            results[name] = result
+    return results
+
+
+def run(sizes: list[int], backends: list[str], memory: bool = True) -> dict:
+    results = []
+    for backend in backends:
+        for size in sizes:
+            for style in STYLES:
+                timings = run_style(backend, size, style, trace_memory=False)
+                if memory:
+                    peaks = run_style(backend, size, style, trace_memory=True)
+                    for name in timings:
+                        timings[name]["peak_memory_mb"] = (
+                            peaks[name]["peak_memory_mb"])
+                for name, result in timings.items():
+                    result = {"backend": backend, "size": size,
+                              "style": style, "workload": name, **result}
+                    results.append(result)
+                    print_result(result)
+    return {
+        "python": platform.python_version(),
+        "sqlalchemy": sqlalchemy.__version__,
+        "sqlite": sqlite3.sqlite_version,
+        "results": results,
+    }
+
+
+def print_result(result: dict):
+    memory = result.get("peak_memory_mb")
+    print(
+        f"{result['backend']:<6} {result['size']:>9} {result['style']:<4} "
+        f"{result['workload']:<16} {result['rows_per_second']:>12,.0f} rows/s"
+        f" {result['statements']:>7} statements"
+        + ("" if memory is None else f" {memory:>9.1f} MB")
+    )
+
+
+def result_key(result: dict) -> tuple:
+    return (result["backend"], result["size"], result["style"],
+            result["workload"])
+
+
+def compare(current: dict, baseline: dict, threshold: float) -> list[str]:
+    """Workloads whose rows per second dropped by more than `threshold`."""
+    previous = {result_key(r): r for r in baseline["results"]}
+    regressions = []
+    for result in current["results"]:
+        before = previous.get(result_key(result))
+        if before is None or not before["rows_per_second"]:
+            continue
+        change = result["rows_per_second"] / before["rows_per_second"] - 1
+        if change < -threshold:
+            regressions.append(
+                f"{' '.join(map(str, result_key(result)))}: "
+                f"{before['rows_per_second']:,.0f} -> "
+                f"{result['rows_per_second']:,.0f} rows/s ({change:+.0%})"
+            )
+    return regressions
+
+
+def env_sizes() -> list[int]:
+    sizes = os.environ.get("BENCH_SIZES", str(SIZES[0]))
+    return [int(size) for size in sizes.split(",")]
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+@pytest.mark.parametrize("size", env_sizes())
+def test_styles_process_the_same_rows(size: int, backend: str):
+    core = run_style(backend, size, "core", trace_memory=False)
+    orm = run_style(backend, size, "orm", trace_memory=False)
+    assert core["insert"]["rows"] == size * 2
+    assert core["bulk_update"]["rows"] == core["delete"]["rows"]
+    for name in WORKLOADS:
+        assert core[name]["rows"] == orm[name]["rows"], name
+
+
+def test_no_regression():
+    baseline = os.environ.get("BENCH_BASELINE")
+    if baseline is None:
+        pytest.skip("BENCH_BASELINE is not set")
+    with open(baseline) as file:
+        previous = json.load(file)
+    current = run(env_sizes(), BACKENDS, memory=False)
+    threshold = float(os.environ.get("BENCH_THRESHOLD", THRESHOLD))
+    assert compare(current, previous, threshold) == []
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--sizes", default=",".join(map(str, SIZES)),
+        help="comma separated numbers of orders")
+    parser.add_argument("--backends", default=",".join(BACKENDS))
+    parser.add_argument("--output", default="bench_core_vs_orm.json")
+    parser.add_argument("--compare", help="previous result file")
+    parser.add_argument("--threshold", type=float, default=THRESHOLD)
+    parser.add_argument("--no-memory", action="store_true")
+    args = parser.parse_args()
+
+    current = run(
+        [int(size) for size in args.sizes.split(",")],
+        args.backends.split(","),
+        memory=not args.no_memory,
+    )
+    with open(args.output, "w") as file:
+        json.dump(current, file, indent=2)
+    print("Results written to", args.output)
+
+    if args.compare:
+        with open(args.compare) as file:
+            regressions = compare(current, json.load(file), args.threshold)
+        for regression in regressions:
+            print("REGRESSION", regression)
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,288 @@
+"""
+Counter caches: child counts stored on the parent row.
+
+Counting the reports of every manager or the orders of every customer is a
+GROUP BY over the whole child table (see `customer_orders_count()` in
+read.py). A counter cache keeps the count in a column of the parent,
+`Employee.subordinate_count` and `Customer.order_count_cached`, so reading
+it is reading a column.
+
+`enable_counter_caches()` keeps the declared `COUNTERS` up to date in the
+flush that changes the children, in the same transaction:
+
+- `before_flush` reads the current foreign key of the children that are
+  deleted or reparented, from the database, since the old value is often
+  not loaded anymore (expired by a commit),
+- `after_flush` adds up the changes per parent (inserted: +1, deleted: -1,
+  reparented: -1 for the old parent, +1 for the new one) and applies them
+  with one executemany of `UPDATE ... SET n = n + :delta`: relative and
+  atomic, concurrent transactions do not overwrite each other's counts,
+- `after_flush_postexec` expires the counter of the parents loaded in the
+  session, to be read again from the database.
+
+Bulk statements (`insert()`, `update()`, `delete()` on the children),
+database cascades and other applications bypass the flush: `repair()`
+recomputes the counters in batches of parents, committing each batch, and
+reports how many were wrong.
+"""
+from collections import Counter, defaultdict
+
+from models import Customer, Employee, Order
+from sqlalchemy import and_, bindparam, event, func, inspect, select, update
+from sqlalchemy.orm import (MANYTOONE, InstrumentedAttribute, Session,
+                            aliased)
+
+IN_BATCH_SIZE = 500  # parameters per IN (...)
+
+
+class CounterCache:
+    """The number of `foreign_key.class_` rows per parent in `counter`."""
+
+    def __init__(
+            self,
+            counter: InstrumentedAttribute,
+            foreign_key: InstrumentedAttribute,
+    ) -> None:
+        self.counter = counter
+        self.foreign_key = foreign_key
+        self.parent = counter.class_
+        self.child = foreign_key.class_
+        parent_mapper = inspect(self.parent)
+        child_mapper = inspect(self.child)
+        self.parent_key = getattr(
+            self.parent, parent_mapper.get_property_by_column(
+                parent_mapper.primary_key[0]).key)
+        self.child_key = getattr(
+            self.child, child_mapper.get_property_by_column(
+                child_mapper.primary_key[0]).key)
+        # many-to-one relationships that set the foreign key on flush
+        fk_column = foreign_key.property.columns[0]
+        self.relationships = [
+            relationship.key for relationship in child_mapper.relationships
+            if relationship.direction is MANYTOONE
+            and fk_column in relationship.local_columns
+        ]
+
+    def __repr__(self) -> str:
+        return f"CounterCache({self.counter}, {self.foreign_key})"
+
+    def reparented(self, obj) -> bool:
+        attrs = inspect(obj).attrs
+        return any(
+            attrs[key].history.has_changes()
+            for key in (self.foreign_key.key, *self.relationships)
+        )
+
+    def current_parents(self, session: Session, ids: list) -> dict:
+        """Child primary key -> foreign key, as in the database."""
+        parents = {}
+        for start in range(0, len(ids), IN_BATCH_SIZE):
+            rows = session.connection().execute(
+                select(self.child_key, self.foreign_key)
+                .where(self.child_key.in_(ids[start:start + IN_BATCH_SIZE]))
+            )
+            parents.update(rows.all())
+        return parents
+
+    def apply(self, session: Session, deltas: Counter):
+        """Add `deltas` (parent primary key -> change) to the counters."""
+        column = self.counter.property.columns[0]
+        table = column.table
+        stmt = (
+            update(table)
+            .where(self.parent_key.property.columns[0]
+                   == bindparam("parent_key"))
+            .values({column: column + bindparam("delta")})
+        )
+        # in primary key order, so concurrent flushes lock rows in the
+        # same order
+        session.connection().execute(stmt, [
+            {"parent_key": key, "delta": delta}
+            for key, delta in sorted(deltas.items())
+        ])
+
+    def actual_count(self):
+        """Correlated subquery counting the children of the parent row."""
+        child = aliased(self.child)
+        return (
+            select(func.count())
+            .select_from(child)
+            .where(getattr(child, self.foreign_key.key) == self.parent_key)
+            .scalar_subquery()
+        )
+
+
+COUNTERS = [
+    CounterCache(Employee.subordinate_count, Employee.manager_id),
+    CounterCache(Customer.order_count_cached, Order.customer_id),
+]
+
+
+def before_flush(session: Session, flush_context, instances):
+    previous = {}
+    for cache in COUNTERS:
+        ids = [
+            inspect(obj).identity[0]
+            for obj in session.dirty
+            if isinstance(obj, cache.child) and cache.reparented(obj)
+        ] + [
+            inspect(obj).identity[0]
+            for obj in session.deleted if isinstance(obj, cache.child)
+        ]
+        if ids:
+            previous[cache] = cache.current_parents(session, ids)
+    session.info["counter_cache_previous"] = previous
+
+
+def after_flush(session: Session, flush_context):
+    previous = session.info.pop("counter_cache_previous", {})
+    changed = defaultdict(set)
+    for cache in COUNTERS:
+        before = previous.get(cache, {})
+        deltas: Counter = Counter()
+        for obj in session.new:
+            if isinstance(obj, cache.child):
+                deltas[getattr(obj, cache.foreign_key.key)] += 1
+        for obj in session.dirty:
+            key = inspect(obj).identity
+            if isinstance(obj, cache.child) and key[0] in before:
+                deltas[before[key[0]]] -= 1
+                deltas[getattr(obj, cache.foreign_key.key)] += 1
+        for obj in session.deleted:
+            key = inspect(obj).identity
+            if isinstance(obj, cache.child) and key[0] in before:
+                deltas[before[key[0]]] -= 1
+
+        deltas.pop(None, None)  # children without a parent
+        deltas = Counter({key: n for key, n in deltas.items() if n})
+        if deltas:
+            cache.apply(session, deltas)
+            changed[cache].update(deltas)
+    session.info["counter_cache_changed"] = changed
+
+
+def after_flush_postexec(session: Session, flush_context):
+    changed = session.info.pop("counter_cache_changed", {})
+    for cache, keys in changed.items():
+        mapper = inspect(cache.parent)
+        for key in keys:
+            parent = session.identity_map.get(
+                mapper.identity_key_from_primary_key([key]))
+            if parent is not None:
+                session.expire(parent, [cache.counter.key])
+
+
+def enable_counter_caches(target=Session):
+    """Maintain `COUNTERS` on flush, for all sessions by default."""
+    event.listen(target, "before_flush", before_flush)
+    event.listen(target, "after_flush", after_flush)
+    event.listen(target, "after_flush_postexec", after_flush_postexec)
+
+
+def disable_counter_caches(target=Session):
+    event.remove(target, "before_flush", before_flush)
+    event.remove(target, "after_flush", after_flush)
+    event.remove(target, "after_flush_postexec", after_flush_postexec)
+
+
+def repair(
+        session: Session,
+        cache: CounterCache,
+        batch_size: int = 1000,
+        dry_run: bool = False,
+) -> int:
+    """
+    Recompute `cache` for every parent, `batch_size` parents per statement
+    and commit. Return the number of wrong counters (fixed unless
+    `dry_run`).
+    """
+    wrong = 0
+    last_key = None
+    while True:
+        stmt = select(cache.parent_key).order_by(cache.parent_key)
+        if last_key is not None:
+            stmt = stmt.where(cache.parent_key > last_key)
+        keys = session.scalars(stmt.limit(batch_size)).all()
+        if not keys:
+            break
+        mismatch = and_(
+            cache.parent_key.between(keys[0], keys[-1]),
+            cache.counter != cache.actual_count(),
+        )
+        if dry_run:
+            wrong += session.scalar(
+                select(func.count()).select_from(cache.parent)
+                .where(mismatch))
+        else:
+            result = session.execute(
+                update(cache.parent)
+                .where(mismatch)
+                .values({cache.counter: cache.actual_count()})
+                .execution_options(synchronize_session=False)
+            )
+            wrong += result.rowcount
+            session.commit()
+        last_key = keys[-1]
+    return wrong
+
+
+def managers_with_employee_count(session: Session):
+    """Like part1's `list_all_managers_with_employee_count()`, no GROUP BY."""
+    return session.execute(
+        select(Employee.name, Employee.subordinate_count)
+        .where(Employee.subordinate_count > 0)
+        .order_by(Employee.employee_id)
+    ).all()
+
+
+def customer_orders_count(session: Session, min_count: int = 0):
+    """Like `customer_orders_count()` of read.py, no GROUP BY."""
+    return session.execute(
+        select(
+            Customer.first_name,
+            Customer.last_name,
+            Customer.order_count_cached,
+        )
+        .where(Customer.order_count_cached > min_count)
+        .order_by(Customer.order_count_cached.desc())
+    ).all()
+
+
+if __name__ == "__main__":
+    import logging
+
+    from models import Base
+    from sqlalchemy import create_engine, delete
+
+    logging.disable(logging.INFO)  # `echo=True` on the engine of models.py
+    engine = create_engine("sqlite+pysqlite:///:memory:")
+    Base.metadata.create_all(engine)
+    enable_counter_caches()
+
+    with Session(engine) as session:
+        alice = Employee(name="Alice", is_manager=True)
+        louis = Employee(name="Louis", is_manager=True)
+        alice.employees.extend([Employee(name="Bob"), Employee(name="Cathy")])
+        lilly = Employee(name="Lilly")
+        lilly.manager = louis
+        mary = Customer("Mary", "Smith", "1 Main St", "mary@example.com")
+        mary.orders.extend([Order(), Order(), Order()])
+        session.add_all([alice, louis, mary])
+        session.commit()
+        print(managers_with_employee_count(session))
+
+        # reparent, delete, and a change the flush does not see
+        bob = session.scalars(select(Employee).filter_by(name="Bob")).one()
+        bob.manager = louis
+        session.delete(lilly)
+        session.delete(mary.orders[0])
+        session.commit()
+        print(managers_with_employee_count(session))
+        print(customer_orders_count(session))
+
+        session.execute(delete(Order))  # a bulk DELETE
+        session.commit()
+        print("wrong order counters:",
+              repair(session, COUNTERS[1], dry_run=True))
+        print("repaired:", repair(session, COUNTERS[1]))
+        print("wrong subordinate counters:", repair(session, COUNTERS[0]))
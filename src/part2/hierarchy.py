@@ -0,0 +1,349 @@
+"""
+Loading the `Employee` hierarchy with one query.
+
+Walking `Employee.employees` or `Employee.manager` lazily emits a SELECT per
+employee and level. `descendants()` and `ancestors()` load a whole subtree,
+or the chain of managers, with a recursive CTE and fill the relationships of
+the returned employees with `set_committed_value()`: walking them afterwards
+emits no SQL. Only collections that are complete are filled: the
+`employees` of the employees at `max_depth` are left to load lazily, like
+those of the managers returned by `ancestors()`.
+
+Closure table: `employee_closure` holds a row for every (ancestor,
+descendant) pair with its distance, so a subtree is an indexed lookup
+instead of a recursion of one join per level. `enable_closure_table()`
+keeps it up to date with an `after_flush` listener on every session:
+new employees get the paths of their manager, an employee moved to another
+manager moves with its subtree, deleted employees lose their rows. The
+listener emits a few statements per changed employee, and bulk statements
+(`insert()`/`update()` on `Employee`) bypass it: run `rebuild_closure()`
+after those. Pass `closure=True` to `descendants()`/`ancestors()` to use it.
+
+`MAX_DEPTH` bounds the recursion, so a cycle in `manager_id` cannot make a
+query run forever.
+"""
+from collections import defaultdict
+
+from models import Base, Employee
+from sqlalchemy import (Column, ForeignKey, Index, Integer, Table, delete,
+                        event, insert, inspect, literal, or_, select)
+from sqlalchemy.orm import Session, aliased
+from sqlalchemy.orm.attributes import set_committed_value
+
+MAX_DEPTH = 64
+
+employee_closure = Table(
+    "employee_closure",
+    Base.metadata,
+    Column(
+        "ancestor_id",
+        ForeignKey("employee.employee_id", ondelete="CASCADE"),
+        primary_key=True,
+    ),
+    Column(
+        "descendant_id",
+        ForeignKey("employee.employee_id", ondelete="CASCADE"),
+        primary_key=True,
+    ),
+    Column("depth", Integer, nullable=False),
+    # ancestors() looks up by descendant
+    Index("employee_closure_descendant", "descendant_id", "depth"),
+)
+
+
+def subtree(employee_id: int, max_depth: int, closure: bool):
+    """(employee_id, depth) of `employee_id` and its reports."""
+    if closure:
+        return (
+            select(
+                employee_closure.c.descendant_id.label("employee_id"),
+                employee_closure.c.depth,
+            )
+            .where(employee_closure.c.ancestor_id == employee_id)
+            .where(employee_closure.c.depth <= max_depth)
+            .subquery("tree")
+        )
+
+    tree = (
+        select(Employee.employee_id, literal(0).label("depth"))
+        .where(Employee.employee_id == employee_id)
+        .cte("tree", recursive=True)
+    )
+    return tree.union_all(
+        select(Employee.employee_id, tree.c.depth + 1)
+        .join(tree, Employee.manager_id == tree.c.employee_id)
+        .where(tree.c.depth < max_depth)
+    )
+
+
+def descendants(
+        session: Session,
+        employee_id: int,
+        max_depth: int | None = None,
+        closure: bool = False,
+) -> list[Employee]:
+    """
+    `employee_id` and its reports down to `max_depth` levels, by level, with
+    their `manager` and `employees` loaded. Empty if there is no such
+    employee.
+    """
+    depth_limit = MAX_DEPTH if max_depth is None else min(max_depth,
+                                                          MAX_DEPTH)
+    tree = subtree(employee_id, depth_limit, closure)
+    stmt = (
+        select(Employee, tree.c.depth)
+        .join(tree, Employee.employee_id == tree.c.employee_id)
+        .order_by(tree.c.depth, Employee.employee_id)
+    )
+    rows = session.execute(stmt).all()
+
+    employees = {employee.employee_id: employee for employee, _ in rows}
+    reports: dict[int, list[Employee]] = defaultdict(list)
+    for employee, depth in rows:
+        if depth > 0:
+            manager = employees[employee.manager_id]
+            set_committed_value(employee, "manager", manager)
+            reports[manager.employee_id].append(employee)
+    for employee, depth in rows:
+        if depth < depth_limit:  # all reports of this one were loaded
+            set_committed_value(
+                employee, "employees", reports[employee.employee_id])
+    return [employee for employee, _ in rows]
+
+
+def ancestors(
+        session: Session,
+        employee_id: int,
+        closure: bool = False,
+) -> list[Employee]:
+    """
+    `employee_id` and its managers up to the top, each with its `manager`
+    loaded. Empty if there is no such employee.
+    """
+    if closure:
+        chain = (
+            select(
+                employee_closure.c.ancestor_id.label("employee_id"),
+                employee_closure.c.depth,
+            )
+            .where(employee_closure.c.descendant_id == employee_id)
+            .subquery("chain")
+        )
+    else:
+        chain = (
+            select(
+                Employee.employee_id,
+                Employee.manager_id,
+                literal(0).label("depth"),
+            )
+            .where(Employee.employee_id == employee_id)
+            .cte("chain", recursive=True)
+        )
+        manager = aliased(Employee)
+        chain = chain.union_all(
+            select(manager.employee_id, manager.manager_id, chain.c.depth + 1)
+            .join(chain, manager.employee_id == chain.c.manager_id)
+            .where(chain.c.depth < MAX_DEPTH)
+        )
+    stmt = (
+        select(Employee)
+        .join(chain, Employee.employee_id == chain.c.employee_id)
+        .order_by(chain.c.depth)
+    )
+    chain_of_command = list(session.scalars(stmt))
+
+    for employee, manager in zip(
+            chain_of_command, chain_of_command[1:] + [None]):
+        if manager is not None or employee.manager_id is None:
+            set_committed_value(employee, "manager", manager)
+    return chain_of_command
+
+
+# closure table maintenance
+def managers_first(employees: list[Employee]) -> list[Employee]:
+    """Order `employees` so that managers come before their reports."""
+    pending = set(map(id, employees))
+    ordered, done = [], set()
+
+    def visit(employee: Employee):
+        if id(employee) in done:
+            return
+        done.add(id(employee))
+        manager = employee.manager
+        if manager is not None and id(manager) in pending:
+            visit(manager)
+        ordered.append(employee)
+
+    for employee in employees:
+        visit(employee)
+    return ordered
+
+
+def add_paths(session: Session, employee: Employee):
+    conn = session.connection()
+    conn.execute(insert(employee_closure).values(
+        ancestor_id=employee.employee_id,
+        descendant_id=employee.employee_id,
+        depth=0,
+    ))
+    if employee.manager_id is not None:
+        # the paths to the manager, one step longer
+        conn.execute(insert(employee_closure).from_select(
+            ["ancestor_id", "descendant_id", "depth"],
+            select(
+                employee_closure.c.ancestor_id,
+                literal(employee.employee_id),
+                employee_closure.c.depth + 1,
+            ).where(employee_closure.c.descendant_id == employee.manager_id),
+        ))
+
+
+def move_paths(session: Session, employee: Employee):
+    conn = session.connection()
+    members = (
+        select(employee_closure.c.descendant_id)
+        .where(employee_closure.c.ancestor_id == employee.employee_id)
+    )
+    # detach the subtree from its former managers
+    conn.execute(
+        delete(employee_closure)
+        .where(employee_closure.c.descendant_id.in_(members))
+        .where(employee_closure.c.ancestor_id.not_in(members))
+    )
+    if employee.manager_id is not None:
+        # every path to the new manager times every path in the subtree
+        above = employee_closure.alias("above")
+        below = employee_closure.alias("below")
+        conn.execute(insert(employee_closure).from_select(
+            ["ancestor_id", "descendant_id", "depth"],
+            select(
+                above.c.ancestor_id,
+                below.c.descendant_id,
+                above.c.depth + below.c.depth + 1,
+            )
+            .select_from(above.join(
+                below, below.c.ancestor_id == employee.employee_id))
+            .where(above.c.descendant_id == employee.manager_id),
+        ))
+
+
+def manager_changed(employee: Employee) -> bool:
+    attrs = inspect(employee).attrs
+    return (attrs.manager_id.history.has_changes()
+            or attrs.manager.history.has_changes())
+
+
+def maintain_closure(session: Session, flush_context):
+    # `new`, `dirty` and `deleted` still hold what was flushed
+    added = [obj for obj in session.new if isinstance(obj, Employee)]
+    moved = [
+        obj for obj in session.dirty
+        if isinstance(obj, Employee) and manager_changed(obj)
+    ]
+    removed = [
+        obj.employee_id for obj in session.deleted
+        if isinstance(obj, Employee)
+    ]
+    for employee in managers_first(added):
+        add_paths(session, employee)
+    for employee in managers_first(moved):
+        move_paths(session, employee)
+    if removed:
+        session.connection().execute(
+            delete(employee_closure).where(or_(
+                employee_closure.c.ancestor_id.in_(removed),
+                employee_closure.c.descendant_id.in_(removed),
+            ))
+        )
+
+
+def enable_closure_table(target=Session):
+    """Maintain `employee_closure` on flush, for all sessions by default."""
+    event.listen(target, "after_flush", maintain_closure)
+
+
+def disable_closure_table(target=Session):
+    event.remove(target, "after_flush", maintain_closure)
+
+
+def rebuild_closure(session: Session):
+    """Create `employee_closure` if needed and fill it from `employee`."""
+    employee_closure.create(session.connection(), checkfirst=True)
+    paths = (
+        select(
+            Employee.employee_id.label("ancestor_id"),
+            Employee.employee_id.label("descendant_id"),
+            literal(0).label("depth"),
+        )
+        .cte("paths", recursive=True)
+    )
+    paths = paths.union_all(
+        select(paths.c.ancestor_id, Employee.employee_id, paths.c.depth + 1)
+        .join(paths, Employee.manager_id == paths.c.descendant_id)
+        .where(paths.c.depth < MAX_DEPTH)
+    )
+    session.execute(delete(employee_closure))
+    session.execute(insert(employee_closure).from_select(
+        ["ancestor_id", "descendant_id", "depth"], select(paths)))
+
+
+if __name__ == "__main__":
+    from sqlalchemy import create_engine, func
+
+    engine = create_engine("sqlite+pysqlite:///:memory:")
+    Base.metadata.create_all(engine)
+    statements = 0
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def count(conn, cursor, statement, parameters, context, executemany):
+        global statements
+        statements += 1
+
+    def walk(employee: Employee) -> int:
+        return 1 + sum(walk(report) for report in employee.employees)
+
+    enable_closure_table()
+    with Session(engine) as session:
+        # a CEO, 4 vice presidents with 4 managers each, 5 staff per manager
+        ceo = Employee(name="CEO", is_manager=True)
+        for v in range(4):
+            vp = Employee(name=f"VP {v}", is_manager=True)
+            ceo.employees.append(vp)
+            for m in range(4):
+                manager = Employee(name=f"Manager {v}.{m}", is_manager=True)
+                vp.employees.append(manager)
+                manager.employees.extend(
+                    Employee(name=f"Staff {v}.{m}.{s}") for s in range(5))
+        session.add(ceo)
+        session.commit()
+
+        ceo_id = ceo.employee_id
+        for name, load in (
+                ("lazy", lambda: [session.get(Employee, ceo_id)]),
+                ("recursive CTE", lambda: descendants(session, ceo_id)),
+                ("closure table",
+                 lambda: descendants(session, ceo_id, closure=True)),
+        ):
+            session.expire_all()
+            statements = 0
+            root = load()[0]
+            print(f"{name}: {walk(root)} employees, {statements} statements")
+
+        # move a manager and its staff under another vice president
+        manager = session.scalars(
+            select(Employee).filter_by(name="Manager 0.0")).one()
+        manager.manager = session.scalars(
+            select(Employee).filter_by(name="VP 3")).one()
+        session.commit()
+        staff_id = manager.employees[0].employee_id
+        statements = 0
+        chain = ancestors(session, staff_id)
+        print(" > ".join(employee.name for employee in chain),
+              f"({statements} statements)")
+
+        maintained = set(session.execute(select(employee_closure)).all())
+        rebuild_closure(session)
+        rebuilt = set(session.execute(select(employee_closure)).all())
+        print("closure table consistent:", maintained == rebuilt,
+              session.scalar(select(func.count()).select_from(
+                  employee_closure)), "paths")
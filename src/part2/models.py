@@ -10,9 +10,10 @@ import enum
 from decimal import Decimal
 from typing import Annotated
 
-from sqlalchemy import (CheckConstraint, ForeignKey, Index, Numeric, String,
-                        create_engine)
+from sqlalchemy import (BigInteger, CheckConstraint, ForeignKey, Index,
+                        Integer, Numeric, String, create_engine, func, select)
 from sqlalchemy.ext.associationproxy import AssociationProxy, association_proxy
+from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.orm import (DeclarativeBase, Mapped, MappedAsDataclass,
                             mapped_column, query_expression, relationship,
                             sessionmaker)
@@ -56,6 +57,16 @@ int_pk = Annotated[
         primary_key=True,
     )
 ]
+# keys of customers and orders: 64-bit for the Snowflake IDs of sharding.py;
+# INTEGER on SQLite, where only `INTEGER PRIMARY KEY` autoincrements
+big_int = BigInteger().with_variant(Integer, "sqlite")
+big_int_pk = Annotated[
+    int,
+    mapped_column(
+        big_int,
+        primary_key=True,
+    )
+]
 date_auto = Annotated[
     datetime.date,
     mapped_column(
@@ -110,6 +121,13 @@ class Employee(Base):
     )
     is_manager: Mapped[bool] = mapped_column(default=False)
     hire_date: Mapped[date_auto] = mapped_column(default=None)
+    # counter cache of `employees`, maintained by counters.py
+    subordinate_count: Mapped[int] = mapped_column(
+        init=False,
+        repr=False,
+        default=0,
+        server_default="0",
+    )
 
     # self-referential relationship: manager/employees
     manager: Mapped[Employee] = relationship(
@@ -134,7 +152,7 @@ class Employee(Base):
 class Customer(Base):
     __tablename__ = "customer"
 
-    customer_id: Mapped[int_pk] = mapped_column(init=False)
+    customer_id: Mapped[big_int_pk] = mapped_column(init=False)
 
     first_name: Mapped[str_127]
     last_name: Mapped[str_127]
@@ -147,6 +165,15 @@ class Customer(Base):
     email: Mapped[str_127] = mapped_column(unique=True)
 
     order_count: Mapped[int] = query_expression(repr=False)
+    # value of `lifetime_value`, filled by `with_expression()` or aggregates.py
+    _lifetime_value: Mapped[Decimal] = query_expression(repr=False)
+    # counter cache of `orders`, maintained by counters.py
+    order_count_cached: Mapped[int] = mapped_column(
+        init=False,
+        repr=False,
+        default=0,
+        server_default="0",
+    )
 
     __table_args__ = (
         Index("customer_full_name", "first_name", "last_name"),
@@ -162,13 +189,34 @@ class Customer(Base):
         order_by="desc(Order.order_id)",
     )
 
+    @hybrid_property
+    def lifetime_value(self) -> Decimal:
+        """The total of all orders of the customer."""
+        if self._lifetime_value is None:
+            return sum((order.total for order in self.orders), Decimal(0))
+        return self._lifetime_value
+
+    @lifetime_value.inplace.expression
+    @classmethod
+    def _lifetime_value_expression(cls):
+        return (
+            select(func.coalesce(
+                func.sum(OrderDetail.quantity * Product.unit_price), 0))
+            .join(Order.order_details)
+            .join(OrderDetail.product)
+            .where(Order.customer_id == cls.customer_id)
+            .correlate(cls)
+            .scalar_subquery()
+        )
+
 
 class Order(Base):
     __tablename__ = "order"
 
-    order_id: Mapped[int_pk] = mapped_column(init=False)
+    order_id: Mapped[big_int_pk] = mapped_column(init=False)
 
     customer_id: Mapped[int] = mapped_column(
+        big_int,
         ForeignKey("customer.customer_id"),
         default=None,
     )
@@ -179,6 +227,10 @@ class Order(Base):
 
     order_datetime: Mapped[timestamp_auto] = mapped_column(init=False)
     is_shipped: Mapped[bool] = mapped_column(default=False)
+    # values of `total` and `item_count`, filled by `with_expression()` or
+    # aggregates.py
+    _total: Mapped[Decimal] = query_expression(repr=False)
+    _item_count: Mapped[int] = query_expression(repr=False)
 
     customer: Mapped[Customer] = relationship(
         back_populates="orders",
@@ -219,6 +271,48 @@ class Order(Base):
         repr=False,
     )
 
+    # hybrids: computed in SQL when used in a statement, e.g.
+    # `select(Order).order_by(Order.total.desc())`
+    @hybrid_property
+    def total(self) -> Decimal:
+        """The sum of `unit_price * quantity` of the order details."""
+        if self._total is None:  # not filled: load the details
+            return sum(
+                (detail.product.unit_price * detail.quantity
+                 for detail in self.order_details),
+                Decimal(0),
+            )
+        return self._total
+
+    @total.inplace.expression
+    @classmethod
+    def _total_expression(cls):
+        return (
+            select(func.coalesce(
+                func.sum(OrderDetail.quantity * Product.unit_price), 0))
+            .join(OrderDetail.product)
+            .where(OrderDetail.order_id == cls.order_id)
+            .correlate(cls)
+            .scalar_subquery()
+        )
+
+    @hybrid_property
+    def item_count(self) -> int:
+        """The number of items ordered: the sum of the quantities."""
+        if self._item_count is None:
+            return sum(detail.quantity for detail in self.order_details)
+        return self._item_count
+
+    @item_count.inplace.expression
+    @classmethod
+    def _item_count_expression(cls):
+        return (
+            select(func.coalesce(func.sum(OrderDetail.quantity), 0))
+            .where(OrderDetail.order_id == cls.order_id)
+            .correlate(cls)
+            .scalar_subquery()
+        )
+
 
 class OrderDetail(Base):
     """
@@ -228,6 +322,7 @@ class OrderDetail(Base):
     __tablename__ = "order_detail"
 
     order_id: Mapped[int] = mapped_column(
+        big_int,
         # database side: ON DELETE CASCADE
         ForeignKey("order.order_id", ondelete="CASCADE"),
         primary_key=True,
@@ -0,0 +1,449 @@
+"""
+Opt-in monthly partitioning of `order` by `order_datetime`.
+
+`order` only grows, and a query on recent orders reads an index (or the
+table) holding the whole history. `create_partitioned_schema()` creates the
+tables of models.py with `order` split into one table per month instead,
+`order_2024_01`, ... Old months can then be archived or dropped as a whole
+instead of deleted row by row, and the orders of a month range are read from
+the partitions of that range only:
+
+- PostgreSQL: `order` is a declarative partitioned table (`PARTITION BY
+  RANGE (order_datetime)`, primary key `(order_id, order_datetime)`) and its
+  partitions are `PARTITION OF` tables. The planner skips the partitions
+  that a predicate on `order_datetime` excludes, and routes inserts itself.
+- SQLite: `order` is a `UNION ALL` view of the partitions, whose `INSTEAD
+  OF` triggers route inserts, updates and deletes by `order_datetime`. A
+  predicate on `order_datetime` is pushed into every branch of the view and
+  answered by the `order_datetime` index of each partition: the partitions
+  outside the range cost one index lookup each. Partitions cannot share an
+  autoincrement, so order IDs are taken from `order_id_sequence` by a
+  `before_insert` event: bulk `insert(Order)` statements must provide them,
+  see `next_order_ids()`.
+
+`Order` stays mapped to `order`, so the ORM keeps working. Call
+`use_partitioned_orders(engine)` when the application starts. With SQLite,
+the engine then no longer checks the row count of ORM updates and deletes
+(of `Order` deletes, on any engine), which is 0 for statements on a view.
+
+`order_detail` is not partitioned: it has no `order_datetime`, and its rows
+are found by `order_id`. A foreign key to a partitioned `order` is not
+possible, so a trigger deletes the details of deleted orders, and retiring a
+partition archives or deletes the details of its orders.
+
+Pruning: `prune_orders(session, start, end)` adds
+`start <= order_datetime < end` to every ORM query of `Order` in the session,
+relationship loads included, like `orders_between()` does for one query.
+
+Maintenance, e.g. daily: `create_partitions()` adds the partitions up to a
+month ahead, `retire_partitions()` archives (renames to `archive_...`, with
+a copy of their details) or drops those before a month.
+"""
+import re
+import weakref
+from datetime import datetime
+
+from models import Base, Order
+from sqlalchemy import (Connection, Engine, and_, event, inspect, select,
+                        text)
+from sqlalchemy.orm import Session, with_loader_criteria
+
+PARTITION_NAME = re.compile(r"^order_(\d{4})_(\d{2})$")
+COLUMNS = ", ".join(column.name for column in Order.__table__.c)
+NEW_VALUES = ", ".join(f"NEW.{column.name}" for column in Order.__table__.c)
+
+# `order` and `order_detail`, other tables are created from models.py
+SCHEMA_DDL = {
+    "postgresql": [
+        """
+        CREATE TABLE "order" (
+            order_id BIGSERIAL,
+            customer_id BIGINT NOT NULL REFERENCES customer (customer_id),
+            employee_id INTEGER REFERENCES employee (employee_id),
+            order_datetime TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+            is_shipped BOOLEAN NOT NULL,
+            PRIMARY KEY (order_id, order_datetime)
+        ) PARTITION BY RANGE (order_datetime)
+        """,
+        'CREATE INDEX order_datetime ON "order" (order_datetime)',
+        """
+        CREATE TABLE order_detail (
+            order_id BIGINT NOT NULL,
+            product_id INTEGER NOT NULL REFERENCES product (product_id),
+            quantity INTEGER NOT NULL
+                CONSTRAINT num_of_ordered_item_must_be_positive
+                CHECK (quantity>0),
+            PRIMARY KEY (order_id, product_id)
+        )
+        """,
+        # the ON DELETE CASCADE of the missing foreign key
+        """
+        CREATE FUNCTION order_delete_details() RETURNS trigger
+        LANGUAGE plpgsql AS $$
+        BEGIN
+            DELETE FROM order_detail WHERE order_id = OLD.order_id;
+            RETURN NULL;
+        END
+        $$
+        """,
+        """
+        CREATE TRIGGER order_delete_details AFTER DELETE ON "order"
+        FOR EACH ROW EXECUTE FUNCTION order_delete_details()
+        """,
+    ],
+    "sqlite": [
+        """
+        CREATE TABLE order_detail (
+            order_id INTEGER NOT NULL,
+            product_id INTEGER NOT NULL REFERENCES product (product_id),
+            quantity INTEGER NOT NULL
+                CONSTRAINT num_of_ordered_item_must_be_positive
+                CHECK (quantity>0),
+            PRIMARY KEY (order_id, product_id)
+        )
+        """,
+        "CREATE TABLE order_id_sequence (last_id INTEGER NOT NULL)",
+        "INSERT INTO order_id_sequence (last_id) VALUES (0)",
+    ],
+}
+
+# engines whose `order` is a view, see `use_partitioned_orders()`
+_view_engines: weakref.WeakSet = weakref.WeakSet()
+
+
+def month_start(moment: datetime) -> datetime:
+    return datetime(moment.year, moment.month, 1)
+
+
+def add_months(month: datetime, months: int) -> datetime:
+    index = month.year * 12 + month.month - 1 + months
+    return datetime(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month: datetime) -> str:
+    return f"order_{month.year:04d}_{month.month:02d}"
+
+
+def bounds(month: datetime) -> tuple[str, str]:
+    """The range of `month` as SQL literals (also SQLite's text format)."""
+    return (f"'{month:%Y-%m-%d %H:%M:%S}'",
+            f"'{add_months(month, 1):%Y-%m-%d %H:%M:%S}'")
+
+
+def partitions(conn: Connection) -> list[datetime]:
+    """The first day of the month of each partition, in order."""
+    if conn.dialect.name == "postgresql":
+        names = conn.scalars(text(
+            "SELECT c.relname FROM pg_inherits i "
+            "JOIN pg_class c ON c.oid = i.inhrelid "
+            "WHERE i.inhparent = '\"order\"'::regclass"
+        ))
+    else:
+        names = conn.scalars(text(
+            "SELECT name FROM sqlite_master WHERE type = 'table'"))
+    months = []
+    for name in names:
+        match = PARTITION_NAME.match(name)
+        if match:
+            months.append(datetime(int(match[1]), int(match[2]), 1))
+    return sorted(months)
+
+
+# SQLite: the view and its triggers, recreated when the partitions change
+def in_partition(row: str, month: datetime) -> str:
+    low, high = bounds(month)
+    return f"{row}.order_datetime >= {low} AND {row}.order_datetime < {high}"
+
+
+def sqlite_view_ddl(months: list[datetime]) -> list[str]:
+    names = [partition_name(month) for month in months]
+    covered = " OR ".join(f"({in_partition('NEW', month)})"
+                          for month in months)
+    no_partition = (
+        f"SELECT RAISE(ABORT, 'no partition of order for order_datetime') "
+        f"WHERE NOT ({covered});"
+    )
+    insert = "\n".join(
+        f"INSERT INTO {name} ({COLUMNS}) SELECT {NEW_VALUES} "
+        f"WHERE {in_partition('NEW', month)};"
+        for name, month in zip(names, months)
+    )
+    delete = "\n".join(
+        f"DELETE FROM {name} WHERE order_id = OLD.order_id "
+        f"AND {in_partition('OLD', month)};"
+        for name, month in zip(names, months)
+    )
+    return [
+        'CREATE VIEW "order" AS '
+        + " UNION ALL ".join(f"SELECT {COLUMNS} FROM {name}"
+                             for name in names),
+        f"""
+        CREATE TRIGGER order_insert INSTEAD OF INSERT ON "order"
+        BEGIN
+            {no_partition}
+            {insert}
+        END
+        """,
+        # a new `order_datetime` may move the order to another partition
+        f"""
+        CREATE TRIGGER order_update INSTEAD OF UPDATE ON "order"
+        BEGIN
+            {no_partition}
+            {delete}
+            {insert}
+        END
+        """,
+        f"""
+        CREATE TRIGGER order_delete INSTEAD OF DELETE ON "order"
+        BEGIN
+            {delete}
+            DELETE FROM order_detail WHERE order_id = OLD.order_id;
+        END
+        """,
+    ]
+
+
+def replace_sqlite_view(conn: Connection, months: list[datetime]):
+    conn.execute(text('DROP VIEW IF EXISTS "order"'))  # and its triggers
+    if months:
+        for statement in sqlite_view_ddl(months):
+            conn.execute(text(statement))
+
+
+# maintenance
+def create_partitions(
+        conn: Connection,
+        through: datetime,
+        since: datetime | None = None,
+) -> list[str]:
+    """
+    Create the missing partitions from `since` (by default, the month after
+    the last partition, or this month) to the month of `through`. Return the
+    names of the partitions created.
+    """
+    existing = partitions(conn)
+    if since is None:
+        since = (add_months(existing[-1], 1) if existing
+                 else month_start(datetime.now()))
+    month, created = month_start(since), []
+    while month <= through:
+        if month not in existing:
+            name = partition_name(month)
+            low, high = bounds(month)
+            if conn.dialect.name == "postgresql":
+                conn.execute(text(
+                    f'CREATE TABLE {name} PARTITION OF "order" '
+                    f"FOR VALUES FROM ({low}) TO ({high})"
+                ))
+            else:
+                conn.execute(text(f"""
+                    CREATE TABLE {name} (
+                        order_id INTEGER NOT NULL PRIMARY KEY,
+                        customer_id INTEGER NOT NULL,
+                        employee_id INTEGER,
+                        order_datetime DATETIME NOT NULL
+                            CHECK ({in_partition(name, month)}),
+                        is_shipped BOOLEAN NOT NULL
+                    )
+                """))
+                conn.execute(text(
+                    f"CREATE INDEX {name}_datetime ON {name} (order_datetime)"
+                ))
+            created.append(name)
+        month = add_months(month, 1)
+    if created and conn.dialect.name != "postgresql":
+        replace_sqlite_view(conn, partitions(conn))
+    return created
+
+
+def retire_partitions(
+        conn: Connection,
+        before: datetime,
+        archive: bool = True,
+) -> list[str]:
+    """
+    Take the partitions of the months before `before` out of `order`, with
+    the details of their orders. With `archive`, partition `order_2024_01`
+    is kept as `archive_order_2024_01` and its details are moved to
+    `archive_order_detail_2024_01`, otherwise both are deleted. Return the
+    names of the partitions retired.
+    """
+    months = partitions(conn)
+    retired = [month for month in months if month < month_start(before)]
+    postgresql = conn.dialect.name == "postgresql"
+    if retired and not postgresql:
+        replace_sqlite_view(conn, [])  # no view on the tables to change
+    for month in retired:
+        name = partition_name(month)
+        if postgresql:
+            conn.execute(text(f'ALTER TABLE "order" DETACH PARTITION {name}'))
+        orders = f"SELECT order_id FROM {name}"
+        if archive:
+            conn.execute(text(
+                f"CREATE TABLE archive_order_detail_{name[6:]} AS "
+                f"SELECT * FROM order_detail WHERE order_id IN ({orders})"
+            ))
+            conn.execute(text(f"ALTER TABLE {name} RENAME TO archive_{name}"))
+            orders = f"SELECT order_id FROM archive_{name}"
+        conn.execute(text(
+            f"DELETE FROM order_detail WHERE order_id IN ({orders})"))
+        if not archive:
+            conn.execute(text(f"DROP TABLE {name}"))
+    if retired and not postgresql:
+        replace_sqlite_view(conn, [m for m in months if m not in retired])
+    return [partition_name(month) for month in retired]
+
+
+def create_partitioned_schema(
+        engine: Engine,
+        first_month: datetime,
+        months_ahead: int = 3,
+):
+    """
+    Create the tables of models.py, with `order` partitioned by month from
+    `first_month` to `months_ahead` months after the current one.
+    """
+    dialect = engine.dialect.name
+    if dialect not in SCHEMA_DDL:
+        raise ValueError(f"Partitioning is not available with {dialect}.")
+    with engine.begin() as conn:
+        Base.metadata.create_all(conn, tables=[
+            table for table in Base.metadata.sorted_tables
+            if table.name not in ("order", "order_detail")
+        ])
+        for statement in SCHEMA_DDL[dialect]:
+            conn.execute(text(statement))
+        create_partitions(
+            conn,
+            add_months(month_start(datetime.now()), months_ahead),
+            since=first_month,
+        )
+
+
+# ORM
+def assign_order_id(mapper, connection: Connection, target: Order):
+    if target.order_id is None and connection.engine in _view_engines:
+        target.order_id = next_order_ids(connection, 1)[0]
+
+
+def next_order_ids(conn: Connection, count: int) -> list[int]:
+    """Reserve `count` order IDs (SQLite partitioned schema)."""
+    last_id = conn.scalar(text(
+        "UPDATE order_id_sequence SET last_id = last_id + :count "
+        "RETURNING last_id"
+    ), {"count": count})
+    return list(range(last_id - count + 1, last_id + 1))
+
+
+def add_pruning(orm_execute_state):
+    period = orm_execute_state.session.info.get("order_period")
+    if (period is None or not orm_execute_state.is_select
+            or orm_execute_state.is_column_load):
+        return
+    start, end = period
+    orm_execute_state.statement = orm_execute_state.statement.options(
+        with_loader_criteria(
+            Order,
+            lambda cls: and_(cls.order_datetime >= start,
+                             cls.order_datetime < end),
+            include_aliases=True,
+        )
+    )
+
+
+def use_partitioned_orders(engine: Engine):
+    """Set up the ORM for the partitioned schema on `engine`."""
+    if engine.dialect.name == "sqlite":
+        _view_engines.add(engine)
+        # statements on a view report 0 rows
+        engine.dialect.supports_sane_rowcount = False
+        engine.dialect.supports_sane_multi_rowcount = False
+        inspect(Order).confirm_deleted_rows = False
+    if not event.contains(Order, "before_insert", assign_order_id):
+        event.listen(Order, "before_insert", assign_order_id)
+        event.listen(Session, "do_orm_execute", add_pruning)
+
+
+def prune_orders(
+        session: Session,
+        start: datetime,
+        end: datetime = datetime.max,
+):
+    """Restrict the `Order` queries of `session` to `[start, end)`."""
+    session.info["order_period"] = (start, end)
+
+
+def unprune_orders(session: Session):
+    session.info.pop("order_period", None)
+
+
+def orders_between(session: Session, start: datetime, end: datetime):
+    return session.scalars(
+        select(Order)
+        .where(Order.order_datetime >= start, Order.order_datetime < end)
+        .order_by(Order.order_datetime)
+    ).all()
+
+
+if __name__ == "__main__":
+    import logging
+
+    from models import Customer, OrderDetail, Product
+    from sqlalchemy import create_engine, func
+
+    logging.disable(logging.INFO)  # `echo=True` on the engine of models.py
+    engine = create_engine("sqlite+pysqlite:///:memory:")
+    this_month = month_start(datetime.now())
+    create_partitioned_schema(engine, add_months(this_month, -23))
+    use_partitioned_orders(engine)
+
+    with Session(engine) as session:
+        mary = Customer("Mary", "Smith", "1 Main St", "mary@example.com")
+        phone = Product(product_name="phone", unit_price=300)
+        session.add_all([mary, phone])
+        for month in range(-23, 1):  # 10 orders a month for two years
+            for day in range(10):
+                order = Order()
+                order.order_datetime = add_months(this_month, month).replace(
+                    day=1 + day)
+                mary.orders.append(order)
+                detail = OrderDetail()
+                detail.product = phone
+                order.order_details.append(detail)
+        session.commit()
+        print("partitions:", len(partitions(session.connection())),
+              "orders:", session.scalar(select(func.count(Order.order_id))))
+
+        # updates and deletes through the ORM
+        recent = orders_between(
+            session, add_months(this_month, -1), this_month)
+        recent[0].is_shipped = True
+        recent[1].order_datetime = this_month  # moves to another partition
+        session.delete(recent[2])
+        session.commit()
+        print("shipped:", session.scalar(
+            select(func.count()).where(Order.is_shipped)))
+
+        prune_orders(session, add_months(this_month, -2))
+        session.expire_all()
+        print("orders since 2 months ago:", len(mary.orders))
+        plan = [row.detail for row in session.execute(text(
+            "EXPLAIN QUERY PLAN SELECT * FROM \"order\" "
+            "WHERE order_datetime >= :start"),
+            {"start": str(add_months(this_month, -2))})]
+        print("plan:", sum("USING INDEX" in step for step in plan),
+              "index searches,", sum(step.startswith("SCAN order_")
+                                     for step in plan), "scans")
+        unprune_orders(session)
+
+        # maintenance
+        conn = session.connection()
+        print("created:", create_partitions(conn, add_months(this_month, 6)))
+        print("archived:", len(retire_partitions(
+            conn, add_months(this_month, -12))))
+        print("dropped:", retire_partitions(
+            conn, add_months(this_month, -11), archive=False))
+        session.commit()
+        session.expire_all()
+        print("orders:", len(mary.orders), "details:",
+              session.scalar(select(func.count()).select_from(OrderDetail)))
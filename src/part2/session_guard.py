@@ -0,0 +1,334 @@
+"""
+Identity map monitor and expunge policy for long-lived sessions.
+
+A batch job that walks millions of rows in one `Session` keeps every object
+it still references in the identity map. Clean objects are referenced
+weakly, so they stay as long as the job holds them (result lists, caches,
+the collections of objects it keeps); modified and deleted objects are held
+by the session itself until the next flush. Every object in the map is also
+expired by each commit and rollback, and each of them then costs a SELECT
+when it is used again: a job that commits per batch slows down as the map
+grows.
+
+`SessionGuard` listens to the events of one session. Every `check_every`
+objects loaded or inserted it checks the size of the map and estimates its
+memory, from a sample of `SAMPLE_SIZE` objects of each class (the object,
+its `__dict__` and the attribute values, not what they refer to). When the
+estimate exceeds `budget_bytes`, an `IdentityMapWarning` is issued once per
+call site: the first frame outside SQLAlchemy and this module.
+
+The policy expunges clean objects: persistent, unmodified, not deleted, and
+without a modified object among those an expunge would cascade to.
+
+- "none": only monitor,
+- "count": expunge every clean object once the map has more than
+  `max_objects`,
+- "commit": expunge every clean object on commit, before the commit
+  expires them, so they keep their loaded state when detached,
+- "lru": expunge the least recently used clean objects down to
+  `max_objects`; recently used means loaded, inserted or added back last.
+
+Objects are not expunged while a query is loading rows: "count" and "lru"
+apply before the next ORM statement, on commit, or when `checkpoint()` is
+called (e.g. in a loop over a `yield_per` result), and they leave the
+objects loaded since the previous check (every `check_every` objects) alone,
+like the rest of a `yield_per` partition. The keys the guard tracks for that
+are dropped at every check once their objects left the map, so the guard
+stays as small as the map it watches. Expunged objects are detached: they
+keep their loaded attributes, but lazy loads raise `DetachedInstanceError`
+and changes are not saved anymore. The policies suit jobs that do not come
+back to the objects of earlier batches.
+
+Usage:
+    guard = SessionGuard(session, policy="commit", budget_bytes=2**28)
+    ...
+    print(guard.report())
+    guard.close()
+"""
+import os
+import sys
+import sysconfig
+import time
+import warnings
+from collections import OrderedDict
+from typing import Any
+
+import sqlalchemy
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import InstanceState, Session
+
+POLICIES = ("none", "count", "commit", "lru")
+SAMPLE_SIZE = 100
+
+# frames in SQLAlchemy, this module and the standard library are not call
+# sites; those of third-party packages, even installed under the standard
+# library (site-packages of a system Python), are
+_SQLALCHEMY = os.path.join(os.path.dirname(sqlalchemy.__file__), "")
+_STDLIB = os.path.join(sysconfig.get_paths()["stdlib"], "")
+_THIRD_PARTY = (f"{os.sep}site-packages{os.sep}",
+                f"{os.sep}dist-packages{os.sep}")
+
+
+def is_internal(filename: str) -> bool:
+    if filename == __file__ or filename.startswith(_SQLALCHEMY):
+        return True
+    return filename.startswith(_STDLIB) and not any(
+        part in filename for part in _THIRD_PARTY)
+
+
+class IdentityMapWarning(UserWarning):
+    pass
+
+
+def call_site() -> tuple[str, int, dict]:
+    """(file, line, globals) of the innermost caller outside SQLAlchemy."""
+    frame = sys._getframe(1)
+    while frame.f_back is not None:
+        if not is_internal(frame.f_code.co_filename):
+            break
+        frame = frame.f_back
+    return frame.f_code.co_filename, frame.f_lineno, frame.f_globals
+
+
+def estimate_bytes(state: InstanceState) -> int:
+    """Shallow size of a loaded object: itself, its state and its values."""
+    obj = state.obj()
+    if obj is None:
+        return 0
+    return (
+        sys.getsizeof(obj)
+        + sys.getsizeof(state.dict)
+        + sum(sys.getsizeof(value) for value in state.dict.values())
+    )
+
+
+class SessionGuard:
+    def __init__(
+            self,
+            session: Session,
+            policy: str = "none",
+            max_objects: int = 10_000,
+            budget_bytes: int | None = 256 * 2**20,
+            check_every: int = 1_000,
+    ) -> None:
+        if policy not in POLICIES:
+            raise ValueError(f"Use one of {POLICIES} for the policy.")
+        self.session = session
+        self.policy = policy
+        self.max_objects = max_objects
+        self.budget_bytes = budget_bytes
+        self.check_every = check_every
+
+        self.added = 0  # objects loaded or inserted since the last check
+        self.expunged = 0
+        self.peak_objects = 0
+        self._evict_due = False
+        # identity key -> None, least recently used first ("lru" only)
+        self._recent: OrderedDict[tuple, None] = OrderedDict()
+        # identity keys loaded since the last check ("count", "lru")
+        self._fresh: set[tuple] = set()
+        # class -> [objects sampled, their bytes], with the states to sample
+        self._sizes: dict[type, list[int]] = {}
+        self._to_sample: list[InstanceState] = []
+        self._warned: set[tuple[str, int]] = set()
+
+        self._listeners = [
+            ("loaded_as_persistent", self._on_persistent),
+            ("pending_to_persistent", self._on_persistent),
+            ("detached_to_persistent", self._on_persistent),
+            ("do_orm_execute", self._on_execute),
+            ("after_commit", self._on_commit),
+        ]
+        for name, fn in self._listeners:
+            event.listen(session, name, fn)
+
+    def close(self):
+        for name, fn in self._listeners:
+            event.remove(self.session, name, fn)
+
+    # events
+    def _on_persistent(self, session: Session, instance: Any):
+        state = inspect(instance)
+        if self.policy == "lru":
+            self._recent[state.key] = None
+            self._recent.move_to_end(state.key)
+        if self.policy in ("count", "lru"):
+            self._fresh.add(state.key)
+        sampled = self._sizes.setdefault(state.class_, [0, 0])
+        if sampled[0] < SAMPLE_SIZE:
+            # attributes are populated after this event: measured later
+            sampled[0] += 1
+            self._to_sample.append(state)
+        self.added += 1
+        if self.added >= self.check_every:
+            self._check()
+
+    def _on_execute(self, orm_execute_state):
+        if self._evict_due:
+            self.checkpoint()
+
+    def _on_commit(self, session: Session):
+        if self.policy == "commit":
+            self.expunge_clean(list(session.identity_map.keys()))
+        elif self._evict_due:
+            self.checkpoint()
+
+    # checks and eviction
+    def _check(self):
+        self.added = 0
+        for state in self._to_sample:
+            self._sizes[state.class_][1] += estimate_bytes(state)
+        self._to_sample.clear()
+
+        identity_map = self.session.identity_map
+        # objects garbage collected or expunged since: forget their keys
+        for key in [key for key in self._recent if key not in identity_map]:
+            del self._recent[key]
+        self._fresh.clear()
+
+        objects = len(identity_map)
+        self.peak_objects = max(self.peak_objects, objects)
+        if self.policy in ("count", "lru") and objects > self.max_objects:
+            self._evict_due = True
+        if (self.budget_bytes is not None
+                and objects * self.bytes_per_object() > self.budget_bytes):
+            self._warn(objects)
+
+    def bytes_per_object(self) -> float:
+        sampled = sum(count for count, _ in self._sizes.values())
+        total = sum(size for _, size in self._sizes.values())
+        return total / sampled if sampled else 0.0
+
+    def _warn(self, objects: int):
+        filename, lineno, module_globals = call_site()
+        if (filename, lineno) in self._warned:
+            return
+        self._warned.add((filename, lineno))
+        top = sorted(
+            self.report()["classes"].items(),
+            key=lambda item: item[1]["estimated_bytes"],
+            reverse=True,
+        )[:3]
+        warnings.warn_explicit(
+            f"Identity map of {objects} objects, about "
+            f"{objects * self.bytes_per_object() / 2**20:.1f} MiB, over the "
+            f"budget of {self.budget_bytes / 2**20:.1f} MiB; largest: "
+            + ", ".join(f"{name} ({stats['objects']} objects)"
+                        for name, stats in top),
+            IdentityMapWarning,
+            filename,
+            lineno,
+            module=module_globals.get("__name__"),
+            registry=module_globals.setdefault("__warningregistry__", {}),
+        )
+
+    def is_clean(self, state: InstanceState) -> bool:
+        if state.modified or state.deleted or not state.persistent:
+            return False
+        return not any(
+            child_state.modified
+            for _, _, child_state, _ in state.mapper.cascade_iterator(
+                "expunge", state)
+        )
+
+    def checkpoint(self) -> int:
+        """Apply the policy now, return the number of objects expunged."""
+        self._evict_due = False
+        identity_map = self.session.identity_map
+        excess = len(identity_map) - self.max_objects
+        expunged = 0
+        if excess > 0 and self.policy == "count":
+            expunged = self.expunge_clean(list(identity_map.keys()))
+        elif excess > 0 and self.policy == "lru":
+            expunged = self.expunge_clean(list(self._recent), excess)
+        self._fresh.clear()
+        return expunged
+
+    def expunge_clean(self, keys: list[tuple], limit: int | None = None):
+        """Expunge the clean objects among `keys`, at most `limit`."""
+        identity_map = self.session.identity_map
+        expunged = 0
+        for key in keys:
+            if limit is not None and expunged >= limit:
+                break
+            self._recent.pop(key, None)
+            obj = identity_map.get(key)
+            if obj is None:  # garbage collected or expunged by a cascade
+                continue
+            if key in self._fresh or not self.is_clean(inspect(obj)):
+                if self.policy == "lru":
+                    self._recent[key] = None  # try again later
+                continue
+            self.session.expunge(obj)
+            expunged += 1
+        self.expunged += expunged
+        return expunged
+
+    def report(self) -> dict[str, Any]:
+        """Objects per class in the identity map, with estimated bytes."""
+        classes: dict[str, dict[str, Any]] = {}
+        states = self.session.identity_map.all_states()
+        for state in states:
+            stats = classes.setdefault(state.class_.__name__, {
+                "objects": 0,
+                "modified": 0,
+                "bytes_per_object": self._class_bytes(state.class_),
+            })
+            stats["objects"] += 1
+            stats["modified"] += state.modified
+        for stats in classes.values():
+            stats["estimated_bytes"] = (
+                stats["objects"] * stats["bytes_per_object"])
+        return {
+            "policy": self.policy,
+            "objects": len(states),
+            "peak_objects": max(self.peak_objects, len(states)),
+            "expunged": self.expunged,
+            "estimated_bytes": sum(
+                stats["estimated_bytes"] for stats in classes.values()),
+            "classes": classes,
+        }
+
+    def _class_bytes(self, cls: type) -> float:
+        count, size = self._sizes.get(cls, (0, 0))
+        measured = count - sum(
+            1 for state in self._to_sample if state.class_ is cls)
+        return size / measured if measured > 0 else 0.0
+
+
+if __name__ == "__main__":
+    # Demo: a job that updates customers in batches, committing each batch,
+    # and keeps them for a summary at the end
+    from models import Base, Customer
+    from sqlalchemy import create_engine, insert, select
+
+    engine = create_engine("sqlite+pysqlite:///:memory:")
+    Base.metadata.create_all(engine)
+    with engine.begin() as conn:
+        conn.execute(insert(Customer), [
+            {"first_name": "First", "last_name": f"Last {i}",
+             "address": f"{i} Main St", "email": f"customer{i}@example.com"}
+            for i in range(50_000)
+        ])
+
+    for policy in ("none", "commit"):
+        with Session(engine) as session:
+            guard = SessionGuard(
+                session, policy=policy, budget_bytes=10 * 2**20)
+            start = time.perf_counter()
+            processed = []
+            for offset in range(0, 50_000, 1_000):
+                batch = session.scalars(
+                    select(Customer).order_by(Customer.customer_id)
+                    .offset(offset).limit(1_000)
+                ).all()
+                for customer in batch:
+                    customer.first_name = "Updated"
+                session.commit()
+                processed.extend(batch)
+            names = sum(len(customer.last_name) for customer in processed)
+            seconds = time.perf_counter() - start
+            report = guard.report()
+            guard.close()
+        print(f"{policy}: {seconds:.2f} s, peak {report['peak_objects']} "
+              f"objects, {report['expunged']} expunged")
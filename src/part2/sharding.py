@@ -0,0 +1,435 @@
+"""
+Horizontal sharding of customers and their orders across databases.
+
+One database caps the write throughput: `ShardedSession` spreads the
+customers over N engines (the shards), by a hash of `customer_id`, with
+their orders and order details on the same shard, so writing and reading the
+orders of a customer touches one database. Products and employees are
+reference data: they are written to `HOME_SHARD` and copied to the other
+shards by `replicate_reference_data()`, so that order details can refer to
+them on every shard.
+
+IDs are generated without a central sequence, Snowflake style: a 63-bit
+integer made of the milliseconds since `EPOCH` (41 bits), a node number
+(10 bits) and a counter per millisecond (12 bits). They are assigned when an
+object is first routed to a shard, on flush. IDs are unique only if every
+process writing at the same time, on any host, has its own node number: it
+is read from the `ID_NODE` environment variable (0 to 1023), assigned by
+the deployment (e.g. host index * workers per host + worker index), and
+`next_id()` raises an error without it rather than guess one.
+
+Routing (the choosers of `ShardedSession`):
+
+- a new customer goes to `shard_of(customer_id)`; a new order, order detail
+  to the shard of their customer, order,
+- `session.get(Customer, id)` and queries restricted to values of
+  `Customer.customer_id` or `Order.customer_id` (a comparison ANDed with
+  the rest of the WHERE clause, not under an OR) read those shards only;
+  other queries, like `session.get(Order, id)`, run on every shard, one
+  after the other,
+- queries of products and employees alone read `HOME_SHARD`, the other
+  shards have the same copies,
+- lazy loads run on the shard of the object they are loaded from.
+
+Keys of customers and orders are BIGINT (see `big_int` in models.py): the
+IDs do not fit in 32 bits.
+
+Cross-shard reports fan out in parallel instead: `fan_out()` runs a Core
+statement on every shard from a thread pool (a connection per shard, a
+`Session` is not thread safe) and returns the rows of all shards, which
+`customer_orders_count()` then merges.
+
+`shard_of()` is a modulo: changing the number of shards moves most
+customers, so shards are added by splitting the data offline.
+
+Usage:
+    engines = create_shards([f"sqlite+pysqlite:///shard{n}.db"
+                             for n in range(4)])
+    Session = sharded_sessionmaker(engines)
+"""
+import os
+import threading
+import time
+from collections.abc import Iterable, Iterator
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from models import Base, Customer, Employee, Order, OrderDetail, Product
+from sqlalchemy import (Connection, Engine, Table, bindparam, create_engine,
+                        func, insert, select, update)
+from sqlalchemy.ext.horizontal_shard import ShardedSession
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.sql import operators
+from sqlalchemy.sql.elements import (BinaryExpression, BindParameter,
+                                     BooleanClauseList, Grouping)
+
+EPOCH = datetime(2024, 1, 1)
+NODE_ENV = "ID_NODE"
+HOME_SHARD = "0"  # where reference data is written, and read
+REFERENCE_DATA = (Employee, Product)
+
+
+class IdGenerator:
+    """Snowflake IDs: milliseconds, node, counter. Thread safe."""
+
+    NODE_BITS = 10
+    COUNTER_BITS = 12
+
+    def __init__(self, node: int) -> None:
+        if not 0 <= node < 1 << self.NODE_BITS:
+            raise ValueError(
+                f"The node must be between 0 and {(1 << self.NODE_BITS) - 1}"
+                f", not {node}.")
+        self.node = node
+        self.epoch_ms = int(EPOCH.timestamp() * 1000)
+        self.last_ms = -1
+        self.counter = 0
+        self.lock = threading.Lock()
+
+    def __call__(self) -> int:
+        with self.lock:
+            now = int(time.time() * 1000) - self.epoch_ms
+            if now < self.last_ms:  # the clock went back: wait for it
+                time.sleep((self.last_ms - now) / 1000)
+                now = self.last_ms
+            if now == self.last_ms:
+                self.counter = (self.counter + 1) % (1 << self.COUNTER_BITS)
+                if self.counter == 0:  # 4096 IDs this millisecond
+                    while now <= self.last_ms:
+                        now = int(time.time() * 1000) - self.epoch_ms
+            else:
+                self.counter = 0
+            self.last_ms = now
+            return (
+                (now << (self.NODE_BITS + self.COUNTER_BITS))
+                | (self.node << self.COUNTER_BITS)
+                | self.counter
+            )
+
+
+_generator: IdGenerator | None = None
+_generator_lock = threading.Lock()
+
+
+def next_id() -> int:
+    """A new ID, from the generator of node `ID_NODE`."""
+    global _generator
+    if _generator is None:
+        with _generator_lock:
+            if _generator is None:
+                node = os.environ.get(NODE_ENV)
+                if node is None:
+                    raise RuntimeError(
+                        f"Set {NODE_ENV} to a node number unique among the "
+                        f"processes writing to the shards, from 0 to "
+                        f"{(1 << IdGenerator.NODE_BITS) - 1}.")
+                _generator = IdGenerator(int(node))
+    return _generator()
+
+
+def shard_of(customer_id: int, shards: int) -> str:
+    """The shard of a customer: a hash of the ID, modulo `shards`."""
+    # Fibonacci hashing: the low bits of Snowflake IDs are mostly counters
+    mixed = (customer_id * 0x9E3779B97F4A7C15) & 0xFFFF_FFFF_FFFF_FFFF
+    return str((mixed >> 32) % shards)
+
+
+class Router:
+    """The choosers of a `ShardedSession` over `shards` shards."""
+
+    def __init__(self, shards: int) -> None:
+        self.shards = shards
+        self.all_shards = [str(n) for n in range(shards)]
+
+    def customer_shard(self, customer: Customer) -> str:
+        if customer.customer_id is None:
+            customer.customer_id = next_id()
+        return shard_of(customer.customer_id, self.shards)
+
+    def shard_chooser(self, mapper, instance, clause=None):
+        if instance is None:  # e.g. a bulk statement
+            return HOME_SHARD
+        if isinstance(instance, Customer):
+            return self.customer_shard(instance)
+        if isinstance(instance, Order):
+            if instance.order_id is None:
+                instance.order_id = next_id()
+            if instance.customer is not None:
+                return self.customer_shard(instance.customer)
+            return shard_of(instance.customer_id, self.shards)
+        if isinstance(instance, OrderDetail):
+            if instance.order is None:
+                raise ValueError(
+                    "Add order details through `Order.order_details`, the "
+                    "shard of the order is not known from `order_id`.")
+            return self.shard_chooser(mapper, instance.order)
+        return HOME_SHARD  # reference data
+
+    def identity_chooser(self, mapper, primary_key, **kw):
+        if mapper.class_ is Customer:
+            return [shard_of(primary_key[0], self.shards)]
+        if issubclass(mapper.class_, REFERENCE_DATA):
+            return [HOME_SHARD]
+        return self.all_shards
+
+    def execute_chooser(self, orm_execute_state):
+        parent = orm_execute_state.lazy_loaded_from
+        if parent is not None and parent.identity_token is not None:
+            return [parent.identity_token]
+        mappers = orm_execute_state.all_mappers
+        if mappers and all(issubclass(mapper.class_, REFERENCE_DATA)
+                           for mapper in mappers):
+            return [HOME_SHARD]
+        customer_ids = compared_customer_ids(
+            orm_execute_state.statement, orm_execute_state.parameters)
+        if customer_ids is None:
+            return self.all_shards
+        shards = {shard_of(id_, self.shards) for id_ in customer_ids}
+        return sorted(shards) or [HOME_SHARD]  # `IN ()`: no row anywhere
+
+
+def compared_customer_ids(
+        statement,
+        parameters: dict | None = None,
+) -> list[int] | None:
+    """
+    The customer IDs a statement is restricted to by `customer_id = value`
+    or `customer_id IN (values)` ANDed with the rest of its WHERE clause,
+    None if there is no such comparison: one under an OR (or a NOT) does
+    not restrict the rows to its customers.
+    Values of bound parameters passed at execution (like those of
+    `session.get()`) are read from `parameters`.
+    """
+    columns = {Customer.__table__.c.customer_id, Order.__table__.c.customer_id}
+
+    def conjuncts(clause) -> Iterator:
+        if isinstance(clause, Grouping):
+            yield from conjuncts(clause.element)
+        elif (isinstance(clause, BooleanClauseList)
+                and clause.operator is operators.and_):
+            for element in clause.clauses:
+                yield from conjuncts(element)
+        else:
+            yield clause
+
+    def compared(clause) -> list[int] | None:
+        if not isinstance(clause, BinaryExpression):
+            return None
+        if clause.left in columns:
+            value = clause.right
+        elif clause.right in columns:
+            value = clause.left
+        else:
+            return None
+        if not isinstance(value, BindParameter):
+            return None  # compared to a column
+        if parameters and value.key in parameters:
+            values = parameters[value.key]
+        else:
+            values = value.effective_value
+        if clause.operator is operators.eq:
+            return [values]
+        if clause.operator is operators.in_op:
+            return list(values)
+        return None
+
+    whereclause = getattr(statement, "whereclause", None)
+    if whereclause is None:
+        return None
+    for clause in conjuncts(whereclause):
+        # any conjunct restricts the rows: the first one will do
+        customer_ids = compared(clause)
+        if customer_ids is not None:
+            return customer_ids
+    return None
+
+
+def create_shards(urls: list[str]) -> dict[str, Engine]:
+    """An engine per URL, shard "0", "1", ..., with the tables created."""
+    engines = {}
+    for number, url in enumerate(urls):
+        engine = create_engine(url)
+        Base.metadata.create_all(engine)
+        engines[str(number)] = engine
+    return engines
+
+
+def sharded_sessionmaker(engines: dict[str, Engine], **kw) -> sessionmaker:
+    router = Router(len(engines))
+    return sessionmaker(
+        class_=ShardedSession,
+        shards=engines,
+        shard_chooser=router.shard_chooser,
+        identity_chooser=router.identity_chooser,
+        execute_chooser=router.execute_chooser,
+        **kw,
+    )
+
+
+def replicate_reference_data(engines: dict[str, Engine]):
+    """
+    Copy the products and employees of `HOME_SHARD` to the others: insert
+    the missing rows, update the changed ones. Rows are never deleted, the
+    orders of a shard may refer to them.
+    """
+    tables = [Employee.__table__, Product.__table__]
+    with engines[HOME_SHARD].connect() as conn:
+        rows = {table: [row._asdict() for row in conn.execute(select(table))]
+                for table in tables}
+    for shard, engine in engines.items():
+        if shard == HOME_SHARD:
+            continue
+        with engine.begin() as conn:
+            for table in tables:
+                upsert(conn, table, rows[table])
+
+
+def upsert(conn: Connection, table: Table, rows: list[dict]):
+    """Make the rows of `table` with the keys of `rows` equal to them."""
+    key = table.primary_key.columns[0]
+    existing = {
+        row[key.name]: row
+        for row in (row._asdict() for row in conn.execute(select(table)))
+    }
+    # references within the table (`employee.manager_id`) are set by the
+    # update, once every row they may refer to is inserted
+    self_references = [
+        column.name for column in table.c
+        if any(fk.column.table is table for fk in column.foreign_keys)
+    ]
+    missing = [
+        {**row, **dict.fromkeys(self_references)}
+        for row in rows if row[key.name] not in existing
+    ]
+    if missing:
+        conn.execute(insert(table), missing)
+        existing.update((row[key.name], row) for row in missing)
+    changed = [row for row in rows if existing[row[key.name]] != row]
+    if changed:
+        # bound parameters cannot be named after the columns they set
+        conn.execute(
+            update(table)
+            .where(key == bindparam(f"new_{key.name}"))
+            .values({column.name: bindparam(f"new_{column.name}")
+                     for column in table.c if column is not key}),
+            [{f"new_{name}": value for name, value in row.items()}
+             for row in changed],
+        )
+
+
+_pools: dict[int, ThreadPoolExecutor] = {}
+_pools_lock = threading.Lock()
+
+
+def fan_out(engines: dict[str, Engine], statement) -> list:
+    """Run `statement` on every shard in parallel, return all the rows."""
+    with _pools_lock:
+        pool = _pools.get(len(engines))
+        if pool is None:
+            pool = _pools[len(engines)] = ThreadPoolExecutor(
+                len(engines), thread_name_prefix="shard")
+
+    def run(engine: Engine) -> list:
+        with engine.connect() as conn:
+            return conn.execute(statement).all()
+
+    return [row for rows in pool.map(run, engines.values()) for row in rows]
+
+
+def customer_orders_count(
+        engines: dict[str, Engine],
+        min_count: int = 0,
+) -> list:
+    """Like `customer_orders_count()` of read.py, over all the shards."""
+    count = func.count(Order.order_id).label("count")
+    stmt = (
+        select(Customer.first_name, Customer.last_name, count)
+        .join(Customer.orders)
+        .group_by(Customer.customer_id)
+        .having(count > min_count)
+    )
+    # a customer's orders are on its shard: the counts are complete, only
+    # the order of the rows is merged
+    return sorted(fan_out(engines, stmt), key=lambda row: row.count,
+                  reverse=True)
+
+
+def shipped_ratio(engines: dict[str, Engine]) -> float:
+    """An aggregate merged from partial aggregates of every shard."""
+    stmt = select(func.count(), func.count().filter(Order.is_shipped))
+    rows = fan_out(engines, stmt)
+    orders = sum(row[0] for row in rows)
+    return sum(row[1] for row in rows) / orders if orders else 0.0
+
+
+def chunks(items: list, size: int) -> Iterable[list]:
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+if __name__ == "__main__":
+    import logging
+    import random
+    import tempfile
+
+    from sqlalchemy import event
+
+    logging.disable(logging.INFO)  # `echo=True` on the engine of models.py
+    os.environ.setdefault(NODE_ENV, "0")  # the only process writing
+    rng = random.Random(0)
+    with tempfile.TemporaryDirectory() as tmp:
+        engines = create_shards([
+            f"sqlite+pysqlite:///{os.path.join(tmp, f'shard{n}.db')}"
+            for n in range(4)
+        ])
+        statements = dict.fromkeys(engines, 0)
+        for shard, engine in engines.items():
+            @event.listens_for(engine, "before_cursor_execute")
+            def count(conn, cursor, statement, parameters, context,
+                      executemany, shard=shard):
+                statements[shard] += 1
+
+        Session = sharded_sessionmaker(engines)
+        with Session() as session:
+            products = [Product(product_name=f"product {n}", unit_price=n + 1)
+                        for n in range(10)]
+            session.add_all(products)
+            session.commit()
+            replicate_reference_data(engines)
+
+            for batch in chunks(range(1_000), 100):
+                for n in batch:
+                    customer = Customer("First", f"Last {n}", f"{n} Main St",
+                                        f"customer{n}@example.com")
+                    for _ in range(rng.randint(0, 5)):
+                        order = Order(is_shipped=rng.random() < 0.3)
+                        customer.orders.append(order)
+                        for product in rng.sample(products, 2):
+                            detail = OrderDetail()
+                            detail.product_id = product.product_id
+                            order.order_details.append(detail)
+                    session.add(customer)
+                session.commit()
+
+        per_shard = fan_out(engines, select(func.count()).select_from(
+            Customer))
+        print("customers per shard:", [row[0] for row in per_shard])
+
+        with Session() as session:
+            customer_id = session.scalars(
+                select(Customer.customer_id).limit(1)).first()
+            statements = dict.fromkeys(engines, 0)
+            customer = session.get(Customer, customer_id)
+            orders = session.scalars(
+                select(Order).where(Order.customer_id == customer_id)).all()
+            details = [len(order.order_details) for order in orders]
+            print(f"customer {customer_id}: {len(orders)} orders {details}, "
+                  f"statements per shard: {list(statements.values())}")
+
+        start = time.perf_counter()
+        top = customer_orders_count(engines, min_count=4)
+        print(f"{len(top)} customers with 5 orders, first: {tuple(top[0])}, "
+              f"{(time.perf_counter() - start) * 1000:.1f} ms")
+        print(f"shipped: {shipped_ratio(engines):.0%}")
+        for engine in engines.values():
+            engine.dispose()
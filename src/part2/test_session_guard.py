@@ -0,0 +1,38 @@
+"""
+Run with `python -m pytest test_session_guard.py` from src/part2.
+"""
+import pytest
+from models import Base, Customer
+from session_guard import SessionGuard
+from sqlalchemy import create_engine, insert, select
+from sqlalchemy.orm import Session
+
+
+@pytest.mark.parametrize("policy", ["count", "lru"])
+def test_tracked_keys_stay_bounded(policy):
+    engine = create_engine("sqlite+pysqlite:///:memory:")
+    Base.metadata.create_all(engine)
+    with engine.begin() as conn:
+        conn.execute(insert(Customer), [
+            {"first_name": "First", "last_name": f"Last {i}", "address": "",
+             "email": f"customer{i}@example.com"}
+            for i in range(20_000)
+        ])
+
+    with Session(engine) as session:
+        guard = SessionGuard(
+            session, policy=policy, max_objects=500, budget_bytes=None,
+            check_every=100)
+        largest = 0
+        streamed = session.scalars(
+            select(Customer).execution_options(yield_per=1_000))
+        for count, customer in enumerate(streamed, 1):
+            del customer  # dropped: only the identity map held it weakly
+            largest = max(largest, len(guard._recent), len(guard._fresh))
+        guard.close()
+
+    assert count == 20_000
+    assert len(session.identity_map) <= 1
+    # the keys of the objects a yield_per result holds (the partition being
+    # loaded and the previous one), not of every object streamed
+    assert largest <= 2 * 1_000 + guard.check_every
@@ -0,0 +1,59 @@
+"""
+Cold-start latency benchmark for the FastAPI service.
+
+Every run starts a fresh Python process, so the mappers, the compiled cache
+and the pool are really empty. The app is started (running the lifespan
+hook) and the latency of the first requests is measured, once with the
+warm-up from `warmup.py` and once with it disabled.
+
+Usage: python bench_cold_start.py [runs]
+"""
+import json
+import statistics
+import subprocess
+import sys
+
+CHILD = '''
+import json, time
+import warmup
+if not {warm}:
+    warmup.warm_up = lambda *args, **kwargs: {{}}
+from fastapi.testclient import TestClient
+import main
+
+start = time.perf_counter()
+with TestClient(main.app) as client:
+    startup = time.perf_counter() - start
+    latencies = {{}}
+    for url in ("/products/1", "/products", "/products?direction=desc"):
+        start = time.perf_counter()
+        client.get(url)
+        latencies[url] = time.perf_counter() - start
+print(json.dumps({{"startup": startup, "latencies": latencies}}))
+'''
+
+
+def run_once(warm: bool) -> dict:
+    output = subprocess.run(
+        [sys.executable, "-c", CHILD.format(warm=warm)],
+        capture_output=True,
+        check=True,
+        text=True,
+    ).stdout
+    # the engine echoes SQL, the result is the last line
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main(runs: int = 5):
+    for warm in (False, True):
+        results = [run_once(warm) for _ in range(runs)]
+        print(f"# warm-up {'enabled' if warm else 'disabled'} ({runs} runs):")
+        startup = statistics.median(r["startup"] for r in results)
+        print(f"{'startup':<28}: {startup * 1000:8.2f} ms")
+        for url in results[0]["latencies"]:
+            latency = statistics.median(r["latencies"][url] for r in results)
+            print(f"{'GET ' + url:<28}: {latency * 1000:8.2f} ms")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5)
@@ -0,0 +1,130 @@
+"""
+Memory benchmark for the streaming export.
+
+Fills a temporary SQLite database with `rows` products, exports them
+through `GET /products/export` and checks that the peak RSS grew by less
+than `MAX_RSS_GROWTH_MB` while doing so. The ASGI app is called directly, since
+the test client would collect the whole response body in memory.
+
+pytest collects the check too, for both formats, with `BENCH_EXPORT_ROWS`
+products (100000 by default).
+
+Usage:
+    python bench_export.py [rows] [ndjson|csv]
+    BENCH_EXPORT_ROWS=1000000 python -m pytest bench_export.py
+"""
+import asyncio
+import os
+import resource
+import sys
+import tempfile
+import time
+
+import main
+import pytest
+from models import Base, ProductType, SessionMaker
+from sqlalchemy import create_engine
+
+MAX_RSS_GROWTH_MB = 64
+TEST_ROWS = 100_000
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def fill_products(engine, rows: int):
+    """
+    Insert rows from a generator with the DBAPI's executemany, so filling the
+    table does not raise the peak RSS before the export is measured.
+    """
+    types = [t.name for t in ProductType]  # stored by name, like `Enum`
+    conn = engine.raw_connection()
+    try:
+        conn.cursor().executemany(
+            "INSERT INTO product "
+            "(product_name, unit_price, units_in_stock, type) "
+            "VALUES (?, ?, ?, ?)",
+            (
+                (f"Product {i}", 1 + i % 1000, i % 100, types[i % len(types)])
+                for i in range(rows)
+            ),
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+
+async def export(path: str) -> tuple[int, int]:
+    """Call the app like an ASGI server would, discarding the body."""
+    received = {"bytes": 0, "chunks": 0}
+    disconnected = asyncio.Event()
+    path, _, query = path.partition("?")
+    scope = {
+        "type": "http",
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": query.encode(),
+        "headers": [],
+        "server": ("testserver", 80),
+        "client": ("testclient", 50000),
+    }
+    request_sent = False
+
+    async def receive():
+        nonlocal request_sent
+        if not request_sent:
+            request_sent = True
+            return {"type": "http.request", "body": b"", "more_body": False}
+        await disconnected.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        if message["type"] == "http.response.body":
+            received["bytes"] += len(message.get("body", b""))
+            received["chunks"] += 1
+            if not message.get("more_body", False):
+                disconnected.set()
+
+    await main.app(scope, receive, send)
+    return received["bytes"], received["chunks"]
+
+
+def run(rows: int = 1_000_000, fmt: str = "ndjson") -> bool:
+    with tempfile.TemporaryDirectory() as tmp:
+        url = f"sqlite+pysqlite:///{os.path.join(tmp, 'export.db')}"
+        engine = create_engine(url)
+        Base.metadata.create_all(engine)
+        print(f"Inserting {rows} products...")
+        fill_products(engine, rows)
+        SessionMaker.configure(bind=engine)
+
+        before = peak_rss_mb()
+        start = time.perf_counter()
+        size, chunks = asyncio.run(export(f"/products/export?format={fmt}"))
+        elapsed = time.perf_counter() - start
+        growth = peak_rss_mb() - before
+        engine.dispose()
+
+    print(f"exported {size / 2**20:.1f} MB in {chunks} chunks, "
+          f"{elapsed:.2f} s")
+    print(f"peak RSS grew by {growth:.1f} MB (limit {MAX_RSS_GROWTH_MB} MB)")
+    return growth < MAX_RSS_GROWTH_MB
+
+
+@pytest.mark.parametrize("fmt", ["ndjson", "csv"])
+def test_export_memory_is_bounded(fmt: str):
+    rows = int(os.environ.get("BENCH_EXPORT_ROWS", TEST_ROWS))
+    assert run(rows, fmt), f"peak RSS grew by {MAX_RSS_GROWTH_MB} MB or more"
+
+
+if __name__ == "__main__":
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    fmt = sys.argv[2] if len(sys.argv) > 2 else "ndjson"
+    ok = run(rows, fmt)
+    print("PASS" if ok else "FAIL")
+    sys.exit(0 if ok else 1)
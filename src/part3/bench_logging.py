@@ -0,0 +1,112 @@
+"""
+Request latency cost of statement logging.
+
+Serves `GET /products/{id}` from a temporary SQLite database with:
+
+- off: no statement logging,
+- sync: a `StreamHandler` on `sqlalchemy.engine` writing plain text, which
+  is what `echo=True` does,
+- queue: the JSON `QueueHandler`/`QueueListener` of structured_logging.py,
+  every statement logged,
+- queue 1%: the same, logging the statements of 1% of the connections.
+
+Logs are written to a file in the temporary directory, flushed after every
+record like `StreamHandler` does: a local file is the best case for the
+synchronous handler, which blocks on slower sinks. The modes take turns in
+rounds; the median and 99th percentile latency are compared with "off".
+
+Usage: python bench_logging.py [requests]
+"""
+import asyncio
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+import httpx
+import main
+import structured_logging
+from models import Base, Product, SessionMaker
+from sqlalchemy import create_engine, insert
+
+PRODUCTS = 1000
+MODES = ("off", "sync", "queue", "queue 1%")
+
+
+async def serve(client: httpx.AsyncClient, requests: int) -> list[float]:
+    latencies = []
+    for i in range(requests):
+        start = time.perf_counter()
+        await client.get(f"/products/{i % PRODUCTS + 1}")
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+async def run(requests: int = 5000, rounds: int = 10):
+    engine_logger = logging.getLogger("sqlalchemy.engine")
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = create_engine(
+            f"sqlite+pysqlite:///{os.path.join(tmp, 'logging.db')}")
+        Base.metadata.create_all(engine)
+        with engine.begin() as conn:
+            conn.execute(insert(Product), [
+                {"product_name": f"Product {i}", "unit_price": 1 + i}
+                for i in range(PRODUCTS)
+            ])
+        SessionMaker.configure(bind=engine)
+        # one event loop for all requests; the lifespan is not run
+        client = httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=main.app),
+            base_url="http://testserver",
+        )
+        await serve(client, 100)  # warm up
+
+        log_file = open(os.path.join(tmp, "statements.log"), "w")
+        sync_handler = logging.StreamHandler(log_file)
+        sync_handler.setFormatter(logging.Formatter(
+            "%(asctime)s %(levelname)s %(name)s %(message)s"))
+
+        def start(mode: str):
+            if mode == "sync":
+                engine_logger.setLevel(logging.INFO)
+                engine_logger.addHandler(sync_handler)
+            elif mode.startswith("queue"):
+                rate = 0.01 if mode == "queue 1%" else 1.0
+                return structured_logging.setup_statement_logging(
+                    engine, rate, structured_logging.json_handler(log_file))
+
+        def stop(mode: str, listener):
+            if mode == "sync":
+                engine_logger.setLevel(logging.WARNING)
+                engine_logger.removeHandler(sync_handler)
+            elif listener is not None:
+                structured_logging.stop_statement_logging(engine, listener)
+
+        # modes take turns, so a drift of the machine affects all of them
+        results: dict[str, list[float]] = {mode: [] for mode in MODES}
+        for _ in range(rounds):
+            for mode in MODES:
+                listener = start(mode)
+                results[mode] += await serve(client, requests // rounds)
+                stop(mode, listener)
+
+        await client.aclose()
+        log_file.close()
+        engine.dispose()
+
+    baseline = statistics.median(results["off"])
+    print(f"# {requests} requests per mode, latency in ms:")
+    for mode, latencies in results.items():
+        latencies.sort()
+        median = statistics.median(latencies)
+        p99 = latencies[int(len(latencies) * 0.99)]
+        print(
+            f"{mode:<10} median {median * 1000:7.3f}  p99 {p99 * 1000:7.3f}"
+            f"  ({(median - baseline) * 1000:+.3f} ms per request)"
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(run(int(sys.argv[1]) if len(sys.argv) > 1 else 5000))
@@ -0,0 +1,129 @@
+"""
+Backpressure for the sync FastAPI service.
+
+Sync endpoints run in Starlette's threadpool (40 threads by default), but
+only `POOL_SIZE + MAX_OVERFLOW` of those threads can hold a database
+connection at the same time. The other threads block in the pool until
+`POOL_TIMEOUT`, so latency explodes under load instead of failing fast.
+
+`ConcurrencyGovernor` sizes the threadpool from the engine pool and admits a
+request only if a connection is likely to be available: at most `capacity`
+requests run and at most `max_queue` wait for a thread. Everything above that
+is rejected right away with a 503 and a `Retry-After` header.
+"""
+import anyio.to_thread
+from sqlalchemy import Engine
+from starlette.responses import JSONResponse
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+
+def pool_capacity(engine: Engine) -> int:
+    """The number of connections the engine's pool can hand out at once."""
+    pool = engine.pool
+    size = pool.size() if hasattr(pool, "size") else 1
+    # QueuePool does not expose its overflow limit publicly
+    max_overflow = getattr(pool, "_max_overflow", 0)
+    if max_overflow < 0:  # -1 means no limit
+        return size
+    return size + max_overflow
+
+
+class ConcurrencyGovernor:
+    """
+    Admission control shared by `AdmissionMiddleware` and the metrics
+    endpoint. All methods are called from the event loop, so the counters
+    need no locking.
+    """
+
+    def __init__(
+            self,
+            engine: Engine,
+            max_queue: int | None = None,
+            retry_after: int = 1,
+    ) -> None:
+        self.engine = engine
+        self.capacity = pool_capacity(engine)
+        # by default, let as many requests wait as can run
+        self.max_queue = self.capacity if max_queue is None else max_queue
+        self.retry_after = retry_after
+
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.admitted = 0
+        self.rejected = 0
+
+    def configure_threadpool(self):
+        """
+        Size the threadpool used for sync endpoints to the pool capacity.
+        Must be called from the event loop, e.g., in the lifespan hook.
+        """
+        limiter = anyio.to_thread.current_default_thread_limiter()
+        limiter.total_tokens = self.capacity
+
+    def try_admit(self) -> bool:
+        if self.in_flight >= self.capacity + self.max_queue:
+            self.rejected += 1
+            return False
+        self.in_flight += 1
+        self.admitted += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        return True
+
+    def release(self):
+        self.in_flight -= 1
+
+    @property
+    def queue_depth(self) -> int:
+        """Admitted requests that are waiting for a thread."""
+        return max(0, self.in_flight - self.capacity)
+
+    def metrics(self) -> dict:
+        pool = self.engine.pool
+        return {
+            "capacity": self.capacity,
+            "max_queue": self.max_queue,
+            "in_flight": self.in_flight,
+            "peak_in_flight": self.peak_in_flight,
+            "queue_depth": self.queue_depth,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "pool_checked_out": getattr(pool, "checkedout", lambda: None)(),
+            "pool_overflow": getattr(pool, "overflow", lambda: None)(),
+        }
+
+
+class AdmissionMiddleware:
+    """
+    ASGI middleware rejecting requests the governor does not admit.
+    Requests to `exclude` paths (like the metrics endpoint) are always served.
+    """
+
+    def __init__(
+            self,
+            app: ASGIApp,
+            governor: ConcurrencyGovernor,
+            exclude: tuple[str, ...] = (),
+    ) -> None:
+        self.app = app
+        self.governor = governor
+        self.exclude = exclude
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or scope["path"] in self.exclude:
+            await self.app(scope, receive, send)
+            return
+
+        governor = self.governor
+        if not governor.try_admit():
+            response = JSONResponse(
+                {"detail": "Server is overloaded, try again later."},
+                status_code=503,
+                headers={"Retry-After": str(governor.retry_after)},
+            )
+            await response(scope, receive, send)
+            return
+
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            governor.release()
@@ -0,0 +1,109 @@
+"""
+ETags and conditional GET for product resources.
+
+The ETag of a product is derived from its `version_id`, which the ORM
+increments on every UPDATE. A request with `If-None-Match` only needs the
+version of the product: it is read from a small in-process cache, or with a
+single-column primary key lookup, and the object is neither loaded nor
+serialized when the client's copy is still current.
+
+The cache is local to each process, so an entry may be stale for at most
+`VERSION_CACHE_TTL` seconds after another process updated the product.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from models import Product
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session, object_session
+
+VERSION_CACHE_SIZE = 10_000
+VERSION_CACHE_TTL = 5  # seconds
+
+
+class VersionCache:
+    """A thread-safe LRU cache of product versions with a TTL."""
+
+    def __init__(
+            self,
+            maxsize: int = VERSION_CACHE_SIZE,
+            ttl: float = VERSION_CACHE_TTL,
+    ) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict[int, tuple[float, int]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, product_id: int) -> int | None:
+        with self._lock:
+            entry = self._data.get(product_id)
+            if entry is None:
+                return None
+            expires, version = entry
+            if expires < time.monotonic():
+                del self._data[product_id]
+                return None
+            self._data.move_to_end(product_id)
+            return version
+
+    def set(self, product_id: int, version: int):
+        with self._lock:
+            self._data[product_id] = (time.monotonic() + self.ttl, version)
+            self._data.move_to_end(product_id)
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def discard(self, product_id: int):
+        with self._lock:
+            self._data.pop(product_id, None)
+
+
+version_cache = VersionCache()
+
+
+# forget versions changed by this process once the transaction is committed
+# (or rolled back): discarded at flush, a version read by a concurrent
+# request before the commit would be cached again. The new version is cached
+# by the next lookup.
+CHANGED_VERSIONS = "changed_product_versions"  # key of `Session.info`
+
+
+@event.listens_for(Product, "after_update")
+@event.listens_for(Product, "after_delete")
+def collect_changed_version(mapper, connection, target: Product):
+    session = object_session(target)
+    if session is not None:
+        session.info.setdefault(CHANGED_VERSIONS, set()).add(
+            target.product_id)
+
+
+@event.listens_for(Session, "after_commit")
+@event.listens_for(Session, "after_rollback")
+def discard_cached_versions(session: Session):
+    for product_id in session.info.pop(CHANGED_VERSIONS, ()):
+        version_cache.discard(product_id)
+
+
+def make_etag(product_id: int, version: int) -> str:
+    return f'"product-{product_id}-v{version}"'
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """Weak comparison, as required for If-None-Match (RFC 9110)."""
+    if if_none_match.strip() == "*":
+        return True
+    candidates = (tag.strip() for tag in if_none_match.split(","))
+    return any(tag.removeprefix("W/") == etag for tag in candidates)
+
+
+def get_product_version(session: Session, product_id: int) -> int | None:
+    version = version_cache.get(product_id)
+    if version is None:
+        version = session.scalar(
+            select(Product.version_id)
+            .where(Product.product_id == product_id)
+        )
+        if version is not None:
+            version_cache.set(product_id, version)
+    return version
@@ -7,19 +7,18 @@ from models import Customer, Product, ProductType, SessionMaker, engine
 from sqlalchemy import select
 from sqlalchemy.event import listen, listens_for
 from sqlalchemy.orm import Session
+from structured_logging import setup_logging
 
-# logger settings
+# logger settings: records are written as JSON by a background thread,
+# keeping every "connect" event (lower the rate to sample them)
 logger = logging.getLogger("sqlalchemy_events")
 logger.setLevel(logging.DEBUG)
-stream_handler = logging.StreamHandler()  # you can also define a file handler
-formatter = logging.Formatter(
-    "%(asctime)s [%(name)s][%(levelname)s] [%(funcName)s] %(message)s")
-stream_handler.setFormatter(formatter)
-logger.addHandler(stream_handler)
+log_listener = setup_logging([logger.name], rates={"connect": 1.0})
 
 
 def db_on_connect1(dbapi_connection, connection_record):
-    logger.debug(f"Connected 1: {dbapi_connection}")
+    logger.debug(
+        "Connected 1: %s", dbapi_connection, extra={"event": "connect"})
 
 
 # register a listener with the `listen()` function
@@ -29,7 +28,8 @@ listen(engine, "connect", db_on_connect1)
 # register a listener with the `listens_for()` decorator
 @listens_for(engine, "connect")
 def db_on_connect2(dbapi_connection, connection_record):
-    logger.debug(f"Connected 2: {dbapi_connection}")
+    logger.debug(
+        "Connected 2: %s", dbapi_connection, extra={"event": "connect"})
 
 
 def list_products(session: Session):
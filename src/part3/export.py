@@ -0,0 +1,110 @@
+"""
+Constant-memory streaming export of products and orders.
+
+Rows are read with `yield_per`, which streams results from the database
+(server-side cursors where the driver supports them) and buffers at most
+`YIELD_PER` rows. Each partition is serialized to NDJSON or CSV and sent as
+one chunk of a `StreamingResponse`, so memory stays flat whatever the size
+of the table.
+"""
+import csv
+import datetime
+import enum
+import io
+import json
+from decimal import Decimal
+from typing import Any, Iterator, Sequence
+
+from fastapi import HTTPException
+from fastapi.responses import StreamingResponse
+from models import Order, OrderDetail, Product, SessionMaker
+from sqlalchemy import Select, select
+
+YIELD_PER = 1000
+
+MEDIA_TYPES = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+}
+
+
+def products_stmt() -> Select:
+    # plain columns, not entities: nothing is added to the identity map
+    return (
+        select(
+            Product.product_id,
+            Product.product_name,
+            Product.unit_price,
+            Product.units_in_stock,
+            Product.type,
+        )
+        .order_by(Product.product_id)
+    )
+
+
+def orders_stmt() -> Select:
+    """One row per order line, joined with `order_detail`."""
+    return (
+        select(
+            Order.order_id,
+            Order.customer_id,
+            Order.employee_id,
+            Order.order_datetime,
+            Order.is_shipped,
+            OrderDetail.product_id,
+            OrderDetail.quantity,
+        )
+        .join(Order.order_details)
+        .order_by(Order.order_id, OrderDetail.product_id)
+    )
+
+
+def to_plain(value: Any) -> Any:
+    """Convert a column value to a JSON/CSV friendly value."""
+    if isinstance(value, enum.Enum):
+        return value.name
+    if isinstance(value, Decimal):
+        return str(value)
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    return value
+
+
+def serialize(keys: Sequence[str], rows: Sequence, fmt: str) -> str:
+    if fmt == "csv":
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(
+            [to_plain(value) for value in row] for row in rows
+        )
+        return buffer.getvalue()
+
+    return "".join(
+        json.dumps(dict(zip(keys, map(to_plain, row)))) + "\n"
+        for row in rows
+    )
+
+
+def iter_export(stmt: Select, fmt: str) -> Iterator[str]:
+    # the session lives as long as the response is being streamed
+    with SessionMaker() as session:
+        result = session.execute(stmt.execution_options(yield_per=YIELD_PER))
+        keys = list(result.keys())
+        if fmt == "csv":
+            yield serialize(keys, [keys], fmt)
+        for rows in result.partitions():
+            yield serialize(keys, rows, fmt)
+
+
+def export_response(stmt: Select, fmt: str, name: str) -> StreamingResponse:
+    if fmt not in MEDIA_TYPES:
+        raise HTTPException(
+            status_code=400,
+            detail=f'Use one of {tuple(MEDIA_TYPES)} for the format.',
+        )
+    return StreamingResponse(
+        iter_export(stmt, fmt),
+        media_type=MEDIA_TYPES[fmt],
+        headers={
+            "Content-Disposition": f'attachment; filename="{name}.{fmt}"',
+        },
+    )
@@ -0,0 +1,335 @@
+"""
+Deterministic synthetic data for the store schema, at any scale.
+
+The seed data of part1/part2 has a handful of rows; this generates a store
+sized for capacity testing:
+
+- employees: a management tree (each manager has 3 to 8 reports, hired
+  after them), the managers land in `manager` through its triggers,
+- customers: unique emails accepted by `is_email_valid()`,
+- products: popularity follows a Zipf distribution (exponent `ZIPF_S`), so
+  a few products are in most orders, like a real catalog,
+- orders: spread over `DAYS` days before `END`, growing over time, busier
+  on weekends, in December and in the evening; 1 to 5 order lines each.
+  Customers are skewed too: some order much more often than others.
+
+The output depends only on the seed and the sizes: every shard of
+`SHARD_SIZE` rows is generated with its own `random.Random` seeded from
+(seed, table, shard number), with primary keys derived from the shard
+number, so neither the number of processes nor their scheduling changes a
+row. `END` is fixed rather than today for the same reason.
+
+Shards are generated by a process pool and loaded, in order, by the main
+process with one executemany `insert()` per table and shard, while the
+workers generate the next shards. On SQLite, the load connection turns off
+the journal and `fsync()` (`PRAGMA journal_mode=OFF`, `synchronous=OFF`):
+a crash leaves a corrupt file, generate it again.
+
+Usage:
+    python generate_data.py [--url sqlite+pysqlite:///generated.db]
+        [--orders 1000000] [--customers N] [--products N] [--employees N]
+        [--seed 0] [--workers N]
+"""
+import argparse
+import bisect
+import datetime
+import itertools
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from decimal import Decimal
+
+from models import (Base, Customer, Employee, Order, OrderDetail, Product,
+                    ProductType, is_email_valid)
+from sqlalchemy import Engine, create_engine, event, func, insert, select
+
+SHARD_SIZE = 50_000
+ZIPF_S = 1.1
+END = datetime.datetime(2024, 1, 1)
+DAYS = 2 * 365
+# orders per hour of the day, relative
+HOUR_WEIGHTS = [1, 1, 1, 1, 1, 2, 3, 5, 6, 7, 8, 8,
+                9, 8, 7, 7, 8, 9, 11, 12, 12, 10, 6, 3]
+# order lines per order (1 to 5), relative
+LINE_WEIGHTS = [40, 30, 15, 10, 5]
+
+FIRST_NAMES = [
+    "Alice", "Bob", "Cathy", "David", "Emma", "Frank", "Grace", "Henry",
+    "Irene", "Jack", "Karen", "Louis", "Lilly", "Maria", "Nathan", "Olivia",
+    "Peter", "Quinn", "Rosa", "Samuel", "Tina", "Umar", "Vera", "Walter",
+    "Xenia", "Yusuf", "Zoe", "Amir", "Bianca", "Carlos", "Diana", "Elena",
+    "Felix", "Hana", "Ivan", "Julia", "Kenji", "Lena", "Mateo", "Nora",
+]
+LAST_NAMES = [
+    "Smith", "Johnson", "Brown", "Garcia", "Miller", "Davis", "Lopez",
+    "Wilson", "Anderson", "Thomas", "Moore", "Martin", "Lee", "Clark",
+    "Lewis", "Walker", "Young", "King", "Wright", "Scott", "Green", "Baker",
+    "Adams", "Nelson", "Hill", "Campbell", "Mitchell", "Roberts", "Carter",
+    "Phillips", "Evans", "Turner", "Torres", "Parker", "Collins", "Edwards",
+]
+STREETS = [
+    "Main St", "Oak Ave", "Pine St", "Maple Ave", "Cedar Rd", "Elm St",
+    "Lake Dr", "Hill Rd", "Park Ave", "River Rd", "Sunset Blvd", "Bay St",
+]
+CITIES = [
+    "Springfield", "Riverside", "Fairview", "Franklin", "Greenville",
+    "Bristol", "Clinton", "Madison", "Georgetown", "Salem", "Ashland",
+]
+PRODUCT_WORDS = [
+    "smart", "ultra", "mini", "pro", "lite", "classic", "wireless", "rugged",
+    "slim", "max", "eco", "turbo", "nano", "prime", "solar", "retro",
+]
+PRODUCT_NOUNS = {
+    ProductType.PHONE: ["phone", "handset", "flip phone"],
+    ProductType.ACCESSORY: ["case", "charger", "cable", "headset", "stand"],
+    ProductType.OTHER: ["speaker", "tablet", "watch", "tracker", "camera"],
+}
+
+
+@dataclass(frozen=True)
+class Scale:
+    seed: int
+    orders: int
+    customers: int
+    products: int
+    employees: int
+
+
+def shard_rng(scale: Scale, table: str, shard: int) -> random.Random:
+    # seeding with a str is stable across runs, unlike `hash()` of a tuple
+    return random.Random(f"{scale.seed}:{table}:{shard}")
+
+
+def shards(count: int) -> list[range]:
+    """Primary keys of each shard of `count` rows."""
+    return [
+        range(start, min(start + SHARD_SIZE, count + 1))
+        for start in range(1, count + 1, SHARD_SIZE)
+    ]
+
+
+def generate_employees(scale: Scale) -> list[dict]:
+    # small enough for one shard: breadth-first, so managers come first
+    rng = shard_rng(scale, "employee", 0)
+    rows = [{
+        "employee_id": 1,
+        "manager_id": None,
+        "hire_date": (END - datetime.timedelta(days=3 * DAYS)).date(),
+    }]
+    managers = iter(range(1, scale.employees + 1))
+    employee_id = 2
+    while employee_id <= scale.employees:
+        manager = rows[next(managers) - 1]
+        for _ in range(rng.randint(3, 8)):
+            if employee_id > scale.employees:
+                break
+            days_left = (END.date() - manager["hire_date"]).days
+            rows.append({
+                "employee_id": employee_id,
+                "manager_id": manager["employee_id"],
+                "hire_date": manager["hire_date"] + datetime.timedelta(
+                    days=rng.randint(1, max(days_left // 2, 1))),
+            })
+            employee_id += 1
+
+    has_reports = {row["manager_id"] for row in rows}
+    for row in rows:
+        row["first_name"] = rng.choice(FIRST_NAMES)
+        row["last_name"] = rng.choice(LAST_NAMES)
+        row["is_manager"] = row["employee_id"] in has_reports
+    return rows
+
+
+def generate_products(scale: Scale) -> list[dict]:
+    rng = shard_rng(scale, "product", 0)
+    rows = []
+    for product_id in range(1, scale.products + 1):
+        product_type = rng.choices(list(ProductType), weights=[2, 5, 3])[0]
+        name = " ".join((
+            rng.choice(PRODUCT_WORDS),
+            rng.choice(PRODUCT_NOUNS[product_type]),
+            str(product_id),
+        ))
+        rows.append({
+            "product_id": product_id,
+            # what `Product.validate_product_name()` would store
+            "product_name": name.title(),
+            "unit_price": Decimal(f"{int(rng.lognormvariate(3.5, 1))}.99"),
+            "units_in_stock": rng.randint(0, 500),
+            "type": product_type,
+        })
+    return rows
+
+
+def generate_customers(scale: Scale, shard: int) -> list[dict]:
+    rng = shard_rng(scale, "customer", shard)
+    rows = []
+    for customer_id in shards(scale.customers)[shard]:
+        first_name = rng.choice(FIRST_NAMES)
+        last_name = rng.choice(LAST_NAMES)
+        rows.append({
+            "customer_id": customer_id,
+            "first_name": first_name,
+            "last_name": last_name,
+            "address": (
+                f"{rng.randint(1, 9999)} {rng.choice(STREETS)}, "
+                f"{rng.choice(CITIES)}"
+            ),
+            # the primary key makes it unique
+            "email": f"{first_name}.{last_name}.{customer_id}@example.com"
+            .lower(),
+        })
+    return rows
+
+
+def popularity(scale: Scale) -> tuple[list[int], list[float]]:
+    """Products by popularity rank, with the cumulative Zipf weights."""
+    products = list(range(1, scale.products + 1))
+    shard_rng(scale, "popularity", 0).shuffle(products)
+    cum_weights = list(itertools.accumulate(
+        1 / rank ** ZIPF_S for rank in range(1, len(products) + 1)))
+    return products, cum_weights
+
+
+def day_weights() -> list[float]:
+    """Cumulative weights of the days before `END`, oldest first."""
+    weights = []
+    for day in range(DAYS):
+        date = END - datetime.timedelta(days=DAYS - day)
+        weight = 1 + 2 * day / DAYS  # the store grows
+        if date.weekday() >= 5:
+            weight *= 1.3
+        if date.month == 12:
+            weight *= 1.5
+        weights.append(weight)
+    return list(itertools.accumulate(weights))
+
+
+def generate_orders(scale: Scale, shard: int) -> tuple[list[dict], list[dict]]:
+    rng = shard_rng(scale, "order", shard)
+    products, product_weights = popularity(scale)
+    days = day_weights()
+    hours = list(itertools.accumulate(HOUR_WEIGHTS))
+    lines = list(itertools.accumulate(LINE_WEIGHTS))
+    start = END - datetime.timedelta(days=DAYS)
+    shipped_before = END - datetime.timedelta(days=7)
+
+    orders, details = [], []
+    for order_id in shards(scale.orders)[shard]:
+        order_datetime = start + datetime.timedelta(
+            days=bisect.bisect(days, rng.random() * days[-1]),
+            hours=bisect.bisect(hours, rng.random() * hours[-1]),
+            seconds=rng.randrange(3600),
+        )
+        orders.append({
+            "order_id": order_id,
+            # the first customers order most often
+            "customer_id": int(rng.random() ** 2 * scale.customers) + 1,
+            # online orders have no employee
+            "employee_id": (
+                rng.randint(1, scale.employees)
+                if scale.employees and rng.random() < 0.7 else None
+            ),
+            "order_datetime": order_datetime,
+            "is_shipped": (
+                order_datetime < shipped_before or rng.random() < 0.5),
+        })
+        count = bisect.bisect(lines, rng.random() * lines[-1]) + 1
+        # distinct products: (order_id, product_id) is the primary key
+        for product_id in dict.fromkeys(rng.choices(
+                products, cum_weights=product_weights, k=count)):
+            details.append({
+                "order_id": order_id,
+                "product_id": product_id,
+                "quantity": rng.choices((1, 2, 3, 5), (70, 20, 7, 3))[0],
+            })
+    return orders, details
+
+
+def sqlite_bulk_load(engine: Engine):
+    @event.listens_for(engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=OFF")
+        cursor.execute("PRAGMA synchronous=OFF")
+        cursor.close()
+
+
+def generate(url: str, scale: Scale, workers: int | None = None) -> dict:
+    engine = create_engine(url)
+    if engine.dialect.name == "sqlite":
+        sqlite_bulk_load(engine)
+    Base.metadata.create_all(engine)
+    with engine.connect() as conn:
+        if conn.scalar(select(func.count()).select_from(Customer)):
+            raise SystemExit(f"{url} is not empty, generate into a new one.")
+
+    counts = dict.fromkeys(("employee", "product", "customer", "order",
+                            "order_detail"), 0)
+    start = time.perf_counter()
+    with ProcessPoolExecutor(workers) as pool:
+        # `map()` submits every shard at once and yields them in order
+        customers = pool.map(
+            generate_customers,
+            itertools.repeat(scale),
+            range(len(shards(scale.customers))),
+        )
+        orders = pool.map(
+            generate_orders,
+            itertools.repeat(scale),
+            range(len(shards(scale.orders))),
+        )
+        with engine.begin() as conn:
+            for table, rows in (
+                    (Employee, generate_employees(scale)),
+                    (Product, generate_products(scale)),
+            ):
+                if rows:
+                    conn.execute(insert(table), rows)
+                counts[table.__tablename__] += len(rows)
+        for rows in customers:
+            with engine.begin() as conn:
+                conn.execute(insert(Customer), rows)
+            counts["customer"] += len(rows)
+        for order_rows, detail_rows in orders:
+            with engine.begin() as conn:
+                conn.execute(insert(Order), order_rows)
+                conn.execute(insert(OrderDetail), detail_rows)
+            counts["order"] += len(order_rows)
+            counts["order_detail"] += len(detail_rows)
+    engine.dispose()
+    return {**counts, "seconds": time.perf_counter() - start}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--url", default="sqlite+pysqlite:///generated.db")
+    parser.add_argument("--orders", type=int, default=1_000_000)
+    parser.add_argument("--customers", type=int,
+                        help="default: a tenth of the orders")
+    parser.add_argument("--products", type=int, default=5_000)
+    parser.add_argument("--employees", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int,
+                        help="processes, default: one per CPU")
+    args = parser.parse_args()
+
+    scale = Scale(
+        seed=args.seed,
+        orders=args.orders,
+        customers=args.customers or max(args.orders // 10, 1),
+        products=args.products,
+        employees=args.employees,
+    )
+    # the email pattern is checked once here, bulk inserts skip validators
+    assert is_email_valid(generate_customers(scale, 0)[0]["email"])
+    result = generate(args.url, scale, args.workers)
+    seconds = result.pop("seconds")
+    print(", ".join(f"{count} {table}" for table, count in result.items()))
+    print(f"{seconds:.1f} s, "
+          f"{result['order'] / seconds * 60:,.0f} orders per minute")
+
+
+if __name__ == "__main__":
+    main()
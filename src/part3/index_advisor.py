@@ -0,0 +1,414 @@
+"""
+Query-driven index advisor.
+
+`IndexAdvisor.capture()` records the statements an engine executes (through
+the `before_cursor_execute` event), grouped by fingerprint. `analyze()` then
+runs `EXPLAIN QUERY PLAN` (SQLite) or `EXPLAIN (FORMAT JSON)` (PostgreSQL)
+once per fingerprint, with the captured parameters, and reports:
+
+- full scans: `SCAN <table>` in SQLite, `Seq Scan` nodes in PostgreSQL,
+- temporary sorts: `USE TEMP B-TREE` in SQLite, `Sort` nodes in PostgreSQL.
+
+For each scanned table it proposes single-column indexes on the columns the
+statement joins or filters on, unless an index (or the primary key) starts
+with them already. The proposals are created in a transaction that is rolled
+back, to measure the plan again: PostgreSQL reports the planner's total
+cost, SQLite has no cost estimate, so the statement is timed instead.
+Other databases are rejected by `capture()`: MySQL and MariaDB commit
+CREATE INDEX at once, the proposals could not be measured without adding
+them for good.
+
+`write_revision()` writes the proposals as an Alembic revision on top of the
+current head. Add `index=True` to the models as well, or autogenerate will
+drop the indexes again.
+
+Usage: python index_advisor.py [--write]
+"""
+import json
+import re
+import statistics
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Any, Iterator
+
+from alembic.config import Config
+from alembic.script import Script, ScriptDirectory
+from alembic.util import rev_id
+from profiler import fingerprint
+from sqlalchemy import (Connection, Engine, Index, MetaData,
+                        PrimaryKeyConstraint, Table, UniqueConstraint, event)
+
+# statements worth explaining; INSERTs never benefit from an index
+EXPLAINABLE = ("SELECT", "WITH", "UPDATE", "DELETE")
+DIALECTS = ("postgresql", "sqlite")
+TIMING_RUNS = 5
+
+_WHITESPACE = re.compile(r"\s+")
+# `FROM "order"`, `JOIN employee AS manager`
+_TABLE_ALIAS = re.compile(
+    r'\b(?:FROM|JOIN|UPDATE)\s+"?(\w+)"?(?:\s+AS\s+"?(\w+)"?)?',
+    re.IGNORECASE,
+)
+_COLUMN_REFERENCE = r'"?{alias}"?\.(\w+)'
+_COMPARISON = r"\s*(?:=|<|>|!=|<>|\bIN\b|\bIS\b|\bLIKE\b|\bBETWEEN\b)"
+_COMPARED_TO = r"(?:=|<|>)\s*"
+_SQLITE_SCAN = re.compile(r"^SCAN (\w+)")
+_SQLITE_AUTOMATIC = re.compile(r"^SEARCH (\w+) USING AUTOMATIC")
+
+
+@dataclass
+class CapturedStatement:
+    fingerprint: str
+    statement: str
+    parameters: Any  # of the first execution, in the DBAPI's format
+    executions: int = 0
+
+
+@dataclass
+class Plan:
+    scans: list[str]  # aliases (or table names) read in full
+    temp_sorts: list[str]
+    cost: float  # planner cost (PostgreSQL) or seconds (SQLite)
+    cost_unit: str
+
+    @property
+    def findings(self) -> list[str]:
+        return (
+            [f"full scan of {alias}" for alias in self.scans]
+            + [f"temporary sort ({detail})" for detail in self.temp_sorts]
+        )
+
+
+@dataclass(frozen=True)
+class IndexProposal:
+    table: str
+    column: str
+
+    @property
+    def name(self) -> str:
+        # SQLAlchemy's default name for `mapped_column(index=True)`
+        return f"ix_{self.table}_{self.column}"
+
+
+@dataclass
+class Analysis:
+    captured: CapturedStatement
+    before: Plan
+    proposals: list[IndexProposal] = field(default_factory=list)
+    after: Plan | None = None
+
+
+class IndexAdvisor:
+    def __init__(self, engine: Engine) -> None:
+        self.engine = engine
+        self.statements: dict[str, CapturedStatement] = {}
+
+    def _before_cursor_execute(
+            self, conn, cursor, statement, parameters, context, executemany):
+        if executemany or not statement.lstrip().upper().startswith(
+                EXPLAINABLE):
+            return
+        key = fingerprint(statement)
+        captured = self.statements.get(key)
+        if captured is None:
+            captured = self.statements[key] = CapturedStatement(
+                key, statement, parameters)
+        captured.executions += 1
+
+    @contextmanager
+    def capture(self) -> Iterator["IndexAdvisor"]:
+        check_dialect(self.engine.dialect.name)
+        event.listen(
+            self.engine, "before_cursor_execute", self._before_cursor_execute)
+        try:
+            yield self
+        finally:
+            event.remove(
+                self.engine,
+                "before_cursor_execute",
+                self._before_cursor_execute,
+            )
+
+    def analyze(self) -> list[Analysis]:
+        """Explain every fingerprint, propose indexes and measure them."""
+        with self.engine.connect() as conn:
+            metadata = MetaData()
+            metadata.reflect(conn)
+            analyses = []
+            for captured in self.statements.values():
+                analysis = Analysis(captured, explain(conn, captured))
+                analysis.proposals = propose_indexes(
+                    captured.statement, analysis.before.scans, metadata)
+                analyses.append(analysis)
+
+            proposals = unique_proposals(analyses)
+            if proposals:
+                # CREATE INDEX is transactional in SQLite and PostgreSQL:
+                # the indexes only exist until the rollback. pysqlite starts
+                # no transaction before DDL though (CREATE INDEX would be
+                # committed at once): begin one explicitly
+                conn.rollback()
+                if conn.dialect.name == "sqlite":
+                    conn.exec_driver_sql("BEGIN")
+                try:
+                    for proposal in proposals:
+                        table = metadata.tables[proposal.table]
+                        Index(proposal.name, table.c[proposal.column]).create(
+                            conn)
+                    for analysis in analyses:
+                        analysis.after = explain(conn, analysis.captured)
+                finally:
+                    conn.rollback()
+        return analyses
+
+
+def check_dialect(name: str):
+    if name not in DIALECTS:
+        raise ValueError(
+            f"The index advisor supports {', '.join(DIALECTS)}, not {name}: "
+            f"it measures the proposed indexes in a transaction rolled back "
+            f"afterwards, and CREATE INDEX commits on MySQL and MariaDB."
+        )
+
+
+def explain(conn: Connection, captured: CapturedStatement) -> Plan:
+    check_dialect(conn.dialect.name)
+    if conn.dialect.name == "postgresql":
+        return explain_postgresql(conn, captured)
+    return explain_sqlite(conn, captured)
+
+
+def explain_sqlite(conn: Connection, captured: CapturedStatement) -> Plan:
+    rows = conn.exec_driver_sql(
+        f"EXPLAIN QUERY PLAN {captured.statement}", captured.parameters
+    ).all()
+    scans, temp_sorts = [], []
+    for *_, detail in rows:
+        if match := _SQLITE_SCAN.match(detail):
+            scans.append(match.group(1))
+        elif match := _SQLITE_AUTOMATIC.match(detail):
+            # SQLite builds a transient index for every execution
+            scans.append(match.group(1))
+        if "TEMP B-TREE" in detail:
+            temp_sorts.append(detail.removeprefix("USE TEMP B-TREE ").lower())
+    return Plan(scans, temp_sorts, time_statement(conn, captured), "s")
+
+
+def time_statement(conn: Connection, captured: CapturedStatement) -> float:
+    """Median run time, for SELECTs only (others would change the data)."""
+    if not captured.statement.lstrip().upper().startswith(("SELECT", "WITH")):
+        return 0.0
+    timings = []
+    for _ in range(TIMING_RUNS):
+        start = time.perf_counter()
+        conn.exec_driver_sql(captured.statement, captured.parameters).all()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def explain_postgresql(conn: Connection, captured: CapturedStatement) -> Plan:
+    output = conn.exec_driver_sql(
+        f"EXPLAIN (FORMAT JSON) {captured.statement}", captured.parameters
+    ).scalar()
+    plan = (json.loads(output) if isinstance(output, str) else output)[0]
+    scans, temp_sorts = [], []
+
+    def visit(node: dict):
+        if node["Node Type"] == "Seq Scan":
+            scans.append(node.get("Alias", node["Relation Name"]))
+        elif node["Node Type"] in ("Sort", "Incremental Sort"):
+            temp_sorts.append(", ".join(node.get("Sort Key", [])))
+        for child in node.get("Plans", []):
+            visit(child)
+
+    visit(plan["Plan"])
+    return Plan(scans, temp_sorts, plan["Plan"]["Total Cost"], "cost")
+
+
+def table_aliases(statement: str) -> dict[str, str]:
+    """Map aliases (and table names) used in the statement to tables."""
+    aliases = {}
+    for table, alias in _TABLE_ALIAS.findall(statement):
+        aliases[alias or table] = table
+    return aliases
+
+
+def indexed_columns(table: Table) -> set[str]:
+    """Columns that already lead an index, a primary key or a unique key."""
+    keys = [
+        constraint.columns for constraint in table.constraints
+        if isinstance(constraint, (PrimaryKeyConstraint, UniqueConstraint))
+    ]
+    keys += [index.columns for index in table.indexes]
+    return {columns[0].name for columns in keys if len(columns)}
+
+
+def propose_indexes(
+        statement: str,
+        scans: list[str],
+        metadata: MetaData,
+) -> list[IndexProposal]:
+    aliases = table_aliases(statement)
+    proposals = []
+    for alias in scans:
+        table = metadata.tables.get(aliases.get(alias, alias))
+        if table is None:
+            continue
+        indexed = indexed_columns(table)
+        reference = _COLUMN_REFERENCE.format(alias=re.escape(alias))
+        # columns of join conditions and filters, on either side
+        compared = set(re.findall(
+            reference + _COMPARISON, statement, re.IGNORECASE))
+        compared.update(re.findall(
+            _COMPARED_TO + reference, statement, re.IGNORECASE))
+        for column in sorted(compared):
+            if column in table.c and column not in indexed:
+                proposals.append(IndexProposal(table.name, column))
+    return proposals
+
+
+def unique_proposals(analyses: list[Analysis]) -> list[IndexProposal]:
+    """Proposals, most executed statements first, without duplicates."""
+    weights: dict[IndexProposal, int] = defaultdict(int)
+    for analysis in analyses:
+        for proposal in analysis.proposals:
+            weights[proposal] += analysis.captured.executions
+    return sorted(weights, key=lambda proposal: -weights[proposal])
+
+
+def print_report(analyses: list[Analysis]):
+    for analysis in analyses:
+        captured, before, after = (
+            analysis.captured, analysis.before, analysis.after)
+        print(f"# {captured.fingerprint} ({captured.executions} executions)")
+        print(_WHITESPACE.sub(" ", captured.statement).strip())
+        print("  findings:", ", ".join(before.findings) or "none")
+        if analysis.proposals:
+            print("  proposed:", ", ".join(p.name for p in analysis.proposals))
+        if after is not None and before.findings:
+            change = (
+                (after.cost - before.cost) / before.cost * 100
+                if before.cost else 0.0
+            )
+            print(
+                f"  estimated: {before.cost:.6g} -> {after.cost:.6g} "
+                f"{before.cost_unit} ({change:+.0f}%), findings after: "
+                f"{', '.join(after.findings) or 'none'}"
+            )
+
+    proposals = unique_proposals(analyses)
+    print("# Proposed indexes:")
+    for proposal in proposals:
+        print(f"{proposal.name}: add index=True to "
+              f"{proposal.table}.{proposal.column}")
+    if not proposals:
+        print("none")
+
+
+def write_revision(
+        proposals: list[IndexProposal],
+        message: str = "indexes proposed by the index advisor",
+        config_file: str = "alembic.ini",
+) -> Script | None:
+    """Write an Alembic revision creating `proposals` on top of the head."""
+    script_directory = ScriptDirectory.from_config(Config(config_file))
+    upgrades = "\n    ".join(
+        f"op.create_index({p.name!r}, {p.table!r}, [{p.column!r}])"
+        for p in proposals
+    )
+    downgrades = "\n    ".join(
+        f"op.drop_index({p.name!r}, table_name={p.table!r})"
+        for p in reversed(proposals)
+    )
+    return script_directory.generate_revision(
+        rev_id(),
+        message,
+        head="head",
+        upgrades=upgrades,
+        downgrades=downgrades,
+    )
+
+
+if __name__ == "__main__":
+    # Demo: the join queries of part1/part2 (customer_orders_count(),
+    # employee_reports_to(), list_all_managers_with_employee_count()),
+    # against the part3 models on a temporary SQLite database
+    import os
+    import random
+    import sys
+    import tempfile
+
+    from models import Base, Customer, Employee, Order
+    from sqlalchemy import create_engine, desc, func, insert, select
+    from sqlalchemy.orm import Session, aliased
+
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = create_engine(
+            f"sqlite+pysqlite:///{os.path.join(tmp, 'advisor.db')}")
+        Base.metadata.create_all(engine)
+
+        random.seed(0)
+        with Session(engine) as session:
+            session.execute(insert(Employee), [
+                {"employee_id": i, "first_name": f"Employee {i}",
+                 "is_manager": i <= 50,
+                 "manager_id": None if i <= 50 else random.randint(1, 50)}
+                for i in range(1, 2001)
+            ])
+            session.execute(insert(Customer), [
+                {"first_name": f"First {i}", "last_name": f"Last {i}",
+                 "address": "", "email": f"customer{i}@example.com"}
+                for i in range(1, 5001)
+            ])
+            session.execute(insert(Order), [
+                {"customer_id": random.randint(1, 5000),
+                 "employee_id": random.randint(1, 2000)}
+                for _ in range(50_000)
+            ])
+            session.commit()
+
+        advisor = IndexAdvisor(engine)
+        manager = aliased(Employee, name="manager")
+        with advisor.capture(), Session(engine) as session:
+            # customer_orders_count()
+            session.execute(
+                select(
+                    Customer.first_name,
+                    Customer.last_name,
+                    func.count(Order.order_id).label("count"),
+                )
+                .join(Customer.orders)
+                .group_by(Customer.customer_id)
+                .having(func.count(Order.order_id) > 0)
+                .order_by(desc("count"))
+            ).all()
+            # employee_reports_to()
+            session.execute(
+                select(Employee.first_name, manager.first_name)
+                .join(manager, Employee.manager_id == manager.employee_id)
+                .where(Employee.manager_id.is_not(None))
+            ).all()
+            # list_all_managers_with_employee_count()
+            session.execute(
+                select(
+                    manager.first_name,
+                    func.count(Employee.employee_id).label("count"),
+                )
+                .join(Employee, Employee.manager_id == manager.employee_id)
+                .group_by(manager.employee_id)
+                .having(func.count(Employee.employee_id) < 4)
+                .order_by(func.count(Employee.employee_id))
+            ).all()
+            # orders of a customer, several times with other parameters
+            for customer_id in (1, 2, 3):
+                session.scalars(
+                    select(Order).where(Order.customer_id == customer_id)
+                ).all()
+
+        analyses = advisor.analyze()
+        print_report(analyses)
+        if "--write" in sys.argv:
+            script = write_revision(unique_proposals(analyses))
+            print("Revision written:", script.path if script else None)
@@ -0,0 +1,342 @@
+"""
+Load test of the sync (part3) and async product APIs, in process.
+
+Requests go through httpx's ASGI transport straight to the FastAPI app, with
+its lifespan (threadpool sizing, warm-up) run first: no server and no
+network, so the numbers show the cost of the app and the database, plus the
+client, which shares the process and the event loop.
+
+Traffic is a mix of request types, e.g. `get=80,list=15,post=5`:
+
+- get: `GET /products/{id}`, any existing product,
+- list: `GET /products`, a page of 20 among the first 50 pages,
+- post: `POST /products`, a new product.
+
+It is driven either at a fixed concurrency (`--concurrency`, a closed loop:
+each virtual user sends its next request when the previous one is answered)
+or at a fixed arrival rate (`--rate`, an open loop: requests start on
+schedule whether or not the app keeps up, and latency is measured from the
+scheduled start, so a stalled app is not hidden by fewer requests).
+
+For every request it records the status, the latency, the statements
+executed and the time spent waiting for a pooled connection (which includes
+opening new ones). Both are attributed to the request through a context
+variable: Starlette copies the context into the threadpool for sync
+endpoints, and SQLAlchemy into the greenlet for async ones.
+
+Each app runs in its own process (both have a `main`, `models`, ... module)
+with `DATABASE_URL` set. By default, that is a temporary SQLite file filled
+by generate_data.py; with `--url`, an empty database is filled the same
+way. The async app uses the async driver of the same database (aiosqlite,
+asyncpg). The apps run one after the other against the same database, so
+the products posted by the first one are there for the second one.
+
+Usage:
+    python loadtest.py [--apps sync,async] [--mix get=80,list=15,post=5]
+        [--concurrency 20 | --rate 200] [--duration 10] [--url URL]
+"""
+import argparse
+import asyncio
+import contextvars
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any
+
+import httpx
+from sqlalchemy import (URL, Engine, create_engine, event, inspect, make_url,
+                        text)
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+APP_DIRS = {
+    "sync": HERE,
+    "async": os.path.join(HERE, "..", "async"),
+}
+# sync driver -> the async driver of the same database
+ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "sqlite+pysqlite": "sqlite+aiosqlite",
+    "postgresql": "postgresql+asyncpg",
+    "postgresql+psycopg2": "postgresql+asyncpg",
+    "postgresql+psycopg": "postgresql+psycopg_async",
+}
+PAGE_SIZE = 20
+SEED_ORDERS = 10_000
+SEED_PRODUCTS = 1_000
+
+# the counters of the request being served, see `instrument()`
+current_request: contextvars.ContextVar[dict[str, Any]] = (
+    contextvars.ContextVar("current_request"))
+
+
+def instrument(engine: Engine):
+    """Count statements and time pool checkouts for `current_request`."""
+    @event.listens_for(engine, "before_cursor_execute")
+    def count_statement(
+            conn, cursor, statement, parameters, context, executemany):
+        counters = current_request.get(None)
+        if counters is not None:
+            counters["statements"] += 1
+
+    # there is no event before a checkout: time `connect()` of this pool
+    pool = engine.pool
+    pool_connect = pool.connect
+
+    def timed_connect():
+        start = time.perf_counter()
+        try:
+            return pool_connect()
+        finally:
+            counters = current_request.get(None)
+            if counters is not None:
+                counters["pool_wait"] += time.perf_counter() - start
+
+    pool.connect = timed_connect  # type: ignore[method-assign]
+
+
+def parse_mix(mix: str) -> dict[str, int]:
+    weights = {}
+    for part in mix.split(","):
+        name, _, weight = part.partition("=")
+        if name not in REQUESTS:
+            raise SystemExit(f"Unknown request type {name!r}, "
+                             f"use {', '.join(REQUESTS)}.")
+        weights[name] = int(weight or 1)
+    return weights
+
+
+def get_request(rng: random.Random, products: int) -> tuple[str, str, dict]:
+    return "GET", f"/products/{rng.randint(1, products)}", {}
+
+
+def list_request(rng: random.Random, products: int) -> tuple[str, str, dict]:
+    params = {"page": rng.randint(1, 50), "page_size": PAGE_SIZE}
+    return "GET", "/products", {"params": params}
+
+
+def post_request(rng: random.Random, products: int) -> tuple[str, str, dict]:
+    product = {
+        "product_name": f"load test {rng.getrandbits(32)}",
+        "unit_price": f"{rng.randint(1, 500)}.99",
+        "units_in_stock": rng.randint(0, 100),
+    }
+    return "POST", "/products", {"json": product}
+
+
+REQUESTS = {
+    "get": get_request,
+    "list": list_request,
+    "post": post_request,
+}
+
+
+class LoadTest:
+    def __init__(
+            self,
+            client: httpx.AsyncClient,
+            mix: dict[str, int],
+            products: int,
+    ) -> None:
+        self.client = client
+        self.names = list(mix)
+        self.weights = list(mix.values())
+        self.products = products
+        # (request type, status, latency, statements, pool wait)
+        self.samples: list[tuple[str, int, float, int, float]] = []
+
+    async def send(self, rng: random.Random, start: float | None = None):
+        name = rng.choices(self.names, self.weights)[0]
+        method, url, kwargs = REQUESTS[name](rng, self.products)
+        counters = {"statements": 0, "pool_wait": 0.0}
+        current_request.set(counters)
+        if start is None:
+            start = time.perf_counter()
+        response = await self.client.request(method, url, **kwargs)
+        self.samples.append((
+            name,
+            response.status_code,
+            time.perf_counter() - start,
+            counters["statements"],
+            counters["pool_wait"],
+        ))
+
+    async def closed_loop(self, concurrency: int, duration: float):
+        deadline = time.perf_counter() + duration
+
+        async def user(number: int):
+            rng = random.Random(number)
+            while time.perf_counter() < deadline:
+                await self.send(rng)
+
+        await asyncio.gather(*(user(n) for n in range(concurrency)))
+
+    async def open_loop(self, rate: float, duration: float):
+        rng = random.Random(0)
+        tasks = []
+        start = time.perf_counter()
+        for n in range(int(rate * duration)):
+            scheduled = start + n / rate
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            # the task copies the context: `current_request` is per request
+            tasks.append(asyncio.create_task(self.send(
+                random.Random(rng.getrandbits(64)), scheduled)))
+        await asyncio.gather(*tasks)
+
+
+def summarize(samples: list[tuple], elapsed: float) -> dict[str, Any]:
+    result: dict[str, Any] = {
+        "requests": len(samples),
+        "throughput": len(samples) / elapsed,
+        "types": {},
+    }
+    for name in sorted({sample[0] for sample in samples}):
+        own = [sample for sample in samples if sample[0] == name]
+        latencies = sorted(sample[2] * 1000 for sample in own)
+        statuses: dict[str, int] = {}
+        for sample in own:
+            statuses[str(sample[1])] = statuses.get(str(sample[1]), 0) + 1
+        result["types"][name] = {
+            "requests": len(own),
+            "statuses": statuses,
+            "p50_ms": percentile(latencies, 0.50),
+            "p95_ms": percentile(latencies, 0.95),
+            "p99_ms": percentile(latencies, 0.99),
+            "statements": statistics.fmean(sample[3] for sample in own),
+            "pool_wait_ms": statistics.fmean(
+                sample[4] * 1000 for sample in own),
+        }
+    return result
+
+
+def percentile(ordered: list[float], fraction: float) -> float:
+    index = min(len(ordered) - 1, int(fraction * len(ordered)))
+    return ordered[index]
+
+
+async def run_app(args: argparse.Namespace) -> dict[str, Any]:
+    """Load test the app of the current directory, in this process."""
+    sys.path.insert(0, os.getcwd())
+    import main
+    import models
+
+    instrument(getattr(models.engine, "sync_engine", models.engine))
+    async with main.app.router.lifespan_context(main.app):
+        async with httpx.AsyncClient(
+                transport=httpx.ASGITransport(app=main.app),
+                base_url="http://testserver",
+        ) as client:
+            test = LoadTest(client, parse_mix(args.mix), args.products)
+            start = time.perf_counter()
+            if args.rate:
+                await test.open_loop(args.rate, args.duration)
+            else:
+                await test.closed_loop(args.concurrency, args.duration)
+            elapsed = time.perf_counter() - start
+    return summarize(test.samples, elapsed)
+
+
+def async_url(url: URL) -> URL:
+    return url.set(drivername=ASYNC_DRIVERS.get(url.drivername,
+                                                url.drivername))
+
+
+def prepare(url: URL) -> int:
+    """Fill the database if it is empty, return the number of products."""
+    engine = create_engine(url)
+    if not inspect(engine).has_table("product"):
+        import generate_data
+        generate_data.generate(str(url), generate_data.Scale(
+            seed=0,
+            orders=SEED_ORDERS,
+            customers=SEED_ORDERS // 10,
+            products=SEED_PRODUCTS,
+            employees=50,
+        ))
+    with engine.connect() as conn:
+        products = conn.scalar(text("SELECT max(product_id) FROM product"))
+    engine.dispose()
+    if not products:
+        raise SystemExit(f"{url!r} has no products.")
+    return products
+
+
+def report(results: dict[str, dict[str, Any]]):
+    print(f"{'app':<6} {'type':<5} {'requests':>8} {'req/s':>7} "
+          f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'stmts':>6} "
+          f"{'pool ms':>8}  statuses")
+    for app, result in results.items():
+        print(f"{app:<6} {'all':<5} {result['requests']:>8} "
+              f"{result['throughput']:>7.0f}")
+        for name, stats in result["types"].items():
+            print(
+                f"{'':<6} {name:<5} {stats['requests']:>8} {'':>7} "
+                f"{stats['p50_ms']:>8.2f} {stats['p95_ms']:>8.2f} "
+                f"{stats['p99_ms']:>8.2f} {stats['statements']:>6.1f} "
+                f"{stats['pool_wait_ms']:>8.3f}  "
+                + " ".join(f"{status}:{count}" for status, count
+                           in sorted(stats["statuses"].items()))
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--apps", default="sync,async")
+    parser.add_argument("--mix", default="get=80,list=15,post=5")
+    load = parser.add_mutually_exclusive_group()
+    load.add_argument("--concurrency", type=int, default=20)
+    load.add_argument("--rate", type=float, help="requests per second")
+    parser.add_argument("--duration", type=float, default=10,
+                        help="seconds per app")
+    parser.add_argument("--url", help="sync URL of the database, "
+                                      "default: a temporary SQLite file")
+    parser.add_argument("--output", help="write the results as JSON")
+    # used by the parent process to start an app process
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    parser.add_argument("--products", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    parse_mix(args.mix)
+
+    if args.worker:
+        result = asyncio.run(run_app(args))
+        with open(args.worker, "w") as f:
+            json.dump(result, f)
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        url = make_url(
+            args.url or f"sqlite+pysqlite:///{os.path.join(tmp, 'load.db')}")
+        products = prepare(url)
+        results = {}
+        for app in args.apps.split(","):
+            result_file = os.path.join(tmp, f"{app}.json")
+            app_url = async_url(url) if app == "async" else url
+            subprocess.run(
+                [sys.executable, os.path.abspath(__file__), *sys.argv[1:],
+                 "--worker", result_file, "--products", str(products)],
+                cwd=APP_DIRS[app],
+                env={**os.environ, "DATABASE_URL":
+                     app_url.render_as_string(hide_password=False)},
+                stdout=subprocess.DEVNULL,  # validators print
+                check=True,
+            )
+            with open(result_file) as f:
+                results[app] = json.load(f)
+
+    mode = (f"{args.rate:g} requests/s" if args.rate
+            else f"{args.concurrency} concurrent users")
+    print(f"# {args.mix}, {mode}, {args.duration:g} s per app")
+    report(results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
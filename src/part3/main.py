@@ -2,13 +2,65 @@
 Code for Chapter 15:
 SQLAlchemy Integration with FastAPI.
 """
+from contextlib import asynccontextmanager
+
+import bulk_import
 import crud
+import etag
+import export
 import schemas
-from fastapi import Depends, FastAPI
-from models import SessionMaker
+import structured_logging
+import warmup
+from concurrency import AdmissionMiddleware, ConcurrencyGovernor
+from fastapi import (Depends, FastAPI, Header, HTTPException, Query, Request,
+                     Response)
+from fastapi.responses import JSONResponse
+from cache_stats import SQL_CACHE_STATS, cache_stats
+from models import SessionMaker, engine
+from profiler import profiler
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
 from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+
+governor = ConcurrencyGovernor(engine)
+profiler.install(engine)
+if SQL_CACHE_STATS:
+    cache_stats.install(engine)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # no more threads for sync endpoints than pooled connections
+    governor.configure_threadpool()
+    # fill the pool and the compiled cache before serving requests, in a
+    # worker thread: the sync warm-up would block the event loop
+    await run_in_threadpool(warmup.warm_up)
+    # sampled statement log, written as JSON off the request threads
+    listener = None
+    if structured_logging.SQL_LOG_RATE > 0:
+        listener = structured_logging.setup_statement_logging(
+            engine, structured_logging.SQL_LOG_RATE)
+    yield
+    if listener is not None:
+        structured_logging.stop_statement_logging(engine, listener)
+
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(
+    AdmissionMiddleware,
+    governor=governor,
+    exclude=("/metrics/admission", "/admin/profiler", "/admin/cache"),
+)
+
 
-app = FastAPI()
+@app.exception_handler(PoolTimeoutError)
+def pool_timeout_handler(request: Request, exc: PoolTimeoutError):
+    # no connection became available within `POOL_TIMEOUT`
+    return JSONResponse(
+        {"detail": "No database connection available, try again later."},
+        status_code=503,
+        headers={"Retry-After": str(governor.retry_after)},
+    )
 
 
 # Dependency Injection
@@ -22,6 +74,36 @@ def root():
     return {"message": "Product API"}
 
 
+@app.get("/metrics/admission")
+async def admission_metrics():
+    return governor.metrics()
+
+
+@app.get("/admin/profiler")
+async def profiler_report(top: int = 20):
+    """Statement statistics of this process, slowest in total first."""
+    return profiler.report(top)
+
+
+@app.delete("/admin/profiler", status_code=204)
+async def reset_profiler():
+    profiler.reset()
+
+
+@app.get("/admin/cache")
+async def cache_report():
+    """Compiled cache outcomes per call site, set `SQL_CACHE_STATS=1`."""
+    if not SQL_CACHE_STATS:
+        raise HTTPException(
+            status_code=404, detail="Set SQL_CACHE_STATS=1 to enable.")
+    return cache_stats.report()
+
+
+@app.delete("/admin/cache", status_code=204)
+async def reset_cache_stats():
+    cache_stats.reset()
+
+
 @app.post("/products", status_code=201, response_model=schemas.ProductOutput)
 def create_product(
     product: schemas.ProductInput,
@@ -30,20 +112,59 @@ def create_product(
     return crud.create_product(session, product)
 
 
+@app.post("/products/bulk", response_model=schemas.ImportResult)
+async def bulk_import_products(
+    request: Request,
+    session: Session = Depends(get_session),
+):
+    """Import products from an NDJSON body, one product per line."""
+    return await bulk_import.import_products(request.stream(), session)
+
+
+# declared before `/products/{product_id}` so "export" is not taken as an ID
+@app.get("/products/export")
+def export_products(fmt: str = Query("ndjson", alias="format")):
+    return export.export_response(export.products_stmt(), fmt, "products")
+
+
+@app.get("/orders/export")
+def export_orders(fmt: str = Query("ndjson", alias="format")):
+    return export.export_response(export.orders_stmt(), fmt, "orders")
+
+
 @app.get("/products/{product_id}", response_model=schemas.ProductOutput)
 def get_product(
     product_id: int,
+    response: Response,
+    if_none_match: str | None = Header(None),
     session: Session = Depends(get_session),
 ):
-    return crud.get_product(session, product_id)
+    # conditional GET: compare versions without loading the product
+    if if_none_match is not None:
+        version = etag.get_product_version(session, product_id)
+        if version is not None:
+            tag = etag.make_etag(product_id, version)
+            if etag.etag_matches(if_none_match, tag):
+                return Response(status_code=304, headers={"ETag": tag})
+
+    product = crud.get_product(session, product_id)
+    if product is None:
+        raise HTTPException(status_code=404, detail="Product not found.")
+    etag.version_cache.set(product.product_id, product.version_id)
+    response.headers["ETag"] = etag.make_etag(
+        product.product_id, product.version_id)
+    return product
 
 
-@app.get("/products", response_model=list[schemas.ProductOutput])
+@app.get("/products", response_model=schemas.ProductPage)
 def get_products(
     page: int = 1,
     page_size: int = 3,
     order_by: str = "product_id",
     direction: str = "asc",
+    total: str = "none",
+    q: str | None = None,
     session: Session = Depends(get_session),
 ):
-    return crud.get_products(session, page, page_size, order_by, direction)
+    return crud.get_products(
+        session, page, page_size, order_by, direction, total, q)
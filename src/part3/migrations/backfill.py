@@ -0,0 +1,282 @@
+"""
+Chunked, throttled backfills for data migrations.
+
+A single `UPDATE employee SET ...` on a large table holds its locks until
+the whole table is rewritten. `backfill()` updates the table in primary key
+ranges instead, committing after every chunk:
+
+- the chunk size adapts so each chunk takes about `target_seconds`,
+- after each chunk it sleeps `pause_ratio` times as long as the chunk took,
+  leaving room for the application's own queries,
+- the last finished PK is saved in the `backfill_checkpoint` table, so an
+  interrupted backfill resumes where it stopped,
+- progress (rows, percentage, rate, ETA) is logged after every chunk.
+
+Chunks may run again after an interruption, so the update must be
+idempotent, e.g., restricted by `where` to rows that still need it.
+
+Usage in a migration (the autocommit block commits every statement, see
+`MigrationContext.autocommit_block()`):
+
+    from migrations.backfill import backfill
+
+    def upgrade() -> None:
+        op.add_column("employee", sa.Column("full_name", sa.String(255)))
+        with op.get_context().autocommit_block():
+            backfill(
+                op.get_bind(),
+                "employee",
+                {"full_name": sa.text("first_name || ' ' || last_name")},
+                where=sa.text("full_name IS NULL"),
+                pk="employee_id",
+                checkpoint="employee_full_name",
+            )
+"""
+import datetime
+import logging
+import time
+from dataclasses import dataclass
+from typing import Any, Callable
+
+import sqlalchemy as sa
+from sqlalchemy import Connection
+
+logger = logging.getLogger("alembic.backfill")
+
+checkpoint_table = sa.Table(
+    "backfill_checkpoint",
+    sa.MetaData(),
+    sa.Column("name", sa.String(127), primary_key=True),
+    sa.Column("last_pk", sa.BigInteger, nullable=False),
+    sa.Column("updated_at", sa.DateTime, nullable=False),
+)
+
+
+@dataclass
+class BackfillProgress:
+    """State of a backfill, passed to the progress callback."""
+    name: str
+    first_pk: int
+    last_pk: int  # last PK that was processed
+    max_pk: int
+    resumed_pk: int  # `last_pk` when this run started
+    rows: int = 0
+    chunks: int = 0
+    chunk_size: int = 0
+    chunk_seconds: float = 0.0
+    elapsed: float = 0.0
+    done: bool = False
+
+    @property
+    def fraction(self) -> float:
+        total = self.max_pk - self.first_pk
+        return 1.0 if total <= 0 else (self.last_pk - self.first_pk) / total
+
+    @property
+    def rows_per_second(self) -> float:
+        return self.rows / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def eta(self) -> float | None:
+        """Seconds left, extrapolated from the PK range done in this run."""
+        done = self.last_pk - self.resumed_pk
+        if done <= 0 or self.done:
+            return None
+        return self.elapsed * (self.max_pk - self.last_pk) / done
+
+
+def log_progress(progress: BackfillProgress):
+    if progress.done:
+        logger.info(
+            "%s: done, %d rows in %.1fs",
+            progress.name, progress.rows, progress.elapsed,
+        )
+        return
+
+    eta = progress.eta
+    logger.info(
+        "%s: %.1f%% (pk %d/%d), %d rows, %.0f rows/s, chunk %d in %.3fs%s",
+        progress.name,
+        progress.fraction * 100,
+        progress.last_pk,
+        progress.max_pk,
+        progress.rows,
+        progress.rows_per_second,
+        progress.chunk_size,
+        progress.chunk_seconds,
+        "" if eta is None else f", ETA {eta:.0f}s",
+    )
+
+
+def _commit(connection: Connection):
+    # in autocommit mode every statement is already committed
+    options = connection.get_execution_options()
+    if options.get("isolation_level") != "AUTOCOMMIT":
+        connection.commit()
+
+
+def load_checkpoint(connection: Connection, name: str) -> int | None:
+    checkpoint_table.create(connection, checkfirst=True)
+    return connection.scalar(
+        sa.select(checkpoint_table.c.last_pk)
+        .where(checkpoint_table.c.name == name)
+    )
+
+
+def save_checkpoint(connection: Connection, name: str, last_pk: int):
+    values = {"last_pk": last_pk, "updated_at": datetime.datetime.now()}
+    result = connection.execute(
+        sa.update(checkpoint_table)
+        .where(checkpoint_table.c.name == name)
+        .values(**values)
+    )
+    if result.rowcount == 0:
+        connection.execute(
+            sa.insert(checkpoint_table).values(name=name, **values))
+
+
+def clear_checkpoint(connection: Connection, name: str):
+    connection.execute(
+        sa.delete(checkpoint_table).where(checkpoint_table.c.name == name))
+
+
+def backfill(
+        connection: Connection,
+        table: str,
+        values: dict[str, Any],
+        where: Any = None,
+        pk: str = "id",
+        checkpoint: str | None = None,
+        chunk_size: int = 10_000,
+        min_chunk_size: int = 100,
+        max_chunk_size: int = 100_000,
+        target_seconds: float = 0.5,
+        pause_ratio: float = 0.5,
+        max_chunks: int | None = None,
+        progress: Callable[[BackfillProgress], None] = log_progress,
+) -> BackfillProgress:
+    """
+    Run `UPDATE table SET values WHERE where` in chunks of consecutive
+    primary key ranges of the integer column `pk`, committing each chunk.
+
+    `values` maps column names to values or SQL expressions. `checkpoint`
+    names the saved position (defaults to the table name); it is removed
+    once the backfill is complete. `max_chunks` stops after that many chunks,
+    to spread a backfill over several runs.
+    """
+    name = checkpoint or table
+    target = sa.table(table, sa.column(pk), *(sa.column(c) for c in values))
+    pk_column = target.c[pk]
+
+    first_pk, max_pk = connection.execute(
+        sa.select(sa.func.min(pk_column), sa.func.max(pk_column))
+    ).one()
+    resumed_pk = load_checkpoint(connection, name)
+    _commit(connection)
+
+    start_pk = (first_pk or 0) - 1 if resumed_pk is None else resumed_pk
+    state = BackfillProgress(
+        name=name,
+        first_pk=(first_pk or 0) - 1,
+        last_pk=start_pk,
+        max_pk=max_pk or 0,
+        resumed_pk=start_pk,
+        chunk_size=chunk_size,
+    )
+    if resumed_pk is not None:
+        logger.info("%s: resuming after pk %d", name, resumed_pk)
+
+    started = time.perf_counter()
+    while state.last_pk < state.max_pk:
+        if max_chunks is not None and state.chunks >= max_chunks:
+            break
+
+        upper_pk = min(state.last_pk + state.chunk_size, state.max_pk)
+        stmt = (
+            sa.update(target)
+            .where(pk_column > state.last_pk, pk_column <= upper_pk)
+            .values(**values)
+        )
+        if where is not None:
+            stmt = stmt.where(where)
+
+        chunk_started = time.perf_counter()
+        result = connection.execute(stmt)
+        save_checkpoint(connection, name, upper_pk)
+        _commit(connection)
+        chunk_seconds = time.perf_counter() - chunk_started
+
+        state.rows += max(result.rowcount, 0)
+        state.chunks += 1
+        state.last_pk = upper_pk
+        state.chunk_seconds = chunk_seconds
+        state.elapsed = time.perf_counter() - started
+        progress(state)
+
+        # throttle: adapt the chunk size to the measured latency ...
+        if chunk_seconds > target_seconds:
+            state.chunk_size = max(min_chunk_size, state.chunk_size // 2)
+        elif chunk_seconds < target_seconds / 2:
+            state.chunk_size = min(max_chunk_size, state.chunk_size * 2)
+        # ... and give other transactions time to run
+        if pause_ratio > 0:
+            time.sleep(chunk_seconds * pause_ratio)
+
+    if state.last_pk >= state.max_pk:
+        clear_checkpoint(connection, name)
+        _commit(connection)
+        state.done = True
+        state.elapsed = time.perf_counter() - started
+        progress(state)
+
+    return state
+
+
+if __name__ == "__main__":
+    # Demo: backfill `employee.last_name` on a large SQLite table,
+    # interrupted after a few chunks and then resumed.
+    # Usage: python -m migrations.backfill [rows]
+    import os
+    import sys
+    import tempfile
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 5_000_000
+
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = sa.create_engine(
+            f"sqlite+pysqlite:///{os.path.join(tmp, 'backfill.db')}")
+        with engine.connect() as conn:
+            conn.exec_driver_sql(
+                "CREATE TABLE employee ("
+                "employee_id INTEGER PRIMARY KEY, "
+                "first_name VARCHAR(127) NOT NULL, "
+                "last_name VARCHAR(127))"
+            )
+            print(f"Inserting {rows} employees...")
+            conn.exec_driver_sql(
+                "WITH RECURSIVE n(i) AS "
+                f"(SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < {rows}) "
+                "INSERT INTO employee (first_name) "
+                "SELECT 'employee ' || i FROM n"
+            )
+            conn.commit()
+
+            arguments = dict(
+                table="employee",
+                values={"last_name": sa.text("upper(first_name)")},
+                where=sa.text("last_name IS NULL"),
+                pk="employee_id",
+                checkpoint="employee_last_name",
+                chunk_size=50_000,
+                target_seconds=0.2,
+                pause_ratio=0.1,
+            )
+            print("# Interrupted after 3 chunks:")
+            backfill(conn, max_chunks=3, **arguments)
+            print("# Resumed:")
+            backfill(conn, **arguments)
+
+            remaining = conn.scalar(sa.text(
+                "SELECT count(*) FROM employee WHERE last_name IS NULL"))
+            print("Rows left to backfill:", remaining)
@@ -0,0 +1,35 @@
+"""product version
+
+Revision ID: b3e1c7d9a2f4
+Revises: 57a71507107f
+Create Date: 2026-10-19 10:12:41.305127
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b3e1c7d9a2f4'
+down_revision: Union[str, None] = '57a71507107f'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # existing rows start at version 1
+    op.add_column(
+        'product',
+        sa.Column(
+            'version_id',
+            sa.Integer(),
+            server_default='1',
+            nullable=False,
+        ),
+    )
+
+
+def downgrade() -> None:
+    op.drop_column('product', 'version_id')
@@ -0,0 +1,124 @@
+"""manager table
+
+Revision ID: d7c2e9f14a38
+Revises: b3e1c7d9a2f4
+Create Date: 2026-10-19 11:02:17.514806
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd7c2e9f14a38'
+down_revision: Union[str, None] = 'b3e1c7d9a2f4'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+# A materialized version of the `manager` view (see
+# f56ad6119ef3_manager_view.py.tmp), kept up to date by triggers on `employee`.
+COLUMNS = 'id, first_name, last_name, hire_date'
+VALUES = 'NEW.employee_id, NEW.first_name, NEW.last_name, NEW.hire_date'
+
+SQL_CREATE_TRIGGERS = {
+    'sqlite': [
+        f'''
+        CREATE TRIGGER manager_insert AFTER INSERT ON employee
+        WHEN NEW.is_manager
+        BEGIN
+            INSERT INTO manager ({COLUMNS}) VALUES ({VALUES});
+        END
+        ''',
+        f'''
+        CREATE TRIGGER manager_update AFTER UPDATE ON employee
+        WHEN OLD.is_manager OR NEW.is_manager
+        BEGIN
+            DELETE FROM manager WHERE id = OLD.employee_id;
+            INSERT INTO manager ({COLUMNS})
+            SELECT {VALUES} WHERE NEW.is_manager;
+        END
+        ''',
+        '''
+        CREATE TRIGGER manager_delete AFTER DELETE ON employee
+        WHEN OLD.is_manager
+        BEGIN
+            DELETE FROM manager WHERE id = OLD.employee_id;
+        END
+        ''',
+    ],
+    'postgresql': [
+        f'''
+        CREATE FUNCTION manager_sync() RETURNS trigger
+        LANGUAGE plpgsql AS $$
+        BEGIN
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                DELETE FROM manager WHERE id = OLD.employee_id;
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') AND NEW.is_manager THEN
+                INSERT INTO manager ({COLUMNS}) VALUES ({VALUES});
+            END IF;
+            RETURN NULL;
+        END
+        $$
+        ''',
+        '''
+        CREATE TRIGGER manager_insert AFTER INSERT ON employee
+        FOR EACH ROW WHEN (NEW.is_manager)
+        EXECUTE FUNCTION manager_sync()
+        ''',
+        '''
+        CREATE TRIGGER manager_update AFTER UPDATE ON employee
+        FOR EACH ROW WHEN (OLD.is_manager OR NEW.is_manager)
+        EXECUTE FUNCTION manager_sync()
+        ''',
+        '''
+        CREATE TRIGGER manager_delete AFTER DELETE ON employee
+        FOR EACH ROW WHEN (OLD.is_manager)
+        EXECUTE FUNCTION manager_sync()
+        ''',
+    ],
+}
+SQL_DROP_TRIGGERS = {
+    'sqlite': [
+        'DROP TRIGGER IF EXISTS manager_insert',
+        'DROP TRIGGER IF EXISTS manager_update',
+        'DROP TRIGGER IF EXISTS manager_delete',
+    ],
+    'postgresql': [
+        'DROP TRIGGER IF EXISTS manager_insert ON employee',
+        'DROP TRIGGER IF EXISTS manager_update ON employee',
+        'DROP TRIGGER IF EXISTS manager_delete ON employee',
+        'DROP FUNCTION IF EXISTS manager_sync',
+    ],
+}
+SQL_FILL_MANAGER = f'''
+    INSERT INTO manager ({COLUMNS})
+    SELECT employee_id, first_name, last_name, hire_date
+    FROM employee
+    WHERE is_manager
+'''
+
+
+def upgrade() -> None:
+    op.create_table(
+        'manager',
+        sa.Column('id', sa.Integer(), autoincrement=False, nullable=False),
+        sa.Column('first_name', sa.String(length=127), nullable=False),
+        sa.Column('last_name', sa.String(length=127), nullable=True),
+        sa.Column('hire_date', sa.Date(), nullable=False),
+        sa.PrimaryKeyConstraint('id'),
+    )
+    # in the same transaction (where DDL is transactional, as in PostgreSQL),
+    # so no change to `employee` is missed between filling and the triggers
+    op.execute(SQL_FILL_MANAGER)
+    for statement in SQL_CREATE_TRIGGERS[op.get_bind().dialect.name]:
+        op.execute(statement)
+
+
+def downgrade() -> None:
+    for statement in SQL_DROP_TRIGGERS[op.get_bind().dialect.name]:
+        op.execute(statement)
+    op.drop_table('manager')
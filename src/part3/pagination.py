@@ -0,0 +1,95 @@
+"""
+Row counts for paginated listings.
+
+A `SELECT count(*)` on every page doubles the cost of a listing on large
+tables, so the total of a page can be computed in one of these ways:
+
+- exact: a `count(*) OVER ()` window added to the page query itself,
+- estimated: the planner statistics (PostgreSQL `pg_class.reltuples`,
+  SQLite `sqlite_stat1` after ANALYZE), falling back to "cached",
+- cached: an exact count that is refreshed at most every `COUNT_CACHE_TTL`
+  seconds.
+"""
+import time
+
+from sqlalchemy import FromClause, Table, func, select, text
+from sqlalchemy.orm import Session
+
+TOTAL_MODES = ("none", "exact", "estimated", "cached")
+
+COUNT_CACHE_TTL = 60  # seconds
+
+# table name -> (expiry time, row count)
+_count_cache: dict[str, tuple[float, int]] = {}
+
+
+def exact_count(session: Session, table: FromClause) -> int:
+    return session.scalar(select(func.count()).select_from(table))
+
+
+def estimated_count(session: Session, table: Table) -> int | None:
+    """
+    Row count estimated from the database statistics, or None if the
+    database has no statistics for the table.
+    """
+    dialect = session.get_bind().dialect.name
+
+    if dialect == "postgresql":
+        estimate = session.scalar(
+            text(
+                "SELECT reltuples::bigint FROM pg_class "
+                "WHERE oid = to_regclass(:name)"
+            ),
+            {"name": table.name},
+        )
+        # -1: the table was never vacuumed or analyzed
+        if estimate is None or estimate < 0:
+            return None
+        return estimate
+
+    if dialect == "sqlite":
+        has_stats = session.scalar(
+            text(
+                "SELECT 1 FROM sqlite_master "
+                "WHERE type = 'table' AND name = 'sqlite_stat1'"
+            )
+        )
+        if not has_stats:
+            return None
+        # the first number of each `stat` row is the number of rows
+        stat = session.scalar(
+            text("SELECT stat FROM sqlite_stat1 WHERE tbl = :name LIMIT 1"),
+            {"name": table.name},
+        )
+        if stat is None:
+            return None
+        return int(stat.split()[0])
+
+    return None
+
+
+def cached_count(
+        session: Session,
+        table: Table,
+        ttl: float = COUNT_CACHE_TTL,
+) -> int:
+    now = time.monotonic()
+    cached = _count_cache.get(table.name)
+    if cached is not None and cached[0] > now:
+        return cached[1]
+
+    count = exact_count(session, table)
+    _count_cache[table.name] = (now + ttl, count)
+    return count
+
+
+def total_count(session: Session, table: Table, mode: str) -> int | None:
+    """Row count of `table` for the "estimated" and "cached" modes."""
+    if mode == "estimated":
+        estimate = estimated_count(session, table)
+        if estimate is not None:
+            return estimate
+        return cached_count(session, table)
+    if mode == "cached":
+        return cached_count(session, table)
+    return None
@@ -0,0 +1,151 @@
+"""
+Startup profiling for the FastAPI service.
+
+Measures, in a fresh Python process each time, how long a worker takes to
+become ready:
+
+- import: importing `models` (engine, declarative classes and metadata) and
+  then `main` (FastAPI, schemas and routes),
+- configure_mappers: mapper configuration, otherwise done by the first query,
+- metadata: compiling the DDL of all tables (what `create_all()` builds),
+- first query and first request: the first `session.get()` and the first
+  `GET /products/1` through the ASGI app.
+
+The heaviest modules reported by `python -X importtime` are listed as well.
+
+Configured mappers cannot be serialized (only `MetaData` can be pickled, and
+the declarative classes rebuild it on import anyway), so `--preload`
+compares a cold worker with a worker forked from a master process that has
+run `warmup.preload()`, like `gunicorn --preload` does. The forked worker
+inherits the imported modules, the configured mappers and the compiled
+cache, and only has to open its own connections.
+
+Usage: python profile_startup.py [--preload] [runs]
+"""
+import json
+import multiprocessing
+import statistics
+import subprocess
+import sys
+import time
+
+PHASES = '''
+import json, time
+timings = {}
+start = time.perf_counter()
+import models
+timings["import models"] = time.perf_counter() - start
+
+start = time.perf_counter()
+import main
+timings["import main"] = time.perf_counter() - start
+
+from sqlalchemy.orm import configure_mappers
+start = time.perf_counter()
+configure_mappers()
+timings["configure_mappers"] = time.perf_counter() - start
+
+from sqlalchemy.schema import CreateTable
+start = time.perf_counter()
+for table in models.Base.metadata.sorted_tables:
+    CreateTable(table).compile(dialect=models.engine.dialect)
+timings["metadata"] = time.perf_counter() - start
+
+start = time.perf_counter()
+with models.SessionMaker() as session:
+    session.get(models.Product, 1)
+timings["first query"] = time.perf_counter() - start
+
+from fastapi.testclient import TestClient
+client = TestClient(main.app)  # not entered: the lifespan is not run
+start = time.perf_counter()
+client.get("/products/1")
+timings["first request"] = time.perf_counter() - start
+print(json.dumps(timings))
+'''
+
+
+def run_phases() -> dict[str, float]:
+    output = subprocess.run(
+        [sys.executable, "-c", PHASES],
+        capture_output=True,
+        check=True,
+        text=True,
+    ).stdout
+    # the engine echoes SQL, the result is the last line
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def heaviest_imports(limit: int = 10) -> list[tuple[int, str]]:
+    """(cumulative microseconds, module) of the slowest imports of `main`."""
+    stderr = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import main"],
+        capture_output=True,
+        check=True,
+        text=True,
+    ).stderr
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, module = line.split("|")
+        imports.append((int(cumulative), module.strip()))
+    return sorted(imports, reverse=True)[:limit]
+
+
+def ready_time(queue: multiprocessing.Queue, started: float):
+    """Worker body: serve the first request and report when it is done."""
+    import main
+    import warmup
+    from fastapi.testclient import TestClient
+
+    warmup.after_fork()
+    TestClient(main.app).get("/products/1")
+    # wall clock time, comparable between processes
+    queue.put(time.time() - started)
+
+
+def start_worker(method: str) -> float:
+    context = multiprocessing.get_context(method)
+    queue = context.Queue()
+    process = context.Process(target=ready_time, args=(queue, time.time()))
+    process.start()
+    elapsed = queue.get()
+    process.join()
+    return elapsed
+
+
+def compare_preload(runs: int):
+    # cold: a fresh interpreter that has to import everything
+    cold = [start_worker("spawn") for _ in range(runs)]
+
+    # preloaded: the master imports and warms up once, then forks
+    import warmup
+    warmup.preload()
+    preloaded = [start_worker("fork") for _ in range(runs)]
+
+    print(f"# time to first response ({runs} runs, median):")
+    print(f"{'cold worker':<24}: {statistics.median(cold) * 1000:8.2f} ms")
+    print(f"{'preloaded fork':<24}: "
+          f"{statistics.median(preloaded) * 1000:8.2f} ms")
+
+
+def main(runs: int = 5):
+    results = [run_phases() for _ in range(runs)]
+    print(f"# startup phases ({runs} runs, median):")
+    for phase in results[0]:
+        seconds = statistics.median(r[phase] for r in results)
+        print(f"{phase:<24}: {seconds * 1000:8.2f} ms")
+
+    print("# heaviest imports of main (cumulative):")
+    for microseconds, module in heaviest_imports():
+        print(f"{module:<24}: {microseconds / 1000:8.2f} ms")
+
+
+if __name__ == "__main__":
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    runs = int(args[0]) if args else 5
+    if "--preload" in sys.argv:
+        compare_preload(runs)
+    else:
+        main(runs)
@@ -0,0 +1,248 @@
+"""
+Statement-level profiler and slow-query log, a cheap replacement for
+`echo=True` in production.
+
+`before_cursor_execute`/`after_cursor_execute` listeners (see events.py)
+time every statement. The hot path only appends a tuple to a ring buffer
+(`collections.deque` with `maxlen`, whose `append()` is atomic: no lock is
+taken); fingerprints, latency histograms, call counts and row counts are
+computed from the buffer when a report is requested. Statements slower than
+`SLOW_QUERY_MS` are logged with their parameters on the `slow_query` logger.
+
+Statements are normalized into fingerprints: whitespace collapsed, literals
+and expanded `IN` lists replaced, so the same query with other values is
+counted once. Normalizing is cached per statement string, since SQLAlchemy's
+compiled cache hands out the same strings again and again.
+
+Row counts are the DBAPI's `cursor.rowcount`: rows changed by INSERT,
+UPDATE and DELETE; drivers report -1 for SELECTs, which are not counted.
+
+Settings come from the environment: `PROFILER_RING_SIZE` (executions kept)
+and `SLOW_QUERY_MS` (threshold in milliseconds).
+
+Run python profiler.py to measure the overhead on an in-memory database. On
+the ORM path of the service it is within the noise (about 1%). On a bare
+Core primary key lookup it is a few microseconds, mostly SQLAlchemy's event
+dispatch itself: listeners that do nothing cost about as much.
+"""
+import bisect
+import hashlib
+import logging
+import os
+import re
+import statistics
+import time
+from collections import deque
+from typing import Any
+
+from sqlalchemy import Engine, event
+
+RING_SIZE = int(os.environ.get("PROFILER_RING_SIZE", 100_000))
+SLOW_QUERY_MS = float(os.environ.get("SLOW_QUERY_MS", 100))
+NORMALIZED_CACHE_SIZE = 10_000
+
+# upper bounds of the latency histogram buckets, in milliseconds
+HISTOGRAM_BOUNDS_MS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250,
+                       500, 1000, float("inf"))
+
+slow_query_logger = logging.getLogger("slow_query")
+
+_WHITESPACE = re.compile(r"\s+")
+# expanded IN lists, e.g. `IN (?, ?, ?)` or `IN (%(id_1_1)s, %(id_1_2)s)`
+_IN_LIST = re.compile(r"\bIN \((?:[^()]*)\)", re.IGNORECASE)
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_LITERAL = re.compile(r"\b\d+(?:\.\d+)?\b")
+
+
+def normalize(statement: str) -> str:
+    normalized = _WHITESPACE.sub(" ", statement).strip()
+    normalized = _STRING_LITERAL.sub("?", normalized)
+    normalized = _NUMBER_LITERAL.sub("?", normalized)
+    return _IN_LIST.sub("IN (...)", normalized)
+
+
+def fingerprint(statement: str) -> str:
+    return hashlib.sha1(normalize(statement).encode()).hexdigest()[:12]
+
+
+class StatementProfiler:
+    def __init__(
+            self,
+            ring_size: int = RING_SIZE,
+            slow_query_ms: float = SLOW_QUERY_MS,
+    ) -> None:
+        self.slow_query_seconds = slow_query_ms / 1000
+        # (statement, seconds, rowcount) of the last `ring_size` executions
+        self.ring: deque[tuple[str, float, int]] = deque(maxlen=ring_size)
+        # statement -> (fingerprint, normalized statement)
+        self._normalized: dict[str, tuple[str, str]] = {}
+        self.engines: list[Engine] = []
+
+    def _before_cursor_execute(
+            self, conn, cursor, statement, parameters, context, executemany):
+        context._profiler_start = time.perf_counter()
+
+    def _after_cursor_execute(
+            self, conn, cursor, statement, parameters, context, executemany):
+        seconds = time.perf_counter() - context._profiler_start
+        self.ring.append((statement, seconds, cursor.rowcount))
+        if seconds >= self.slow_query_seconds:
+            slow_query_logger.warning(
+                "%.1f ms: %s; parameters: %r",
+                seconds * 1000,
+                _WHITESPACE.sub(" ", statement).strip(),
+                parameters,
+            )
+
+    def install(self, engine: Engine):
+        event.listen(
+            engine, "before_cursor_execute", self._before_cursor_execute)
+        event.listen(
+            engine, "after_cursor_execute", self._after_cursor_execute)
+        self.engines.append(engine)
+
+    def uninstall(self, engine: Engine):
+        event.remove(
+            engine, "before_cursor_execute", self._before_cursor_execute)
+        event.remove(
+            engine, "after_cursor_execute", self._after_cursor_execute)
+        self.engines.remove(engine)
+
+    def reset(self):
+        self.ring.clear()
+
+    def _fingerprint(self, statement: str) -> tuple[str, str]:
+        cached = self._normalized.get(statement)
+        if cached is None:
+            if len(self._normalized) >= NORMALIZED_CACHE_SIZE:
+                self._normalized.clear()
+            normalized = normalize(statement)
+            cached = self._normalized[statement] = (
+                hashlib.sha1(normalized.encode()).hexdigest()[:12],
+                normalized,
+            )
+        return cached
+
+    def report(self, top: int = 20) -> dict[str, Any]:
+        """Per-fingerprint statistics, by total time spent."""
+        # copying the deque is atomic, appends may go on meanwhile
+        samples = list(self.ring)
+        groups: dict[str, dict[str, Any]] = {}
+        for statement, seconds, rowcount in samples:
+            key, normalized = self._fingerprint(statement)
+            group = groups.get(key)
+            if group is None:
+                group = groups[key] = {
+                    "fingerprint": key,
+                    "statement": normalized,
+                    "latencies": [],
+                    "rows": 0,
+                }
+            group["latencies"].append(seconds * 1000)
+            if rowcount > 0:
+                group["rows"] += rowcount
+
+        statements = []
+        for group in groups.values():
+            latencies = sorted(group.pop("latencies"))
+            histogram = [0] * len(HISTOGRAM_BOUNDS_MS)
+            for latency in latencies:
+                bucket = bisect.bisect_left(HISTOGRAM_BOUNDS_MS, latency)
+                histogram[bucket] += 1
+            statements.append({
+                **group,
+                "calls": len(latencies),
+                "total_ms": sum(latencies),
+                "mean_ms": statistics.fmean(latencies),
+                "p50_ms": percentile(latencies, 0.50),
+                "p95_ms": percentile(latencies, 0.95),
+                "p99_ms": percentile(latencies, 0.99),
+                "max_ms": latencies[-1],
+                "histogram": {
+                    f"le_{bound}": count
+                    for bound, count in zip(HISTOGRAM_BOUNDS_MS, histogram)
+                    if count
+                },
+            })
+        statements.sort(key=lambda s: s["total_ms"], reverse=True)
+        return {
+            "executions": len(samples),
+            "ring_size": self.ring.maxlen,
+            "slow_query_ms": self.slow_query_seconds * 1000,
+            "statements": statements[:top],
+        }
+
+    def dump_report(self, top: int = 20) -> str:
+        report = self.report(top)
+        lines = [
+            f"# {report['executions']} executions "
+            f"(last {report['ring_size']} kept), by total time:"
+        ]
+        for s in report["statements"]:
+            lines.append(
+                f"{s['fingerprint']} calls={s['calls']} "
+                f"total={s['total_ms']:.1f}ms mean={s['mean_ms']:.3f}ms "
+                f"p95={s['p95_ms']:.3f}ms max={s['max_ms']:.3f}ms "
+                f"rows={s['rows']}"
+            )
+            lines.append(f"    {s['statement']}")
+        return "\n".join(lines)
+
+
+def percentile(ordered: list[float], fraction: float) -> float:
+    index = min(len(ordered) - 1, int(fraction * len(ordered)))
+    return ordered[index]
+
+
+profiler = StatementProfiler()
+
+
+if __name__ == "__main__":
+    # Overhead of the profiler on an in-memory SQLite database: a primary
+    # key lookup through Core, the worst case in relative terms, and a
+    # product loaded through the ORM, like the FastAPI service does
+    from models import Base, Product
+    from sqlalchemy import create_engine, insert, select
+    from sqlalchemy.orm import Session
+
+    engine = create_engine("sqlite+pysqlite:///:memory:")
+    Base.metadata.create_all(engine)
+    with engine.begin() as conn:
+        conn.execute(insert(Product), [
+            {"product_name": f"Product {i}", "unit_price": 1 + i}
+            for i in range(1000)
+        ])
+
+    def core(queries: int) -> float:
+        stmt = select(Product.unit_price).where(Product.product_id == 1)
+        with engine.connect() as conn:
+            start = time.perf_counter()
+            for i in range(queries):
+                conn.execute(stmt).all()
+            return time.perf_counter() - start
+
+    def orm(queries: int) -> float:
+        stmt = select(Product).where(Product.product_id == 1)
+        start = time.perf_counter()
+        for i in range(queries):
+            with Session(engine) as session:
+                session.scalars(stmt).one()
+        return time.perf_counter() - start
+
+    # short interleaved rounds, keeping the fastest of each like `timeit`,
+    # since the noise is larger than the overhead
+    queries = 5_000
+    for name, run in (("core", core), ("orm", orm)):
+        run(queries)  # warm up
+        plain, profiled = [], []
+        for _ in range(20):
+            plain.append(run(queries))
+            profiler.install(engine)
+            profiled.append(run(queries))
+            profiler.uninstall(engine)
+        plain_time = min(plain)
+        added = min(profiled) - plain_time
+        print(f"{name}: {plain_time / queries * 1e6:.1f} us per query, "
+              f"profiler {added / queries * 1e6:+.2f} us "
+              f"({added / plain_time:+.1%})")
+    print(profiler.dump_report(5))
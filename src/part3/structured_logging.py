@@ -0,0 +1,151 @@
+"""
+Asynchronous, sampled JSON logging for SQLAlchemy and its event listeners.
+
+`setup_logging()` replaces the handlers of the given loggers with a
+`QueueHandler`: the request thread only puts the record on a queue, and a
+`QueueListener` thread formats the message, serializes it as JSON
+(python-json-logger) and writes it. A `SamplingFilter` on the queue handler
+drops records before they are queued, by event type: the `event` passed
+with `extra={"event": ...}`, or the logger name for records without one.
+
+Statement logging without `echo=True`: SQLAlchemy logs statements at INFO on
+the `sqlalchemy.engine` logger, so `setup_statement_logging()` sets that
+level and routes the records through the queue. It samples connections
+rather than records, so a request's statements, their parameters and its
+transaction are logged together, or not at all.
+
+The FastAPI service enables it when `SQL_LOG_RATE` (the fraction of
+connections whose statements are logged, e.g. 0.01) is set; see
+bench_logging.py for the latency cost of both.
+"""
+import atexit
+import logging
+import os
+import queue
+import random
+import sys
+from logging.handlers import QueueHandler, QueueListener
+from typing import IO, Callable, Iterable
+
+from pythonjsonlogger import jsonlogger
+from sqlalchemy import Connection, Engine, event
+
+SQL_LOG_RATE = float(os.environ.get("SQL_LOG_RATE", 0))
+
+JSON_FORMAT = "%(asctime)s %(name)s %(levelname)s %(funcName)s %(message)s"
+
+# engine -> its `engine_connect` listener sampling connections
+_samplers: dict[Engine, Callable[[Connection], None]] = {}
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keep a fraction of the records of each event type: `rates` maps event
+    types to rates between 0 (drop all) and 1 (keep all), `default` applies
+    to the others. Warnings and errors are always kept.
+    """
+
+    def __init__(self, rates: dict[str, float], default: float = 1.0) -> None:
+        super().__init__()
+        self.rates = rates
+        self.default = default
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self.rates.get(
+            getattr(record, "event", record.name), self.default)
+        return rate >= 1.0 or random.random() < rate
+
+
+class DeferredQueueHandler(QueueHandler):
+    """
+    A `QueueHandler` that leaves formatting to the listener thread. The
+    stock `prepare()` formats the message on the calling thread so records
+    can be pickled for a multiprocessing queue, which a thread does not need.
+    The arguments of a record must not be changed once it is logged, which
+    holds for SQLAlchemy's records (parameters are built per execution).
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+def json_handler(stream: IO[str] | None = None) -> logging.Handler:
+    handler = logging.StreamHandler(stream or sys.stderr)
+    handler.setFormatter(jsonlogger.JsonFormatter(JSON_FORMAT))
+    return handler
+
+
+def setup_logging(
+        loggers: Iterable[str],
+        rates: dict[str, float] | None = None,
+        default_rate: float = 1.0,
+        handler: logging.Handler | None = None,
+) -> QueueListener:
+    """
+    Route `loggers` through a queue to `handler` (JSON on stderr by
+    default). The listener is stopped, flushing the queue, at exit.
+    """
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    queue_handler = DeferredQueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter(rates or {}, default_rate))
+    for name in loggers:
+        logger = logging.getLogger(name)
+        for old_handler in logger.handlers[:]:
+            logger.removeHandler(old_handler)
+        logger.addHandler(queue_handler)
+        logger.propagate = False
+
+    listener = QueueListener(
+        log_queue, handler or json_handler(), respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+def setup_statement_logging(
+        engine: Engine,
+        rate: float = 1.0,
+        handler: logging.Handler | None = None,
+) -> QueueListener:
+    """
+    Log the statements of a fraction `rate` of the connections of `engine`
+    (a connection usually serves one request, so its statements are kept
+    or dropped together). The decision is taken when the connection is
+    created, before any record is: building a `LogRecord`, including the
+    lookup of the caller, is most of the cost of logging a statement.
+    """
+    logging.getLogger("sqlalchemy.engine").setLevel(logging.INFO)
+    if rate < 1.0:
+        def sample(conn: Connection):
+            # `_echo` is private: set from the logger level when `conn` is
+            # created, and checked before every log call of `Connection`, as
+            # of SQLAlchemy 2.0.20 (requirements.txt). A logging filter
+            # would only drop records once they are built, at full cost.
+            if conn._echo and random.random() >= rate:
+                conn._echo = False
+
+        event.listen(engine, "engine_connect", sample)
+        _samplers[engine] = sample
+    return setup_logging(["sqlalchemy.engine"], handler=handler)
+
+
+def stop_statement_logging(engine: Engine, listener: QueueListener):
+    logging.getLogger("sqlalchemy.engine").setLevel(logging.WARNING)
+    sample = _samplers.pop(engine, None)
+    if sample is not None:
+        event.remove(engine, "engine_connect", sample)
+    stop_logging(listener, ["sqlalchemy.engine"])
+
+
+def stop_logging(listener: QueueListener, loggers: Iterable[str]):
+    """Flush and stop `listener`, detaching its queue from `loggers`."""
+    atexit.unregister(listener.stop)
+    listener.stop()
+    for name in loggers:
+        logger = logging.getLogger(name)
+        for handler in logger.handlers[:]:
+            if isinstance(handler, QueueHandler):
+                logger.removeHandler(handler)
+        logger.propagate = True
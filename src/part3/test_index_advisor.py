@@ -0,0 +1,52 @@
+"""
+Run with `python -m pytest test_index_advisor.py` from src/part3.
+"""
+import pytest
+from index_advisor import IndexAdvisor, check_dialect
+from models import Base, Customer, Order
+from sqlalchemy import create_engine, insert, select, text
+from sqlalchemy.orm import Session
+
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = create_engine(f"sqlite+pysqlite:///{tmp_path / 'advisor.db'}")
+    Base.metadata.create_all(engine)
+    with Session(engine) as session:
+        session.execute(insert(Customer), [
+            {"first_name": "First", "last_name": f"Last {i}", "address": "",
+             "email": f"customer{i}@example.com"}
+            for i in range(1, 101)
+        ])
+        session.execute(insert(Order), [
+            {"customer_id": 1 + i % 100} for i in range(1_000)
+        ])
+        session.commit()
+    yield engine
+    engine.dispose()
+
+
+def schema(engine) -> list:
+    with engine.connect() as conn:
+        return conn.execute(text(
+            "SELECT type, name, sql FROM sqlite_master ORDER BY name")).all()
+
+
+def test_analyze_leaves_the_schema_unchanged(engine):
+    before = schema(engine)
+    advisor = IndexAdvisor(engine)
+    with advisor.capture(), Session(engine) as session:
+        session.scalars(select(Order).where(Order.customer_id == 1)).all()
+
+    analyses = advisor.analyze()
+
+    assert [proposal.name for proposal in analyses[0].proposals] == [
+        "ix_order_customer_id"]
+    assert analyses[0].after is not None
+    assert analyses[0].after.scans == []  # measured with the index
+    assert schema(engine) == before
+
+
+def test_unsupported_dialects_are_rejected():
+    with pytest.raises(ValueError, match="not mysql"):
+        check_dialect("mysql")
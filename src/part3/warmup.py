@@ -0,0 +1,122 @@
+"""
+Startup warm-up for the FastAPI service.
+
+The first requests after a deploy pay for mapper configuration, SQL
+compilation and opening database connections. The hot paths registered here
+are run once on every pooled connection before the app accepts traffic, so
+the compiled cache and the pool are already filled when requests arrive.
+"""
+import time
+from contextlib import ExitStack
+from typing import Callable
+
+import crud
+import models
+from sqlalchemy import Engine
+from sqlalchemy.orm import Session, configure_mappers
+
+HotPath = Callable[[Session], None]
+
+# statements used by `crud`, run against each pooled connection on startup
+HOT_PATHS: list[HotPath] = []
+
+
+def hot_path(fn: HotPath) -> HotPath:
+    """Register a function that executes a hot statement with a session."""
+    HOT_PATHS.append(fn)
+    return fn
+
+
+@hot_path
+def warm_get_product(session: Session):
+    # a PK that does not exist still compiles and executes the statement
+    crud.get_product(session, 0)
+
+
+@hot_path
+def warm_get_products(session: Session):
+    # default parameters of `GET /products`, in both directions
+    for direction in ("asc", "desc"):
+        crud.get_products(session, 1, 3, "product_id", direction)
+
+
+@hot_path
+def warm_create_product(session: Session):
+    # like `crud.create_product()`, but flushed instead of committed;
+    # the INSERT is rolled back by `warm_up_connection()`
+    session.add(models.Product(product_name="warm-up", unit_price=1))
+    session.flush()
+
+
+def warm_up_connection(conn, hot_paths: list[HotPath] = HOT_PATHS):
+    """
+    Run the hot paths on a single connection. Everything is rolled back, so
+    nothing written by the warm-up is ever visible to other transactions.
+    """
+    with Session(bind=conn) as session:
+        for fn in hot_paths:
+            fn(session)
+        session.rollback()
+
+
+def warm_up(
+        engine: Engine = models.engine,
+        connections: int | None = None,
+        hot_paths: list[HotPath] = HOT_PATHS,
+) -> dict[str, float]:
+    """
+    Configure the mappers, open `connections` connections (defaults to the
+    pool size) at the same time and run the hot paths on each of them.
+    Returns the time spent on every step in seconds.
+    """
+    timings = {}
+
+    start = time.perf_counter()
+    configure_mappers()
+    timings["configure_mappers"] = time.perf_counter() - start
+
+    if connections is None:
+        size = getattr(engine.pool, "size", None)
+        connections = size() if callable(size) else 1
+
+    with ExitStack() as stack:
+        # check out all connections before using them, otherwise the pool
+        # would hand out the same connection again and again; the ones
+        # opened are closed on exit, even if opening another one failed
+        start = time.perf_counter()
+        conns = [
+            stack.enter_context(engine.connect()) for _ in range(connections)
+        ]
+        timings["pool_prefill"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for conn in conns:
+            warm_up_connection(conn, hot_paths)
+        timings["hot_paths"] = time.perf_counter() - start
+
+    return timings
+
+
+def preload(engine: Engine = models.engine) -> dict[str, float]:
+    """
+    Warm up in the master process of a pre-forking server (e.g., gunicorn
+    with `--preload`): forked workers inherit the imported modules, the
+    configured mappers and the compiled cache. The pool is disposed, so no
+    connection is shared with the workers.
+    """
+    timings = warm_up(engine, connections=1)
+    engine.dispose()
+    return timings
+
+
+def after_fork(engine: Engine = models.engine):
+    """
+    Call in a forked worker: drop the pool inherited from the master
+    without closing connections the master may still use.
+    """
+    engine.dispose(close=False)
+
+
+if __name__ == "__main__":
+    for step, seconds in warm_up().items():
+        print(f"{step:<20}: {seconds * 1000:.2f} ms")